@@ -21,6 +21,22 @@ bool speedChange = true;
 
 bool heartbeat = false;
 
+// Binary command frames; see RaspberryPiCode/command_protocol.py
+//    for the layout. ASCII commands still work, since the sync
+//    byte is never sent as an ASCII command.
+const byte FRAME_SYNC = 0xA5;
+const byte FRAME_VERSION = 1;
+const byte FRAME_HEADER_SIZE = 5;
+const byte FRAME_MAX_PAYLOAD = 8;
+const byte FRAME_DRIVE = 0x01;
+const byte FRAME_KEEPALIVE = 0x02;
+const byte FRAME_ACK = 0x80;
+
+byte frameBuffer[FRAME_HEADER_SIZE + FRAME_MAX_PAYLOAD + 1];
+// Bytes of the current frame received so far; 0 when not in a frame
+int frameLength = 0;
+byte ackSeq = 0;
+
 // So the directions make sense
 enum directions
   {
@@ -175,6 +191,14 @@ void SerialEvent()
 
     // interpret input
     char inChar = (char)Serial.read();
+
+    // binary frames are handled separately from ASCII commands
+    if (frameLength > 0 || (byte)inChar == FRAME_SYNC)
+    {
+      ReceiveFrameByte((byte)inChar);
+      continue;
+    }
+
     switch (inChar)
     {
       case 'w':
@@ -201,14 +225,78 @@ void SerialEvent()
         newPath = Stop;
         break;
     }
-    // flag if direction change
-    if (newPath != path)
+    ChangePath(newPath);
+  }
+}
+
+// flag if direction change
+void ChangePath(int newPath)
+{
+  if (newPath != path)
+  {
+    pathChange = true;
+    // update path if it has been changed
+    path = newPath;
+  }
+}
+
+// Collect one byte of a binary frame, handling the frame once complete
+void ReceiveFrameByte(byte inByte)
+{
+  frameBuffer[frameLength++] = inByte;
+  if (frameLength < FRAME_HEADER_SIZE)
+    return;
+
+  // drop frames of an unknown version or too long to hold
+  byte payloadLength = frameBuffer[4];
+  if (frameBuffer[1] != FRAME_VERSION || payloadLength > FRAME_MAX_PAYLOAD)
+  {
+    frameLength = 0;
+    return;
+  }
+  if (frameLength < FRAME_HEADER_SIZE + payloadLength + 1)
+    return;
+
+  // the checksum covers everything but the sync byte and itself
+  byte crc = Crc8(&frameBuffer[1], FRAME_HEADER_SIZE - 1 + payloadLength);
+  if (crc == frameBuffer[FRAME_HEADER_SIZE + payloadLength])
+    HandleFrame(frameBuffer[2], frameBuffer[3], &frameBuffer[FRAME_HEADER_SIZE], payloadLength);
+  frameLength = 0;
+}
+
+// Act on a complete, valid frame, then acknowledge it
+void HandleFrame(byte frameType, byte seq, byte* payload, byte payloadLength)
+{
+  if (frameType == FRAME_DRIVE && payloadLength == 2)
+  {
+    // direction and speed arrive together
+    if (payload[0] <= backward)
+      ChangePath(payload[0]);
+    if (payload[1] != motorSpeed)
     {
-      pathChange = true;
-      // update path if it has been changed
-      path = newPath;
+      motorSpeed = payload[1];
+      speedChange = true;
     }
-      
   }
+  else if (frameType != FRAME_KEEPALIVE)
+    return;
+
+  // reply with the sequence number and type received
+  byte ack[FRAME_HEADER_SIZE + 3] = {FRAME_SYNC, FRAME_VERSION, FRAME_ACK, ackSeq++, 2, seq, frameType, 0};
+  ack[FRAME_HEADER_SIZE + 2] = Crc8(&ack[1], FRAME_HEADER_SIZE - 1 + 2);
+  Serial.write(ack, sizeof(ack));
+}
+
+// CRC-8, polynomial 0x07, matching command_protocol.crc8
+byte Crc8(byte* data, int length)
+{
+  byte crc = 0;
+  for (int i = 0; i < length; i++)
+  {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; bit++)
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+  }
+  return crc;
 }
 
@@ -0,0 +1,298 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# calibration_store.py
+# ********************
+# The colors and thresholds persist between runs in ``webcam_find_car_defaults.pickle``, which holds only one set of values; anything derived from them, such as the :class:`Color_Lut` tables, is rebuilt at every startup. This module instead keeps calibrations in a directory holding any number of named profiles -- for example, one per lighting setup -- along with the tables derived from each, so that startup only needs to load them. The directory looks like::
+#
+#   calibration/
+#     manifest.json
+#     bin_lab_6.npy
+#     profiles/
+#       daylight/
+#         target_lut_r3.npy
+#         line_lut_r3.npy
+#
+# ``manifest.json`` gives the format version, the active profile, and each profile's settings and tables::
+#
+#   {"format_version": 1, "active": "daylight",
+#    "profiles": {"daylight": {"revision": 3,
+#      "settings": {"target_threshold": 50, "target_color": [34.0, 17.0, -47.0],
+#                   "line_threshold": 50, "line_color": [34.0, 17.0, -47.0]},
+#      "tables": {"target": {"file": "profiles/daylight/target_lut_r3.npy", "bits": 6,
+#                            "color": [34.0, 17.0, -47.0], "threshold": 50}, ...}}}}
+#
+# Tables are stored as ``.npy`` files which are loaded with memory mapping, so loading costs almost nothing; the operating system reads each page of a table from disk the first time it's used, then keeps it in its cache. Each table records the color and threshold it was built from. A table which no longer matches its profile's settings (say, after hand-editing the manifest) is ignored and rebuilt rather than used.
+#
+# Saving a profile writes its tables to new files named by the profile's revision, then replaces the manifest in one step, so a program reading the store never sees a half-written profile. Switching profiles while the main loop runs is done by :meth:`Calibration_Store.switch_profile`, which loads (and if needed builds) the profile on a background thread; the loop then picks up the result through :meth:`Calibration_Store.poll`, without stalling. :meth:`poll` also notices when another program changes the active profile, so a running car can be switched with::
+#
+#   python calibration_store.py calibration activate evening
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import time
+
+import numpy
+
+from color_lut import Color_Lut
+
+# The version of the directory format written by this module. A manifest with a newer version can't be read.
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+# The profile made when a store is first created.
+DEFAULT_PROFILE = 'default'
+# The settings kept in a profile, and their values when nothing else is known. These match :class:`Webcam_Find_Car`'s defaults.
+DEFAULT_SETTINGS = {
+    'target_threshold': 50,
+    'target_color': (34.0, 17.0, -47.0),
+    'line_threshold': 50,
+    'line_color': (34.0, 17.0, -47.0),
+}
+# The tables kept for each profile, as the names of their color and threshold settings.
+TABLES = {
+    'target': ('target_color', 'target_threshold'),
+    'line': ('line_color', 'line_threshold'),
+}
+
+# A loaded profile. settings is a dict holding the values in :data:`DEFAULT_SETTINGS`, with the colors as float32 arrays. tables is a dict from each name in :data:`TABLES` to a (color, threshold, table) tuple, ready to pass to :meth:`Color_Lut.add_table`.
+Calibration = namedtuple('Calibration', 'name revision settings tables')
+
+
+class Calibration_Store(object):
+    # directory gives the calibration directory. If it doesn't exist, it's created when create is True; otherwise, an IOError is raised. lut_bits gives the :class:`Color_Lut` bits of the tables stored. check_interval gives the time in seconds between checks of the manifest for changes made by other programs.
+    def __init__(self, directory, create = False, lut_bits = 6, check_interval = 0.5):
+        self.directory = directory
+        self.lut_bits = lut_bits
+        self.check_interval = check_interval
+        self.manifest_path = os.path.join(directory, MANIFEST)
+        if not os.path.exists(self.manifest_path):
+            if not create:
+                raise IOError('No calibration manifest found at %s.' % self.manifest_path)
+            os.makedirs(directory, exist_ok = True)
+            self.manifest = {'format_version': FORMAT_VERSION, 'active': DEFAULT_PROFILE, 'profiles': {}}
+            self.write_manifest()
+        self.read_manifest()
+        # Used only to build tables which are missing or out of date; see :meth:`builder`.
+        self._builder = None
+        # Load profiles on a single background thread, so that switching never stalls the caller.
+        self.loader = ThreadPoolExecutor(1)
+        self.pending = None
+        # The name and revision of the profile last returned by :meth:`load` or :meth:`poll`.
+        self.loaded = None
+        self.last_check = time.monotonic()
+        # Statistics
+        self.tables_loaded = 0
+        self.tables_built = 0
+
+    def read_manifest(self):
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('format_version', 0) > FORMAT_VERSION:
+            raise ValueError('The calibration manifest %s has format version %s, but only version %d or older can be read.' %
+                             (self.manifest_path, manifest.get('format_version'), FORMAT_VERSION))
+        self.manifest = manifest
+        self.manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    # Replace the manifest in one step, so that a reader sees either the old or the new manifest, never part of one.
+    def write_manifest(self):
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent = 2)
+        os.replace(temp_path, self.manifest_path)
+        self.manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    def profiles(self):
+        return sorted(self.manifest['profiles'])
+
+    @property
+    def active(self):
+        return self.manifest['active']
+
+    # Make name the active profile, which is the one loaded by default.
+    def activate(self, name):
+        if name not in self.manifest['profiles']:
+            raise KeyError('No calibration profile named %s.' % name)
+        self.manifest['active'] = name
+        self.write_manifest()
+
+    # A :class:`Color_Lut` used to build tables. Its bin Lab values take longer to compute than a table, so they're stored with the tables as well.
+    def builder(self):
+        if self._builder is None:
+            bin_lab_path = os.path.join(self.directory, 'bin_lab_%d.npy' % self.lut_bits)
+            if os.path.exists(bin_lab_path):
+                self._builder = Color_Lut(self.lut_bits, bin_lab = numpy.load(bin_lab_path, mmap_mode = 'r'))
+            else:
+                self._builder = Color_Lut(self.lut_bits)
+                numpy.save(bin_lab_path, self._builder.bin_lab)
+        return self._builder
+
+    # Save settings (a dict holding the values in :data:`DEFAULT_SETTINGS`) as the profile name, building its tables. Any table already in lut (a :class:`Color_Lut`) is used rather than rebuilt. The profile's revision increases with each save.
+    def save(self, name, settings, lut = None):
+        settings = dict(DEFAULT_SETTINGS, **{key: settings[key] for key in DEFAULT_SETTINGS if key in settings})
+        settings['target_color'] = [float(c) for c in settings['target_color']]
+        settings['line_color'] = [float(c) for c in settings['line_color']]
+        old_profile = self.manifest['profiles'].get(name)
+        revision = old_profile['revision'] + 1 if old_profile else 1
+        profile_dir = os.path.join('profiles', name)
+        os.makedirs(os.path.join(self.directory, profile_dir), exist_ok = True)
+        tables = {}
+        for table_name, (color_key, threshold_key) in TABLES.items():
+            color = numpy.float32(settings[color_key])
+            threshold = settings[threshold_key]
+            table = None
+            if lut is not None and lut.bits == self.lut_bits:
+                table = lut.tables.get(lut.key(color, threshold))
+            if table is None:
+                table = self.builder().build_table(color, threshold)
+                self.tables_built += 1
+            file_name = os.path.join(profile_dir, '%s_lut_r%d.npy' % (table_name, revision))
+            numpy.save(os.path.join(self.directory, file_name), numpy.asarray(table))
+            tables[table_name] = {'file': file_name, 'bits': self.lut_bits, 'color': settings[color_key], 'threshold': threshold}
+        self.manifest['profiles'][name] = {'revision': revision, 'settings': settings, 'tables': tables}
+        self.write_manifest()
+        # The old revision's tables are no longer referenced. A program may still have them mapped; where the operating system won't remove a mapped file, leave it.
+        if old_profile:
+            for table in old_profile['tables'].values():
+                try:
+                    os.remove(os.path.join(self.directory, table['file']))
+                except OSError:
+                    pass
+
+    # Load the named profile (by default, the active one), returning a :class:`Calibration`. Its tables are memory-mapped. A table which is missing or doesn't match the profile's settings is built if build_missing is True, or else left out of the result.
+    def load(self, name = None, build_missing = True):
+        name = name or self.active
+        if name not in self.manifest['profiles']:
+            raise KeyError('No calibration profile named %s.' % name)
+        profile = self.manifest['profiles'][name]
+        settings = dict(profile['settings'])
+        settings['target_color'] = numpy.float32(settings['target_color'])
+        settings['line_color'] = numpy.float32(settings['line_color'])
+        tables = {}
+        for table_name, (color_key, threshold_key) in TABLES.items():
+            color = settings[color_key]
+            threshold = settings[threshold_key]
+            table = self._load_table(profile['tables'].get(table_name), color, threshold)
+            if table is None and build_missing:
+                table = self.builder().build_table(color, threshold)
+                self.tables_built += 1
+            if table is not None:
+                tables[table_name] = (color, threshold, table)
+        self.loaded = (name, profile['revision'])
+        return Calibration(name, profile['revision'], settings, tables)
+
+    # Memory-map the table described by table_info, returning None if it's missing or wasn't built for the given color and threshold.
+    def _load_table(self, table_info, color, threshold):
+        if (table_info is None or table_info['bits'] != self.lut_bits or table_info['threshold'] != threshold or
+            not numpy.array_equal(numpy.float32(table_info['color']), color)):
+            return None
+        try:
+            table = numpy.load(os.path.join(self.directory, table_info['file']), mmap_mode = 'r')
+        except (IOError, ValueError):
+            return None
+        if table.shape != (1 << 3*self.lut_bits,) or table.dtype != numpy.uint8:
+            return None
+        self.tables_loaded += 1
+        return table
+
+    # Start loading the named profile in the background; :meth:`poll` returns it once loaded. This replaces any switch still in progress.
+    def switch_profile(self, name):
+        if name not in self.manifest['profiles']:
+            raise KeyError('No calibration profile named %s.' % name)
+        self.pending = self.loader.submit(self.load, name)
+
+    # Call this once per frame. Returns a newly loaded :class:`Calibration` when a switch started by :meth:`switch_profile` finishes, or None otherwise. Every check_interval seconds, this also checks whether another program has changed the manifest; if the active profile (or its revision) changed, a switch to it is started.
+    def poll(self):
+        now = time.monotonic()
+        if now - self.last_check >= self.check_interval:
+            self.last_check = now
+            self.check_manifest()
+        if self.pending is not None and self.pending.done():
+            pending = self.pending
+            self.pending = None
+            try:
+                return pending.result()
+            except (IOError, ValueError, KeyError) as e:
+                print('Unable to load calibration profile: %s' % e)
+        return None
+
+    def check_manifest(self):
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+            if mtime == self.manifest_mtime:
+                return
+            self.read_manifest()
+        except (IOError, ValueError) as e:
+            print('Unable to read the calibration manifest: %s' % e)
+            return
+        active = self.manifest['profiles'].get(self.active)
+        if active is not None and self.pending is None and self.loaded != (self.active, active['revision']):
+            self.switch_profile(self.active)
+
+    def close(self):
+        self.loader.shutdown()
+
+    def report(self):
+        return "Calibration: profile %s, %d tables loaded, %d built" % (self.loaded[0] if self.loaded else None, self.tables_loaded, self.tables_built)
+
+
+# Read the settings saved in the pickle file used before calibration directories, returning a dict, or None if the file can't be read.
+def read_pickle_settings(pickle_filename = 'webcam_find_car_defaults.pickle'):
+    import pickle
+    try:
+        with open(pickle_filename, 'rb') as f:
+            target_threshold, target_color, line_threshold, line_color = pickle.load(f)
+    except (IOError, ValueError) as e:
+        print('Unable to read %s: %s' % (pickle_filename, e))
+        return None
+    return {'target_threshold': target_threshold, 'target_color': target_color, 'line_threshold': line_threshold, 'line_color': line_color}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Manage a calibration directory.')
+    parser.add_argument('directory', help = 'The calibration directory.')
+    subparsers = parser.add_subparsers(dest = 'command')
+    subparsers.add_parser('list', help = 'List the profiles.')
+    save_parser = subparsers.add_parser('save', help = 'Save a profile from a JSON settings file, or from the last saved settings.')
+    save_parser.add_argument('name')
+    save_parser.add_argument('--config', help = 'A JSON settings file; see Webcam_Find_Car.load_config.')
+    activate_parser = subparsers.add_parser('activate', help = 'Make a profile active; running programs switch to it.')
+    activate_parser.add_argument('name')
+    time_parser = subparsers.add_parser('time', help = 'Compare loading a profile with building its tables.')
+    time_parser.add_argument('name', nargs = '?')
+    args = parser.parse_args()
+
+    store = Calibration_Store(args.directory, create = args.command == 'save')
+    if args.command == 'save':
+        if args.config:
+            with open(args.config) as f:
+                settings = json.load(f)
+        else:
+            settings = read_pickle_settings() or DEFAULT_SETTINGS
+        store.save(args.name, settings)
+        print("Saved %s, revision %d." % (args.name, store.manifest['profiles'][args.name]['revision']))
+    elif args.command == 'activate':
+        store.activate(args.name)
+    elif args.command == 'time':
+        start = time.perf_counter()
+        calibration = store.load(args.name)
+        lut = Color_Lut(store.lut_bits)
+        for color, threshold, table in calibration.tables.values():
+            lut.add_table(color, threshold, table)
+        load_ms = (time.perf_counter() - start)*1000.0
+        start = time.perf_counter()
+        lut = Color_Lut(store.lut_bits)
+        for color, threshold, table in calibration.tables.values():
+            lut.prepare(color, threshold)
+        build_ms = (time.perf_counter() - start)*1000.0
+        print("%s: loading takes %.2f ms; building the tables takes %.2f ms." % (calibration.name, load_ms, build_ms))
+    else:
+        for name in store.profiles():
+            profile = store.manifest['profiles'][name]
+            print("%s%s (revision %d): %s" % ('* ' if name == store.active else '  ', name, profile['revision'],
+                  ", ".join("%s %s" % (key, value) for key, value in sorted(profile['settings'].items()))))
+    store.close()
+
+if __name__ == "__main__":
+    main()
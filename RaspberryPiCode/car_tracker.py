@@ -0,0 +1,134 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# car_tracker.py
+# **************
+# The car's location found in a frame is already out of date when the car acts on it: the frame waits in the camera and capture buffer, processing takes time, and the firmware pauses (``delay(100)``) when it changes direction. A frame in which the car isn't found gives no location at all. This module fuses the car's locations over time using a Kalman filter with a constant-velocity model, which gives a smoothed position and velocity, predicts where the car will be when a command takes effect, and coasts on the predicted motion through short gaps in detection.
+#
+# The state is the car's x, y position in pixels and its x, y velocity in pixels per second, in image coordinates (y increases downward). The model assumes the velocity changes only by random accelerations, whose size is set by accel_noise.
+from collections import namedtuple
+from math import atan2, sqrt
+import time
+
+import numpy
+
+# The tracker's estimate at one time. position is (x, y) and velocity is (vx, vy) in pixels per second. heading gives the direction of travel in radians, using the same convention as :class:`Estimate_Car_Orientation` (counterclockwise from the x axis, y upward), or None if the car is moving too slowly to tell. covariance is the 4x4 covariance of (x, y, vx, vy). predicted is the position expected latency seconds later, when a command sent now takes effect. coasting is the time, in seconds, since the car was last detected; it's 0 for a frame where the car was found.
+Car_State = namedtuple('Car_State', 'position velocity heading covariance predicted coasting')
+
+
+class Car_Tracker(object):
+    # latency gives the time, in seconds, from capturing a frame until a command based on it takes effect. accel_noise gives the typical acceleration of the car, in pixels/s^2; measurement_noise gives the typical error in a detected location, in pixels. If the car isn't detected for max_coast seconds, the track is dropped. A detection more than gate standard deviations from the predicted location is ignored as a false detection, unless the track has been coasting for over half of max_coast, in which case the tracker restarts at the new location. heading is reported only at speeds of at least min_speed pixels/s.
+    def __init__(self, latency = 0.15, accel_noise = 100.0, measurement_noise = 2.0, initial_speed = 200.0, max_coast = 0.5, gate = 5.0, min_speed = 10.0):
+        self.latency = latency
+        self.accel_noise = accel_noise
+        self.measurement_noise = measurement_noise
+        self.initial_speed = initial_speed
+        self.max_coast = max_coast
+        self.gate = gate
+        self.min_speed = min_speed
+        # Only positions are measured.
+        self.H = numpy.array([[1.0, 0.0, 0.0, 0.0],
+                              [0.0, 1.0, 0.0, 0.0]])
+        self.R = numpy.eye(2)*measurement_noise**2
+        self.reset()
+        # Statistics
+        self.detections = 0
+        self.dropouts = 0
+        self.rejected = 0
+        self.restarts = 0
+
+    # Forget the car's state, so that the next detection starts a new track.
+    def reset(self):
+        self.x = None
+        self.P = None
+        self.time = None
+        self.last_detection_time = None
+
+    # True if the tracker has an estimate of the car's state.
+    @property
+    def valid(self):
+        return self.x is not None
+
+    # Return the state transition matrix and process noise for a step of dt seconds.
+    def transition(self, dt):
+        F = numpy.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        # Integrate white-noise acceleration over the step.
+        q = self.accel_noise**2
+        Q = numpy.zeros((4, 4))
+        Q[0, 0] = Q[1, 1] = q*dt**3/3.0
+        Q[0, 2] = Q[2, 0] = Q[1, 3] = Q[3, 1] = q*dt**2/2.0
+        Q[2, 2] = Q[3, 3] = q*dt
+        return F, Q
+
+    # Return the state and covariance predicted dt seconds ahead, without changing the tracker.
+    def predict(self, dt):
+        F, Q = self.transition(dt)
+        return F.dot(self.x), F.dot(self.P).dot(F.T) + Q
+
+    # Add the car's location xy found in the frame captured at timestamp seconds (from ``time.perf_counter()`` if not given). Pass None, or the (-1, -1) returned by :func:`find_car`, if the car wasn't found. Returns the new :class:`Car_State`, or None if there's no track.
+    def update(self, xy, timestamp = None):
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        detected = xy is not None and xy[0] >= 0 and xy[1] >= 0
+        if self.x is None:
+            if not detected:
+                return None
+            self.start(xy, timestamp)
+            return self.state()
+        # Move the estimate forward to this frame.
+        dt = max(timestamp - self.time, 0.0)
+        self.x, self.P = self.predict(dt)
+        self.time = timestamp
+        if detected:
+            z = numpy.array(xy, dtype = numpy.float64)
+            innovation = z - self.H.dot(self.x)
+            S = self.H.dot(self.P).dot(self.H.T) + self.R
+            S_inv = numpy.linalg.inv(S)
+            # Ignore a detection too far from the prediction to be the car, such as another object of a similar color.
+            if innovation.dot(S_inv).dot(innovation) > self.gate**2:
+                if timestamp - self.last_detection_time > self.max_coast/2.0:
+                    self.restarts += 1
+                    self.start(xy, timestamp)
+                    return self.state()
+                self.rejected += 1
+                detected = False
+            else:
+                K = self.P.dot(self.H.T).dot(S_inv)
+                self.x = self.x + K.dot(innovation)
+                # Use the Joseph form, which keeps P symmetric and positive definite despite rounding.
+                I_KH = numpy.eye(4) - K.dot(self.H)
+                self.P = I_KH.dot(self.P).dot(I_KH.T) + K.dot(self.R).dot(K.T)
+                self.last_detection_time = timestamp
+                self.detections += 1
+        if not detected:
+            self.dropouts += 1
+            if timestamp - self.last_detection_time > self.max_coast:
+                self.reset()
+                return None
+        return self.state()
+
+    # Start a new track at xy, with an unknown velocity.
+    def start(self, xy, timestamp):
+        self.x = numpy.array([xy[0], xy[1], 0.0, 0.0], dtype = numpy.float64)
+        self.P = numpy.diag([self.measurement_noise**2]*2 + [self.initial_speed**2]*2)
+        self.time = timestamp
+        self.last_detection_time = timestamp
+        self.detections += 1
+
+    # Return the current :class:`Car_State`.
+    def state(self):
+        vx, vy = self.x[2:4]
+        speed = sqrt(vx*vx + vy*vy)
+        predicted, predicted_P = self.predict(self.latency)
+        return Car_State(
+            position = (self.x[0], self.x[1]),
+            velocity = (vx, vy),
+            heading = atan2(-vy, vx) if speed >= self.min_speed else None,
+            covariance = self.P.copy(),
+            predicted = (predicted[0], predicted[1]),
+            coasting = self.time - self.last_detection_time)
+
+    def report(self):
+        return ("%d detections, %d dropouts, %d rejected, %d restarts" %
+                (self.detections, self.dropouts, self.rejected, self.restarts))
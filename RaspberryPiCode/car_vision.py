@@ -0,0 +1,167 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# car_vision.py
+# *************
+# This is the single command-line entry point for the vision code. The first argument picks the mode:
+#
+# track
+#   Find and steer the car using :class:`Webcam_Find_Car`.
+# tune
+#   Show the masks of the arena colors, to tune their ranges; see ``will_cv2_testing.py``.
+# replay
+#   Replay a recording through the car-finding code and report its speed; see ``replay_benchmark.py``.
+# log
+#   Summarize or export a flight log recorded with ``track --record``; see ``flight_recorder.py``.
+# startup
+#   Measure the time to import the detection code and to process the first frame, checking each against a budget.
+#
+# For example::
+#
+#   python car_vision.py track --lut --calibration calibration
+#   python car_vision.py track --headless --lut --preview-port 8080
+#   python car_vision.py track --headless --lut --record run.flog --record-jpeg 80
+#   python car_vision.py replay recording.avi --lut
+#   python car_vision.py log run.flog --export run_frames
+#   python car_vision.py startup
+#
+# Each mode's module is imported only when that mode runs, so ``track`` never loads the tuner's libraries, and the reverse. Likewise, importing the detection code loads neither pyserial (needed only to talk to a real car) nor matplotlib (needed only by one tutorial routine in the tuner); ``startup`` checks this.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# The startup budgets, in milliseconds. These are generous on a desktop; they're meant to hold on the Raspberry Pi, where importing OpenCV alone takes most of a second.
+IMPORT_BUDGET_MS = 1500.0
+FIRST_FRAME_BUDGET_MS = 500.0
+# Modules which importing the detection code mustn't load.
+LAZY_MODULES = ('serial', 'matplotlib', 'color_lut', 'car_tracker', 'resolution_controller', 'calibration_store', 'line_cache',
+                'stage_scheduler', 'path_planner', 'render_thread', 'mjpeg_server', 'flight_recorder')
+
+
+def track(args):
+    parser = argparse.ArgumentParser(prog = 'car_vision.py track', description = 'Find and steer the car.')
+    parser.add_argument('source', nargs = '?', default = '0', help = 'A webcam index, video file, directory of images, or flight log.')
+    parser.add_argument('--port', type = int, help = 'The serial port number of the car; without this, commands are only printed.')
+    parser.add_argument('--headless', action = 'store_true', help = 'Run without windows; stop with Ctrl+C.')
+    parser.add_argument('--config', help = 'A JSON settings file; see Webcam_Find_Car.load_config.')
+    parser.add_argument('--calibration', help = 'A calibration directory; see calibration_store.py.')
+    parser.add_argument('--profile', help = 'With --calibration, the profile to use rather than the active one.')
+    parser.add_argument('--lut', action = 'store_true', help = 'Classify colors using a lookup table.')
+    parser.add_argument('--windowed', action = 'store_true', help = 'Search for the car near its last location.')
+    parser.add_argument('--track', action = 'store_true', help = 'Fuse the car\'s locations using a Kalman filter.')
+    parser.add_argument('--threaded', action = 'store_true', help = 'Grab frames on a background thread.')
+    parser.add_argument('--schedule', action = 'store_true', help = 'Find the lines and draw at lower rates than finding the car.')
+    parser.add_argument('--cache-lines', action = 'store_true', help = 'Reuse the lines found until the scene changes.')
+    parser.add_argument('--plan', action = 'store_true', help = 'Steer along a path planned around the lines.')
+    parser.add_argument('--render-thread', action = 'store_true', help = 'Draw the results on a separate thread.')
+    parser.add_argument('--preview-port', type = int, help = 'Serve the drawings as an MJPEG stream on this port, to watch from a browser; works with --headless.')
+    parser.add_argument('--record', help = 'Record the frames, results and commands to this flight log, to replay later.')
+    parser.add_argument('--record-every', type = int, default = 1, help = 'With --record, keep the frame of one tick in this many.')
+    parser.add_argument('--record-jpeg', type = int, help = 'With --record, store frames as JPEG images of this quality, rather than raw.')
+    parser.add_argument('--target-ms', type = float, help = 'Choose the processing scale of each frame to take about this long.')
+    parser.add_argument('--stage-timing', action = 'store_true', help = 'Report the time taken by each stage of the pipeline.')
+    args = parser.parse_args(args)
+
+    from jones_webcam_opencv_code import Webcam_Find_Car
+    from frame_sources import open_frame_source
+    wfc = Webcam_Find_Car(comm_port = args.port, frame_source = open_frame_source(args.source), headless = args.headless,
+                          config_file = args.config, calibration_dir = args.calibration, profile = args.profile,
+                          use_lut = args.lut, windowed_search = args.windowed, track_car = args.track,
+                          threaded_capture = args.threaded, target_frame_ms = args.target_ms, stage_timing = args.stage_timing,
+                          schedule_stages = args.schedule, cache_lines = args.cache_lines, plan_path = args.plan,
+                          render_thread = args.render_thread, preview_port = args.preview_port,
+                          record_file = args.record, record_every = args.record_every, record_jpeg_quality = args.record_jpeg)
+    wfc.main()
+
+
+def tune(args):
+    import will_cv2_testing
+    will_cv2_testing.main(args)
+
+
+def replay(args):
+    import replay_benchmark
+    replay_benchmark.main(args)
+
+
+def log(args):
+    import flight_recorder
+    flight_recorder.main(args)
+
+
+# Import module in a fresh interpreter, returning the time this took in milliseconds and a list of the :data:`LAZY_MODULES` it loaded.
+def measure_import(module = 'jones_webcam_opencv_code'):
+    code = ("import json, sys, time\n"
+            "start = time.perf_counter()\n"
+            "import %s\n"
+            "print(json.dumps([(time.perf_counter() - start)*1000.0, [name for name in %r if name in sys.modules]]))" %
+            (module, LAZY_MODULES))
+    # Run from this directory, so the module is found.
+    output = subprocess.check_output([sys.executable, '-c', code], cwd = os.path.dirname(os.path.abspath(__file__)))
+    import_ms, loaded = json.loads(output.decode().strip().splitlines()[-1])
+    return import_ms, loaded
+
+
+# Return the time in milliseconds from creating a headless :class:`Webcam_Find_Car` to finishing the first frame, image. Any keyword arguments are passed to :class:`Webcam_Find_Car`.
+def measure_first_frame(image, **options):
+    from jones_webcam_opencv_code import Webcam_Find_Car
+    from frame_sources import Array_Source
+    start = time.perf_counter()
+    wfc = Webcam_Find_Car(headless = True, frame_source = Array_Source([image]), **options)
+    wfc.grab_frame()
+    wfc.update()
+    first_frame_ms = (time.perf_counter() - start)*1000.0
+    wfc.ser.close()
+    return first_frame_ms
+
+
+def startup(args):
+    parser = argparse.ArgumentParser(prog = 'car_vision.py startup', description = 'Measure the import and startup time of the detection code.')
+    parser.add_argument('--source', help = 'Take the first frame from this video file or directory of images, rather than using a blank frame.')
+    parser.add_argument('--config', help = 'A JSON settings file; see Webcam_Find_Car.load_config.')
+    parser.add_argument('--calibration', help = 'A calibration directory; see calibration_store.py.')
+    parser.add_argument('--lut', action = 'store_true', help = 'Classify colors using a lookup table.')
+    parser.add_argument('--import-budget', type = float, default = IMPORT_BUDGET_MS, help = 'The import budget, in milliseconds.')
+    parser.add_argument('--first-frame-budget', type = float, default = FIRST_FRAME_BUDGET_MS, help = 'The budget from startup to the first processed frame, in milliseconds.')
+    args = parser.parse_args(args)
+
+    import_ms, loaded = measure_import()
+    print("Import: %.1f ms (budget %.0f ms)" % (import_ms, args.import_budget))
+    if loaded:
+        print("Import loaded %s, which should only be loaded when used." % ", ".join(loaded))
+
+    import numpy
+    if args.source:
+        from frame_sources import open_frame_source, read_all_frames
+        image = read_all_frames(open_frame_source(args.source), 1)[0]
+    else:
+        image = numpy.zeros((480, 640, 3), numpy.uint8)
+    first_frame_ms = measure_first_frame(image, config_file = args.config, calibration_dir = args.calibration, use_lut = args.lut)
+    print("Startup to first processed frame: %.1f ms (budget %.0f ms)" % (first_frame_ms, args.first_frame_budget))
+
+    within_budget = import_ms <= args.import_budget and first_frame_ms <= args.first_frame_budget and not loaded
+    print("Within budget." if within_budget else "OVER BUDGET.")
+    return 0 if within_budget else 1
+
+
+MODES = {
+    'track': track,
+    'tune': tune,
+    'replay': replay,
+    'log': log,
+    'startup': startup,
+}
+
+
+def main(args = None):
+    args = sys.argv[1:] if args is None else args
+    if not args or args[0] not in MODES:
+        print("Usage: car_vision.py {%s} [options]; use a mode with --help for its options." % ",".join(MODES))
+        return 2
+    return MODES[args[0]](args[1:])
+
+if __name__ == "__main__":
+    sys.exit(main())
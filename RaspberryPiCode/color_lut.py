@@ -0,0 +1,140 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# color_lut.py
+# ************
+# Per the profiler, converting each frame to the Lab color space then computing a distance to the target color at every pixel takes most of the processing time. However, the result of this computation for a given pixel depends only on that pixel's BGR value, the target color and the threshold. So, this module computes the answer once for every (quantized) BGR value, storing it in a lookup table. Classifying a frame then becomes a single table lookup on the 8-bit image, with no floating-point conversion at all.
+#
+# The table is rebuilt only when the target color or threshold change, which happens only when the user clicks on the image or moves a trackbar.
+#
+# Run this file to check the tables against the exact classification on a recording (see :func:`check_lut`), exiting with a non-zero status if they agree on less than :data:`MIN_AGREEMENT` of the pixels::
+#
+#   python color_lut.py recording.avi --config settings.json
+import argparse
+import sys
+
+import cv2
+import numpy
+
+# The least fraction of pixels on which a 6-bit table must agree with the exact classification. Quantizing each channel to 6 bits moves a pixel's color by at most 2.9 Lab units from its bin's center, so only pixels whose distance from the target color lies within 2.9 of the threshold can be misclassified. Even on noisy images these are under 2% of the frame, and the morphological open which follows removes most of them.
+MIN_AGREEMENT = 0.98
+
+
+# This class holds lookup tables for one or more (Lab color, threshold) pairs.
+class Color_Lut(object):
+    # bits gives the number of bits per BGR channel used to index the table; the table holds 2**(3*bits) entries. 6 bits (64 levels per channel) gives a 256 KB table, which agrees with the exact Lab classification on ~98% of pixels even for noisy images; 5 bits gives a smaller 32 KB table at some loss of accuracy. max_tables bounds the number of tables kept, since dragging a trackbar produces a new (color, threshold) pair at each step. bin_lab optionally supplies a previously computed :attr:`bin_lab`, such as one loaded by a :class:`Calibration_Store`.
+    def __init__(self, bits = 6, max_tables = 4, bin_lab = None):
+        assert 1 <= bits <= 8
+        self.bits = bits
+        self.max_tables = max_tables
+        self.shift = 8 - bits
+        # Map from a (color, threshold) key to its table, in least- to most-recently used order.
+        self.tables = {}
+        # Count table builds, to verify they happen only when the color or threshold change.
+        self.builds = 0
+        self._bin_lab = bin_lab
+
+    # Lab values for the center of every quantized BGR bin, computed once since they don't depend on the color or threshold. Computing these takes longer than building a table, so it's put off until a table must actually be built; tables loaded from a :class:`Calibration_Store` never need them.
+    @property
+    def bin_lab(self):
+        if self._bin_lab is None:
+            self._bin_lab = _bin_centers_to_lab(self.bits)
+        return self._bin_lab
+
+    @staticmethod
+    def key(lab_color, thresh):
+        return tuple(float(c) for c in lab_color), float(thresh)
+
+    # Build (if necessary) the table for the given color and threshold. Call this when the color or threshold change, so that the per-frame :meth:`threshold` never needs to build a table.
+    def prepare(self, lab_color, thresh):
+        key = self.key(lab_color, thresh)
+        table = self.tables.pop(key, None)
+        if table is None:
+            table = self.build_table(lab_color, thresh)
+            self.builds += 1
+        self.add_table(lab_color, thresh, table)
+        return table
+
+    # Add a table built earlier for the given color and threshold, such as one loaded from a :class:`Calibration_Store`.
+    def add_table(self, lab_color, thresh, table):
+        assert table.shape == (1 << 3*self.bits,)
+        key = self.key(lab_color, thresh)
+        self.tables.pop(key, None)
+        # Insert the table last to mark it as most recently used, evicting the least recently used table if there are too many.
+        self.tables[key] = table
+        while len(self.tables) > self.max_tables:
+            del self.tables[next(iter(self.tables))]
+
+    # Compute a table which gives 255 for each BGR bin whose Lab value lies within thresh of lab_color, or 0 otherwise -- the same test as :func:`find_lab_color`.
+    def build_table(self, lab_color, thresh):
+        diff = self.bin_lab - numpy.float32(lab_color)
+        normsq = numpy.sum(diff*diff, -1)
+        return numpy.where(normsq <= thresh**2.0, 255, 0).astype(numpy.uint8)
+
+    # Classify every pixel of the 8-bit BGR image, returning a uint8 image with 255 for pixels near the target color, 0 elsewhere.
+    def threshold(self, image, lab_color, thresh):
+        table = self.tables.get(self.key(lab_color, thresh))
+        if table is None:
+            table = self.prepare(lab_color, thresh)
+        return table[self.index_image(image)]
+
+    # Combine the quantized B, G, R values of each pixel into a single table index.
+    def index_image(self, image):
+        b, g, r = cv2.split(image)
+        index = (b >> self.shift).astype(numpy.int32) << (2*self.bits)
+        index |= (g >> self.shift).astype(numpy.int32) << self.bits
+        index |= r >> self.shift
+        return index
+
+
+# Compute the Lab value of the center of every BGR bin, in table-index order (blue varies slowest, red fastest).
+def _bin_centers_to_lab(bits):
+    levels = 1 << bits
+    step = 256 // levels
+    centers = numpy.arange(levels, dtype = numpy.float32)*step + (step - 1)/2.0
+    b, g, r = numpy.meshgrid(centers, centers, centers, indexing = 'ij')
+    bgr_image = numpy.stack((b.ravel(), g.ravel(), r.ravel()), -1).reshape(1, -1, 3)
+    # This matches :func:`im_to_lab`: scale to [0, 1] then convert.
+    lab_image = cv2.cvtColor(bgr_image / numpy.float32(255.0), cv2.COLOR_BGR2LAB)
+    return lab_image[0]
+
+
+# Check the lookup-table classification against the exact Lab distance computed by :func:`find_lab_color` for the given image, returning the fraction of pixels on which the two masks agree. Quantization means pixels very close to the threshold may disagree; the morphological open which follows removes most such isolated pixels.
+def lut_agreement(image, lab_color, thresh, lut):
+    # Imported here, since the detection code imports this module.
+    from jones_webcam_opencv_code import threshold_lab_color, im_to_lab
+    exact_image = threshold_lab_color(im_to_lab(image), numpy.float32(lab_color), thresh)
+    return numpy.mean(exact_image == lut.threshold(image, lab_color, thresh))
+
+
+# Return the lowest :func:`lut_agreement` of lut over frames (8-bit BGR images) for the given color and threshold.
+def check_lut(frames, lab_color, thresh, lut):
+    return min(lut_agreement(frame, lab_color, thresh, lut) for frame in frames)
+
+
+def main():
+    from frame_sources import open_frame_source, read_all_frames
+    from process_pipeline import load_settings
+    parser = argparse.ArgumentParser(description = 'Check the color lookup tables against the exact Lab classification.')
+    parser.add_argument('recording', help = 'A video file, a directory of images, or a flight log.')
+    parser.add_argument('--config', help = 'A JSON settings file; see Webcam_Find_Car.load_config.')
+    parser.add_argument('--max-frames', type = int, default = 100, help = 'Use at most this many frames of the recording.')
+    parser.add_argument('--bits', type = int, default = 6, help = 'The bits per channel of the tables.')
+    parser.add_argument('--min-agreement', type = float, default = MIN_AGREEMENT, help = 'The least fraction of pixels which must agree in every frame.')
+    args = parser.parse_args()
+
+    frames = read_all_frames(open_frame_source(args.recording), args.max_frames)
+    # Classify the half-size frames the detection code sees.
+    frames = [cv2.resize(frame, (frame.shape[1] // 2, frame.shape[0] // 2)) for frame in frames]
+    settings = load_settings(args.config)
+    lut = Color_Lut(args.bits)
+    within_tolerance = True
+    for name in ('target', 'line'):
+        agreement = check_lut(frames, settings[name + '_color'], settings[name + '_threshold'], lut)
+        print("The %s color: the table agrees on at least %.2f%% of pixels (tolerance %.2f%%)" % (name, agreement*100.0, args.min_agreement*100.0))
+        within_tolerance = within_tolerance and agreement >= args.min_agreement
+    print("Within tolerance." if within_tolerance else "OUT OF TOLERANCE.")
+    return 0 if within_tolerance else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
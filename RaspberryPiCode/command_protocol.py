@@ -0,0 +1,145 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# command_protocol.py
+# *******************
+# This module encodes and decodes the binary command frames sent to the car's Arduino (see ``ArduinoCode/Controlled_Motors.ino``). The older protocol sends one ASCII character per command, so it can't set the speed and direction together: changing speed takes one ``+`` or ``-`` per step of 20, and there's no way to detect a lost or corrupted byte. Each frame instead carries a complete command plus a sequence number and checksum:
+#
+# ======  =======  ==============================================
+# Offset  Size     Contents
+# ======  =======  ==============================================
+# 0       1        Sync byte, 0xA5 (not a printable ASCII command)
+# 1       1        Protocol version, currently 1
+# 2       1        Frame type (see below)
+# 3       1        Sequence number, 0-255, wrapping around
+# 4       1        Payload length, at most :data:`MAX_PAYLOAD`
+# 5       length   Payload
+# 5+len   1        CRC-8 (polynomial 0x07) of bytes 1 through 4+len
+# ======  =======  ==============================================
+#
+# Frame types:
+#
+# - :data:`DRIVE`: payload is the direction (one of the ``Stop`` ... ``backward`` values of the firmware's ``directions`` enum) then the motor speed, 0-255.
+# - :data:`KEEPALIVE`: no payload; tells the car the controller is still running.
+# - :data:`ACK`: sent by the car; the payload is the sequence number and type of the frame acknowledged.
+from collections import namedtuple
+import struct
+
+SYNC = 0xA5
+VERSION = 1
+HEADER_SIZE = 5
+MAX_PAYLOAD = 8
+
+# Frame types
+DRIVE = 0x01
+KEEPALIVE = 0x02
+ACK = 0x80
+
+# Directions, matching the ``directions`` enum in ``Controlled_Motors.ino``.
+STOP = 0
+FORWARD = 1
+RIGHT = 2
+LEFT = 3
+BACKWARD = 4
+
+# A decoded frame.
+Frame = namedtuple('Frame', 'type seq payload')
+
+
+# Compute the CRC-8 (polynomial x^8 + x^2 + x + 1, initial value 0) of some bytes. The firmware uses the same bit-by-bit algorithm, so a table isn't needed there.
+def crc8(data):
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+# Build a complete frame of the given type, sequence number and payload.
+def encode_frame(frame_type, seq, payload = b''):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("Payload of %d bytes exceeds the maximum of %d." % (len(payload), MAX_PAYLOAD))
+    body = struct.pack('BBBB', VERSION, frame_type, seq & 0xFF, len(payload)) + bytes(payload)
+    return bytes(bytearray([SYNC])) + body + bytes(bytearray([crc8(body)]))
+
+
+# Build frames with consecutive sequence numbers.
+class Command_Encoder(object):
+    def __init__(self):
+        self.seq = 0
+
+    def next_seq(self):
+        seq = self.seq
+        self.seq = (self.seq + 1) & 0xFF
+        return seq
+
+    # Set the direction and speed together.
+    def drive(self, direction, speed):
+        if not STOP <= direction <= BACKWARD:
+            raise ValueError("Unknown direction %d." % direction)
+        return encode_frame(DRIVE, self.next_seq(), struct.pack('BB', direction, max(0, min(255, int(speed)))))
+
+    def stop(self):
+        return self.drive(STOP, 0)
+
+    def keepalive(self):
+        return encode_frame(KEEPALIVE, self.next_seq())
+
+    # Used by the car (or a stand-in for it) to acknowledge a frame.
+    def ack(self, frame):
+        return encode_frame(ACK, self.next_seq(), struct.pack('BB', frame.seq, frame.type))
+
+
+# Extract frames from a stream of bytes, which may arrive in pieces of any size. Bytes which don't form a valid frame are skipped: after a bad checksum, the search for the next sync byte resumes just after the bad frame's sync byte.
+class Frame_Decoder(object):
+    def __init__(self):
+        self.buffer = bytearray()
+        # Count problems, to judge the link's quality.
+        self.bad_checksums = 0
+        self.skipped_bytes = 0
+
+    # Add the given bytes, returning a list of the :class:`Frame` instances they complete.
+    def feed(self, data):
+        self.buffer.extend(data)
+        frames = []
+        while True:
+            # Discard anything before the next sync byte.
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                self.skipped_bytes += len(self.buffer)
+                del self.buffer[:]
+                break
+            if start > 0:
+                self.skipped_bytes += start
+                del self.buffer[:start]
+            if len(self.buffer) < HEADER_SIZE:
+                break
+            version, frame_type, seq, length = self.buffer[1:HEADER_SIZE]
+            if version != VERSION or length > MAX_PAYLOAD:
+                self.skip_sync_byte()
+                continue
+            frame_size = HEADER_SIZE + length + 1
+            if len(self.buffer) < frame_size:
+                break
+            if crc8(self.buffer[1:frame_size - 1]) != self.buffer[frame_size - 1]:
+                self.bad_checksums += 1
+                self.skip_sync_byte()
+                continue
+            frames.append(Frame(frame_type, seq, bytes(self.buffer[HEADER_SIZE:frame_size - 1])))
+            del self.buffer[:frame_size]
+        return frames
+
+    def skip_sync_byte(self):
+        self.skipped_bytes += 1
+        del self.buffer[:1]
+
+
+# Return the (direction, speed) carried by a :data:`DRIVE` frame.
+def decode_drive(frame):
+    return struct.unpack('BB', frame.payload)
+
+
+# Return the (seq, type) of the frame acknowledged by an :data:`ACK` frame.
+def decode_ack(frame):
+    return struct.unpack('BB', frame.payload)
@@ -0,0 +1,114 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# command_scheduler.py
+# ********************
+# The update routine decides how to drive the car on every frame, even though that decision rarely changes from one frame to the next. Sending every decision wastes serial bandwidth and, on the car, time spent reading commands. This module sits between the update routine and the serial port: it writes a command only when it differs from the last one sent, plus a cheap keepalive at a fixed interval so the car's heartbeat shows the controller is still running. It also guarantees the car stops: when the program exits, and when the main loop stalls (stops sending commands) for too long.
+#
+# :class:`Command_Scheduler` provides the same ``write`` / ``isOpen`` / ``close`` interface as a serial port, so it can be used in place of one.
+import atexit
+import threading
+import time
+
+from stage_timers import timers
+
+
+class Command_Scheduler(object):
+    # ser is the serial port (or :class:`Serial_Mock`). keepalive_interval gives the longest time, in seconds, between writes while the command is unchanged; keepalive gives the bytes to send then, or None to resend the current command (which the firmware ignores, apart from toggling its heartbeat). If no command arrives for stall_timeout seconds, stop_command is sent. Set stall_timeout to None to disable this.
+    def __init__(self, ser, keepalive_interval = 0.5, keepalive = None, stall_timeout = 1.0, stop_command = b' '):
+        self.ser = ser
+        self.keepalive_interval = keepalive_interval
+        self.keepalive = keepalive
+        self.stall_timeout = stall_timeout
+        self.stop_command = stop_command
+        # The last command written, and when any bytes were last written.
+        self.last_command = None
+        self.last_write_time = 0.0
+        # When :meth:`write` was last called, to detect a stall.
+        self.last_request_time = time.time()
+        # Statistics
+        self.requests = 0
+        self.writes = 0
+        self.suppressed = 0
+        self.keepalives = 0
+        self.stall_stops = 0
+        # Writes may come from the main loop or the watchdog thread.
+        self._lock = threading.Lock()
+        self._closed = False
+        # Set on close, to wake the watchdog at once.
+        self._close_event = threading.Event()
+        self._watchdog = None
+        if stall_timeout is not None:
+            self._watchdog = threading.Thread(target = self._watch, name = "command_watchdog")
+            self._watchdog.daemon = True
+            self._watchdog.start()
+        # Stop the car even if the program exits without calling :meth:`close`.
+        atexit.register(self.close)
+
+    # Request that the given command be sent. It's written only if it differs from the last command, or if a keepalive is due.
+    def write(self, command):
+        command = _to_bytes(command)
+        now = time.time()
+        with self._lock:
+            self.requests += 1
+            self.last_request_time = now
+            if command != self.last_command:
+                self._write(command, now)
+                self.last_command = command
+            elif now - self.last_write_time >= self.keepalive_interval:
+                self._write(command if self.keepalive is None else _to_bytes(self.keepalive), now)
+                self.keepalives += 1
+            else:
+                self.suppressed += 1
+
+    # Send the stop command, whatever was sent last.
+    def stop(self):
+        with self._lock:
+            if not self._closed and self.ser.isOpen():
+                self._write(self.stop_command, time.time())
+                self.last_command = self.stop_command
+
+    def _write(self, data, now):
+        with timers.stage('serial_write'):
+            self.ser.write(data)
+        self.writes += 1
+        self.last_write_time = now
+
+    # Stop the car if the main loop hasn't sent a command recently.
+    def _watch(self):
+        while not self._close_event.wait(self.stall_timeout / 4.0):
+            with self._lock:
+                stalled = time.time() - self.last_request_time > self.stall_timeout
+                if stalled and self.last_command != self.stop_command and not self._closed and self.ser.isOpen():
+                    self._write(self.stop_command, time.time())
+                    self.last_command = self.stop_command
+                    self.stall_stops += 1
+
+    def isOpen(self):
+        return not self._closed and self.ser.isOpen()
+
+    # Stop the car, then close the serial port and stop the watchdog. Calling this more than once is harmless.
+    def close(self):
+        if self._closed:
+            return
+        self.stop()
+        with self._lock:
+            self._closed = True
+            if self.ser.isOpen():
+                self.ser.close()
+        self._close_event.set()
+        if self._watchdog is not None and self._watchdog is not threading.current_thread():
+            self._watchdog.join()
+        # Once closed, there's nothing left to do at exit; don't keep this scheduler alive until then.
+        atexit.unregister(self.close)
+
+    def report(self):
+        return ("%d commands: %d written, %d suppressed, %d keepalives, %d stall stops" %
+                (self.requests, self.writes, self.suppressed, self.keepalives, self.stall_stops))
+
+
+# The serial port needs bytes; accept strings for convenience.
+def _to_bytes(command):
+    if isinstance(command, bytes):
+        return command
+    return command.encode('ascii')
@@ -0,0 +1,133 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# fake_arduino.py
+# ***************
+# This module provides a stand-in for the car's Arduino, so the serial link can be tested and benchmarked with no hardware. It creates a pseudo-terminal (pty): the program under test opens the pty's device name (for example, ``/dev/pts/3``) exactly as it would open ``/dev/ttyACM0``, while a background thread plays the part of ``Controlled_Motors.ino`` on the other end. The stand-in decodes binary command frames (see :mod:`command_protocol`), tracks the resulting direction and speed, and acknowledges each frame, which lets the sender measure round-trip latency.
+#
+# Run this file to benchmark the link::
+#
+#   python fake_arduino.py --count 2000 --baud 9600
+#
+# This works only on POSIX systems (Linux, including the Pi, or macOS), which provide ptys.
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+
+import numpy
+
+import command_protocol as cp
+
+
+class Fake_Arduino(object):
+    # If ack is True, acknowledge every frame received. path_change_delay gives the time, in seconds, the firmware pauses when the direction changes (``delay(100)`` in ``SetPath``); the default of 0 measures only the link itself.
+    def __init__(self, ack = True, path_change_delay = 0.0):
+        self.ack = ack
+        self.path_change_delay = path_change_delay
+        self.master_fd, self.slave_fd = pty.openpty()
+        # Pass bytes through unchanged: no echo, and no translation of line endings or control characters.
+        tty.setraw(self.slave_fd)
+        # The device name to open in place of the Arduino's serial port.
+        self.port_name = os.ttyname(self.slave_fd)
+        self.decoder = cp.Frame_Decoder()
+        self.encoder = cp.Command_Encoder()
+        # The car's state, as set by the frames received.
+        self.direction = cp.STOP
+        self.speed = 0
+        self.frames_received = 0
+        self.heartbeat = False
+        self._running = True
+        self._thread = threading.Thread(target = self._run, name = "fake_arduino")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            readable, writable, errors = select.select([self.master_fd], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self.master_fd, 4096)
+            except OSError:
+                break
+            for frame in self.decoder.feed(data):
+                self.handle_frame(frame)
+
+    # Act on a frame as the firmware does.
+    def handle_frame(self, frame):
+        self.frames_received += 1
+        # Any data received toggles the heartbeat LED.
+        self.heartbeat = not self.heartbeat
+        if frame.type == cp.DRIVE:
+            direction, self.speed = cp.decode_drive(frame)
+            if direction != self.direction:
+                self.direction = direction
+                if self.path_change_delay:
+                    time.sleep(self.path_change_delay)
+        if self.ack:
+            os.write(self.master_fd, self.encoder.ack(frame))
+
+    def close(self):
+        self._running = False
+        self._thread.join(1.0)
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+
+# Send count drive frames to a :class:`Fake_Arduino` through a serial port opened on its pty, waiting for each acknowledgement. Returns a dict giving the frames per second and the round-trip latency percentiles, in milliseconds. If baud is given, also estimate the time each frame would spend on a real serial link at that rate, assuming 10 bits (start, 8 data, stop) per byte.
+def benchmark(count = 1000, baud = None):
+    import serial
+    arduino = Fake_Arduino()
+    port = serial.Serial(arduino.port_name, baudrate = baud or 115200, timeout = 1.0)
+    encoder = cp.Command_Encoder()
+    decoder = cp.Frame_Decoder()
+    latencies = []
+    start_time = time.perf_counter()
+    for index in range(count):
+        frame = encoder.drive(index % 2 + cp.FORWARD, 100 + index % 100)
+        sent = time.perf_counter()
+        port.write(frame)
+        acks = []
+        while not acks:
+            data = port.read(max(1, port.in_waiting))
+            if not data:
+                raise IOError("No acknowledgement received for frame %d." % index)
+            acks = decoder.feed(data)
+        latencies.append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - start_time
+    port.close()
+    arduino.close()
+    p50, p95, p99 = numpy.percentile(latencies, (50, 95, 99))*1000.0
+    results = {
+        'frames': count,
+        'frames_per_s': count / elapsed,
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'frames_received': arduino.frames_received,
+        'bad_checksums': arduino.decoder.bad_checksums,
+    }
+    if baud:
+        results['wire_ms_per_frame'] = len(frame)*10*1000.0 / baud
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the binary command protocol against a pty stand-in for the Arduino.')
+    parser.add_argument('--count', type = int, default = 1000, help = 'Number of frames to send.')
+    parser.add_argument('--baud', type = int, help = 'Estimate time on a real link at this baud rate.')
+    args = parser.parse_args()
+    results = benchmark(args.count, args.baud)
+    print("%(frames)d frames, %(frames_per_s).0f frames/s, round trip p50 %(p50_ms).3f ms, "
+          "p95 %(p95_ms).3f ms, p99 %(p99_ms).3f ms; %(frames_received)d received, "
+          "%(bad_checksums)d bad checksums" % results)
+    if 'wire_ms_per_frame' in results:
+        print("At %d baud, each %d-byte drive frame takes %.2f ms on the wire." %
+              (args.baud, cp.HEADER_SIZE + 3, results['wire_ms_per_frame']))
+
+if __name__ == "__main__":
+    main()
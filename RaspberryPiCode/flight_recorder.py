@@ -0,0 +1,400 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# flight_recorder.py
+# ******************
+# When the car misbehaves, there's no record of what :class:`Webcam_Find_Car` saw or decided, so the problem can't be reproduced, and there's no way to collect frames to test :func:`find_car` against. This module records each pass through the main loop (a tick): the frame grabbed, what was found in it (a :class:`Detection`), and the bytes sent to the car over the serial port since the last tick.
+#
+# Recording must never slow the main loop, so :meth:`Flight_Recorder.record` only puts a reference to the frame (each frame is a new image, which nothing changes afterwards) and its results on a bounded queue, then returns. A background thread encodes and writes them. If the writer falls behind and the queue fills, ticks are dropped and counted, rather than waiting; serial bytes are never dropped, but are kept for the next tick recorded.
+#
+# File format
+# ===========
+# A log is two files: the records themselves, in an append-only file (named, for example, ``run.flog``), and an index with an entry for each tick (``run.flog.idx``). The log starts with :data:`MAGIC`, followed by records, each a :data:`_RECORD` header (the kind of record, its encoding and the length of its payload) then the payload:
+#
+# ``KIND_TICK``
+#   Starts each tick: its time (from ``time.time``) and the number of the frame in the main loop, which shows the gaps left by dropped ticks.
+# ``KIND_FRAME``
+#   The frame, if this tick's frame was kept; either raw pixels, after a :data:`_RAW_FRAME` header giving its shape, or a JPEG image.
+# ``KIND_DETECTION``
+#   The :class:`Detection`, as seven floats; NaN stands for None.
+# ``KIND_COMMAND``
+#   One write to the serial port: the time it was sent, then the bytes sent.
+#
+# Each index entry (see :data:`_INDEX_ENTRY`) is the same size, and gives the offset in the log of a tick's first record, the offset of its frame record (zero if none), and its time. Finding any tick is therefore a matter of reading entry n at n times the entry size, then jumping to the offsets it gives. :class:`Flight_Log` memory-maps both files, so this costs no reads at all, and raw frames are returned as views of the log, without copying.
+#
+# Index entries are written after their tick's records, and the log is flushed before the index, so a log cut short by a crash is still readable up to its last indexed tick. A lost or damaged index can be rebuilt from the log with :func:`rebuild_index`.
+#
+# To summarize a log, or export its frames and detections as a test set, run::
+#
+#   python flight_recorder.py run.flog --export run_frames
+from collections import namedtuple
+import argparse
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import cv2
+import numpy
+
+MAGIC = b'CARLOG01'
+# The extension of a log file; its index is named by adding :data:`INDEX_EXTENSION`.
+LOG_EXTENSION = '.flog'
+INDEX_EXTENSION = '.idx'
+
+KIND_TICK = 1
+KIND_FRAME = 2
+KIND_DETECTION = 3
+KIND_COMMAND = 4
+
+ENCODING_RAW = 0
+ENCODING_JPEG = 1
+
+# kind, encoding, payload length.
+_RECORD = struct.Struct('<BBxxI')
+# time, frame number.
+_TICK = struct.Struct('<dI')
+# rows, columns, channels.
+_RAW_FRAME = struct.Struct('<HHB')
+# car x, y, car radius, heading, line distance, desired x, y.
+_DETECTION = struct.Struct('<7f')
+# The time the bytes which follow were sent.
+_COMMAND_TIME = struct.Struct('<d')
+# offset of the tick's first record, offset of its frame record (or zero), time.
+_INDEX_ENTRY = struct.Struct('<QQd')
+_INDEX_DTYPE = numpy.dtype([('offset', '<u8'), ('frame_offset', '<u8'), ('time', '<f8')])
+
+# What was found in a frame, in the coordinates of the half-size frame processed. car_xy gives the car's location, or (-1, -1) if it wasn't found, and car_radius the radius of a circle of the same area. heading gives the car's estimated orientation in radians (see :meth:`Estimate_Car_Orientation.estimate_car_orientation`), and line_dist its distance to the nearest line; either is None when unknown. desired_xy gives the car's destination, or negative values for none.
+Detection = namedtuple('Detection', 'car_xy car_radius heading line_dist desired_xy')
+
+# A tick read from a log. frame is None if the frame wasn't kept, and detection is None if none was recorded. commands is a list of ``(time, bytes)`` sent to the car.
+Tick = namedtuple('Tick', 'index time number frame detection commands')
+
+
+class Flight_Recorder(object):
+    # Record to the log file path (and its index, path plus :data:`INDEX_EXTENSION`), replacing any existing log. Keep the frame of one tick in frame_every; the others record only their detections and commands. Store frames raw, or as JPEG images of the given jpeg_quality (0 to 100), which are a tenth the size but lossy. At most queue_size ticks wait for the writer before ticks are dropped. Written data is flushed to disk every flush_interval seconds.
+    def __init__(self, path, frame_every = 1, jpeg_quality = None, queue_size = 32, flush_interval = 1.0):
+        self.path = path
+        self.frame_every = frame_every
+        self.jpeg_quality = jpeg_quality
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.log_file = open(path, 'wb')
+        self.index_file = open(path + INDEX_EXTENSION, 'wb')
+        self.log_file.write(MAGIC)
+        self.offset = len(MAGIC)
+        # Commands sent since the last tick was queued. They may come from the main loop or from the :class:`Command_Scheduler`'s watchdog thread.
+        self._pending_commands = []
+        self._lock = threading.Lock()
+        self._closed = False
+        # Statistics
+        self.submitted = 0
+        self.dropped = 0
+        self.ticks = 0
+        self.frames = 0
+        self.commands = 0
+        self.write_ms = 0.0
+        self._thread = threading.Thread(target = self._write_loop, name = "flight_recorder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Record a tick: frame is the frame grabbed, detection a :class:`Detection` (or None), and timestamp the time (from ``time.time``) the frame was grabbed. This never waits; if the writer is behind, the tick is dropped.
+    def record(self, frame, detection, timestamp = None):
+        number = self.submitted
+        self.submitted += 1
+        if number % self.frame_every:
+            frame = None
+        with self._lock:
+            commands = self._pending_commands
+            self._pending_commands = []
+        try:
+            self.queue.put_nowait((number, time.time() if timestamp is None else timestamp, frame, detection, commands))
+        except queue.Full:
+            self.dropped += 1
+            # Keep the commands for the next tick.
+            with self._lock:
+                self._pending_commands[0:0] = commands
+
+    # Record the bytes in data as sent to the car now.
+    def record_command(self, data):
+        with self._lock:
+            self._pending_commands.append((time.time(), bytes(data)))
+
+    def _write_loop(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout = self.flush_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                start = time.monotonic()
+                self.write_tick(*item)
+                self.write_ms += (time.monotonic() - start)*1000.0
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+
+    # Append a tick's records to the log, then its entry to the index.
+    def write_tick(self, number, timestamp, frame, detection, commands):
+        tick_offset = self.offset
+        self.write_record(KIND_TICK, ENCODING_RAW, _TICK.pack(timestamp, number))
+        frame_offset = 0
+        if frame is not None:
+            if self.jpeg_quality is None:
+                frame_offset = self.offset
+                channels = frame.shape[2] if frame.ndim == 3 else 1
+                self.write_record(KIND_FRAME, ENCODING_RAW, _RAW_FRAME.pack(frame.shape[0], frame.shape[1], channels), numpy.ascontiguousarray(frame))
+            else:
+                success_flag, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                if success_flag:
+                    frame_offset = self.offset
+                    self.write_record(KIND_FRAME, ENCODING_JPEG, jpeg)
+            if frame_offset:
+                self.frames += 1
+        if detection is not None:
+            self.write_record(KIND_DETECTION, ENCODING_RAW, pack_detection(detection))
+        for sent, data in commands:
+            self.write_record(KIND_COMMAND, ENCODING_RAW, _COMMAND_TIME.pack(sent), data)
+        self.commands += len(commands)
+        self.index_file.write(_INDEX_ENTRY.pack(tick_offset, frame_offset, timestamp))
+        self.ticks += 1
+
+    # Append a record of the given kind and encoding, whose payload is the concatenation of parts (each anything supporting the buffer protocol).
+    def write_record(self, kind, encoding, *parts):
+        length = sum(memoryview(part).nbytes for part in parts)
+        self.log_file.write(_RECORD.pack(kind, encoding, length))
+        for part in parts:
+            self.log_file.write(part)
+        self.offset += _RECORD.size + length
+
+    # Flush the log before the index, so that the index never refers to records not yet on disk.
+    def flush(self):
+        self.log_file.flush()
+        self.index_file.flush()
+
+    # Write the ticks still queued, plus a last tick holding any commands sent since the last one (such as the stop command sent on exit), then close the files. Calling this more than once is harmless.
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        with self._lock:
+            commands = self._pending_commands
+            self._pending_commands = []
+        if commands:
+            self.queue.put((self.submitted, time.time(), None, None, commands))
+            self.submitted += 1
+        self.queue.put(None)
+        self._thread.join()
+        self.flush()
+        self.log_file.close()
+        self.index_file.close()
+
+    def report(self):
+        return "Recorder: %d of %d ticks recorded (%d dropped), %d frames, %d commands, %.1f MB, mean %.2f ms per tick written" % (
+            self.ticks, self.submitted, self.dropped, self.frames, self.commands, self.offset/1e6, self.write_ms/self.ticks if self.ticks else 0.0)
+
+
+# A serial port (or :class:`Serial_Mock`) which also records each write to a :class:`Flight_Recorder`. Put this under the :class:`Command_Scheduler`, so that only the bytes which actually reach the car are recorded.
+class Recording_Serial(object):
+    def __init__(self, ser, recorder):
+        self.ser = ser
+        self.recorder = recorder
+
+    def write(self, data):
+        self.ser.write(data)
+        self.recorder.record_command(data)
+
+    def isOpen(self):
+        return self.ser.isOpen()
+
+    def close(self):
+        self.ser.close()
+
+
+# Read a log written by a :class:`Flight_Recorder`. ``len(log)`` gives the number of ticks, and ``log[n]`` returns tick n as a :class:`Tick`; both files are memory-mapped, so this takes the same time for any n.
+class Flight_Log(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a flight log' % path)
+            self.log = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        index_path = path + INDEX_EXTENSION
+        if not os.path.exists(index_path):
+            rebuild_index(path)
+        self.index_map = None
+        self.index = numpy.zeros(0, _INDEX_DTYPE)
+        if os.path.getsize(index_path) >= _INDEX_ENTRY.size:
+            with open(index_path, 'rb') as f:
+                self.index_map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            # Ignore a partly written last entry, and entries past the end of the log, left by a crash. An entry may start within the log but have its frame past the end; the entries are in order, so drop it and any after it.
+            count = len(self.index_map) // _INDEX_ENTRY.size
+            self.index = numpy.frombuffer(self.index_map, _INDEX_DTYPE, count)
+            self.index = self.index[:numpy.searchsorted(self.index['offset'], len(self.log))]
+            past_end = numpy.flatnonzero(self.index['frame_offset'] + _RECORD.size > len(self.log))
+            if len(past_end):
+                self.index = self.index[:past_end[0]]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError('tick %d is not in the log' % n)
+        end = int(self.index['offset'][n + 1]) if n + 1 < len(self) else len(self.log)
+        frame = detection = None
+        commands = []
+        timestamp = number = None
+        for kind, encoding, start, length in self.records(int(self.index['offset'][n]), end):
+            if kind == KIND_TICK:
+                if timestamp is not None:
+                    break
+                timestamp, number = _TICK.unpack_from(self.log, start)
+            elif kind == KIND_FRAME:
+                frame = self.decode_frame(encoding, start, length)
+            elif kind == KIND_DETECTION:
+                detection = unpack_detection(self.log, start)
+            elif kind == KIND_COMMAND:
+                sent, = _COMMAND_TIME.unpack_from(self.log, start)
+                commands.append((sent, self.log[start + _COMMAND_TIME.size:start + length]))
+        return Tick(n, timestamp, number, frame, detection, commands)
+
+    # Return the frame of tick n, or None if it wasn't kept. A raw frame is a read-only view of the log; copy it to change it.
+    def frame(self, n):
+        frame_offset = int(self.index['frame_offset'][n])
+        if not frame_offset:
+            return None
+        # A crash may have cut the frame short, even within its header.
+        if frame_offset + _RECORD.size > len(self.log):
+            return None
+        kind, encoding, length = _RECORD.unpack_from(self.log, frame_offset)
+        if frame_offset + _RECORD.size + length > len(self.log):
+            return None
+        return self.decode_frame(encoding, frame_offset + _RECORD.size, length)
+
+    # Return the ticks whose frames were kept.
+    def frame_ticks(self):
+        return numpy.flatnonzero(self.index['frame_offset'])
+
+    def decode_frame(self, encoding, start, length):
+        if encoding == ENCODING_JPEG:
+            return cv2.imdecode(numpy.frombuffer(self.log, numpy.uint8, length, start), cv2.IMREAD_UNCHANGED)
+        rows, cols, channels = _RAW_FRAME.unpack_from(self.log, start)
+        frame = numpy.frombuffer(self.log, numpy.uint8, rows*cols*channels, start + _RAW_FRAME.size)
+        return frame.reshape((rows, cols, channels) if channels > 1 else (rows, cols))
+
+    # Yield ``(kind, encoding, payload offset, payload length)`` for each complete record from offset up to end (by default, the end of the log).
+    def records(self, offset = len(MAGIC), end = None):
+        end = len(self.log) if end is None else end
+        while offset + _RECORD.size <= end:
+            kind, encoding, length = _RECORD.unpack_from(self.log, offset)
+            start = offset + _RECORD.size
+            if start + length > end:
+                break
+            yield kind, encoding, start, length
+            offset = start + length
+
+    # Unmap the files. Raw frames from :meth:`frame` keep the log mapped until they're freed.
+    def close(self):
+        self.index = numpy.zeros(0, _INDEX_DTYPE)
+        for mapped in (self.log, self.index_map):
+            try:
+                if mapped is not None:
+                    mapped.close()
+            except BufferError:
+                pass
+
+
+def pack_detection(detection):
+    (car_x, car_y), (desired_x, desired_y) = detection.car_xy, detection.desired_xy
+    return _DETECTION.pack(car_x, car_y, detection.car_radius, _nan_if_none(detection.heading), _nan_if_none(detection.line_dist), desired_x, desired_y)
+
+def unpack_detection(buffer, offset = 0):
+    car_x, car_y, car_radius, heading, line_dist, desired_x, desired_y = _DETECTION.unpack_from(buffer, offset)
+    return Detection((car_x, car_y), car_radius, _none_if_nan(heading), _none_if_nan(line_dist), (desired_x, desired_y))
+
+def _nan_if_none(value):
+    return float('nan') if value is None else value
+
+def _none_if_nan(value):
+    return None if value != value else value
+
+
+# Rebuild the index of the log at path by scanning its records; use this if the index was lost. Returns the number of ticks found.
+def rebuild_index(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a flight log' % path)
+        log = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    entries = []
+    offset = len(MAGIC)
+    while offset + _RECORD.size <= len(log):
+        kind, encoding, length = _RECORD.unpack_from(log, offset)
+        if offset + _RECORD.size + length > len(log):
+            break
+        if kind == KIND_TICK:
+            timestamp, number = _TICK.unpack_from(log, offset + _RECORD.size)
+            entries.append([offset, 0, timestamp])
+        elif kind == KIND_FRAME and entries:
+            entries[-1][1] = offset
+        offset += _RECORD.size + length
+    log.close()
+    with open(path + INDEX_EXTENSION, 'wb') as f:
+        for entry in entries:
+            f.write(_INDEX_ENTRY.pack(*entry))
+    return len(entries)
+
+
+# Write the frames of log to directory as PNG images, which an :class:`Image_Directory_Source` can replay, along with ``detections.csv``, giving each tick's :class:`Detection`.
+def export(log, directory):
+    os.makedirs(directory, exist_ok = True)
+    with open(os.path.join(directory, 'detections.csv'), 'w') as f:
+        f.write('tick,time,frame,car_x,car_y,car_radius,heading,line_dist,desired_x,desired_y\n')
+        for n in range(len(log)):
+            tick = log[n]
+            filename = ''
+            if tick.frame is not None:
+                filename = 'frame_%06d.png' % n
+                cv2.imwrite(os.path.join(directory, filename), tick.frame)
+            if tick.detection is not None:
+                d = tick.detection
+                f.write('%d,%.6f,%s,%g,%g,%g,%s,%s,%g,%g\n' % (n, tick.time, filename, d.car_xy[0], d.car_xy[1], d.car_radius,
+                                                             '' if d.heading is None else '%g' % d.heading,
+                                                             '' if d.line_dist is None else '%g' % d.line_dist, d.desired_xy[0], d.desired_xy[1]))
+
+
+# Summarize a log; args is a list of command line arguments, by default from sys.argv.
+def main(args = None):
+    parser = argparse.ArgumentParser(description = 'Summarize or export a flight log.')
+    parser.add_argument('log', help = 'The log file.')
+    parser.add_argument('--rebuild-index', action = 'store_true', help = 'Rebuild the index from the log first.')
+    parser.add_argument('--export', help = 'Write the frames and detections to this directory.')
+    args = parser.parse_args(args)
+
+    if args.rebuild_index:
+        print("Indexed %d ticks." % rebuild_index(args.log))
+    log = Flight_Log(args.log)
+    if not len(log):
+        print("No ticks recorded.")
+        return
+    times = log.index['time']
+    found = commands = 0
+    for n in range(len(log)):
+        tick = log[n]
+        found += tick.detection is not None and tick.detection.car_xy[0] >= 0
+        commands += len(tick.commands)
+    print("%d ticks over %.1f s, %d with frames; car found in %d; %d commands." % (len(log), times[-1] - times[0], len(log.frame_ticks()), found, commands))
+    if args.export:
+        export(log, args.export)
+        print("Exported to %s." % args.export)
+    log.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# frame_capture.py
+# ****************
+# This module moves webcam capture off the processing thread. Reading from ``cv2.VideoCapture`` blocks until the camera delivers a frame, and any frame not read promptly waits in the driver's (V4L2) buffer. When processing is slower than the camera, the processing loop therefore works on frames which are several frames old. Instead, a background thread reads frames as fast as the camera supplies them and keeps only the newest one in a :class:`Latest_Frame_Slot`; older, unread frames are simply overwritten and counted as dropped.
+#
+# A recording, unlike a camera, can be read far faster than it's processed, so the thread would read through it, dropping nearly every frame. For a source which says it's ``finite`` (see :mod:`frame_sources`), the thread instead waits for each frame to be taken before reading the next.
+import threading
+import time
+
+
+# A single-frame mailbox. The producer overwrites the held frame; the consumer always takes the freshest frame available.
+class Latest_Frame_Slot(object):
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._frame = None
+        # A sequence number for each frame put in the slot, used to detect when a new frame is available.
+        self._seq = 0
+        self._taken_seq = 0
+        # Frames which were overwritten before the consumer took them.
+        self.dropped_frames = 0
+        self._closed = False
+
+    # Store a new frame, replacing (and counting as dropped) any frame not yet taken.
+    def put(self, frame):
+        with self._cond:
+            if self._seq > self._taken_seq:
+                self.dropped_frames += 1
+            self._frame = frame
+            self._seq += 1
+            self._cond.notify_all()
+
+    # Wait for a frame newer than the last one taken, then return ``(seq, frame)``. Returns ``(None, None)`` if the slot was closed or the timeout (in seconds) expired.
+    def take(self, timeout = None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > self._taken_seq or self._closed, timeout):
+                return None, None
+            if self._seq == self._taken_seq:
+                return None, None
+            self._taken_seq = self._seq
+            # Wake a producer waiting in :meth:`wait_taken`.
+            self._cond.notify_all()
+            return self._seq, self._frame
+
+    # Wait until the consumer has taken the frame held, or the slot is closed.
+    def wait_taken(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._taken_seq == self._seq or self._closed)
+
+    # Wake any waiting consumer; no more frames will arrive.
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+# Read frames from a ``cv2.VideoCapture``-like object on a background thread. This class provides the same ``read`` / ``isOpened`` / ``release`` interface as ``cv2.VideoCapture``, so it can be dropped in wherever a capture is used. If drop_frames is False, each frame is read only once the last was taken, so none are dropped; by default, this is done for sources whose ``finite`` attribute is True.
+class Threaded_Capture(object):
+    def __init__(self, cap, timeout = 2.0, drop_frames = None, first_frame_timeout = 10.0):
+        self.cap = cap
+        self.drop_frames = not getattr(cap, 'finite', False) if drop_frames is None else drop_frames
+        # How long (in seconds) :meth:`read` waits for a new frame before reporting failure. A USB camera may take several seconds to deliver its first frame while it warms up, so the first read waits up to first_frame_timeout instead. Either way, read fails at once if the capture thread stops.
+        self.timeout = timeout
+        self.first_frame_timeout = first_frame_timeout
+        self.slot = Latest_Frame_Slot()
+        # The time (from ``time.time``) the frame last returned by :meth:`read` was captured.
+        self.frame_time = None
+        # Frames read from the camera, including dropped frames.
+        self.captured_frames = 0
+        self._running = True
+        self._thread = threading.Thread(target = self._capture_loop, name = "capture")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _capture_loop(self):
+        while self._running:
+            success_flag, image = self.cap.read()
+            if not success_flag:
+                break
+            self.captured_frames += 1
+            # Note the capture time, rather than the time the frame is taken from the slot; a recording may supply its own.
+            captured = getattr(self.cap, 'frame_time', None)
+            self.slot.put((image, time.time() if captured is None else captured))
+            if not self.drop_frames:
+                self.slot.wait_taken()
+        # The camera failed or we were asked to stop; let the consumer know.
+        self.slot.close()
+
+    # Return the freshest frame, as ``(success_flag, image)``, waiting for one newer than the last frame read.
+    def read(self):
+        seq, frame = self.slot.take(self.first_frame_timeout if self.frame_time is None else self.timeout)
+        if seq is None:
+            return False, None
+        image, self.frame_time = frame
+        return True, image
+
+    @property
+    def dropped_frames(self):
+        return self.slot.dropped_frames
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def release(self):
+        self._running = False
+        self.slot.close()
+        self._thread.join(self.timeout)
+        self.cap.release()
+
+
+# Track how many frames the processing loop handled and how many the capture thread dropped, then summarize these as a single line.
+class Capture_Stats(object):
+    def __init__(self):
+        self.start_time = time.time()
+        self.processed_frames = 0
+
+    def report(self, capture):
+        elapsed = time.time() - self.start_time
+        dropped = getattr(capture, "dropped_frames", 0)
+        fps = self.processed_frames / elapsed if elapsed > 0 else 0.0
+        return "Processed %d frames (%.1f fps), dropped %d" % (self.processed_frames, fps, dropped)
@@ -0,0 +1,156 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# frame_sources.py
+# ****************
+# This module supplies frames to :class:`Webcam_Find_Car` from places other than a live webcam: a video file, a directory of images, a log written by a :class:`Flight_Recorder`, or frames already in memory. This makes it possible to run the same recording through the image-processing code repeatedly, to test it or to measure how long it takes. Each source provides the same ``read`` / ``isOpened`` / ``release`` interface as ``cv2.VideoCapture``, so any of them can be used wherever a capture is used. ``read`` returns ``(False, None)`` when a source runs out of frames. Sources other than a webcam are ``finite``: they supply frames as fast as they're read, rather than at a camera's pace, so a :class:`Threaded_Capture` mustn't drop their frames.
+import os
+
+import cv2
+
+
+# A live webcam.
+class Camera_Source(object):
+    finite = False
+
+    def __init__(self, webcam_index = 0):
+        self.cap = cv2.VideoCapture(webcam_index)
+
+    def read(self):
+        return self.cap.read()
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def release(self):
+        self.cap.release()
+
+
+# A recorded video file. If loop is True, start over from the beginning after the last frame.
+class Video_File_Source(object):
+    finite = True
+
+    def __init__(self, filename, loop = False):
+        self.filename = filename
+        self.loop = loop
+        self.cap = cv2.VideoCapture(filename)
+
+    def read(self):
+        success_flag, image = self.cap.read()
+        if not success_flag and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success_flag, image = self.cap.read()
+        return success_flag, image
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def release(self):
+        self.cap.release()
+
+
+# A directory of still images, read in sorted filename order.
+class Image_Directory_Source(object):
+    finite = True
+    extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+    def __init__(self, directory, loop = False):
+        self.filenames = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                                if os.path.splitext(name)[1].lower() in self.extensions)
+        self.loop = loop
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.filenames):
+            if not self.loop or not self.filenames:
+                return False, None
+            self.index = 0
+        image = cv2.imread(self.filenames[self.index])
+        self.index += 1
+        return image is not None, image
+
+    def isOpened(self):
+        return len(self.filenames) > 0
+
+    def release(self):
+        pass
+
+
+# The frames kept in a log written by a :class:`Flight_Recorder`, in the order recorded. Ticks whose frames weren't kept are skipped. After each :meth:`read`, frame_time gives the time the frame was recorded, so that replaying a log reproduces the timing the tracker saw.
+class Flight_Log_Source(object):
+    finite = True
+
+    def __init__(self, path, loop = False):
+        from flight_recorder import Flight_Log
+        self.log = Flight_Log(path)
+        self.ticks = self.log.frame_ticks()
+        self.loop = loop
+        self.index = 0
+        self.frame_time = None
+
+    def read(self):
+        if self.index >= len(self.ticks):
+            if not self.loop or not len(self.ticks):
+                return False, None
+            self.index = 0
+        image = self.log.frame(self.ticks[self.index])
+        self.frame_time = float(self.log.index['time'][self.ticks[self.index]])
+        self.index += 1
+        # Raw frames are read-only views of the log; the processing code needs an image of its own.
+        return True, image if image.flags.writeable else image.copy()
+
+    def isOpened(self):
+        return len(self.ticks) > 0
+
+    def release(self):
+        self.log.close()
+
+
+# Frames held in memory, such as a list of images or a single N x H x W x 3 array. Since the processing code may draw on the image it's given, each frame is copied unless copy is False.
+class Array_Source(object):
+    finite = True
+
+    def __init__(self, frames, loop = False, copy = True):
+        self.frames = frames
+        self.loop = loop
+        self.copy = copy
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.frames):
+            if not self.loop or len(self.frames) == 0:
+                return False, None
+            self.index = 0
+        image = self.frames[self.index]
+        self.index += 1
+        return True, image.copy() if self.copy else image
+
+    def isOpened(self):
+        return len(self.frames) > 0
+
+    def release(self):
+        pass
+
+
+# Read every frame from a source into memory, returning a list of frames. This removes decoding time from benchmarks. Read at most max_frames frames, if given.
+def read_all_frames(source, max_frames = None):
+    frames = []
+    while max_frames is None or len(frames) < max_frames:
+        success_flag, image = source.read()
+        if not success_flag:
+            break
+        frames.append(image)
+    source.release()
+    return frames
+
+
+# Pick a source based on a string: a webcam index (such as ``0``), a directory of images, a flight log (a file ending in :data:`LOG_EXTENSION`), or a video file. The :mod:`flight_recorder` is imported here, rather than when this module is, so that only programs which open a source by name load it.
+def open_frame_source(name, loop = False):
+    if isinstance(name, int) or name.isdigit():
+        return Camera_Source(int(name))
+    if os.path.isdir(name):
+        return Image_Directory_Source(name, loop)
+    from flight_recorder import LOG_EXTENSION
+    if name.endswith(LOG_EXTENSION):
+        return Flight_Log_Source(name, loop)
+    return Video_File_Source(name, loop)
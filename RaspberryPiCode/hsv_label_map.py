@@ -0,0 +1,102 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# hsv_label_map.py
+# ****************
+# This module segments an HSV image into several named colors in a single pass. Calling ``cv2.inRange`` once per color reads the whole frame once per color. Instead, for each of the H, S and V channels we precompute a 256-entry table giving a bitmask of the color ranges which contain that channel value. A pixel lies inside a range exactly when the range's bit is set in all three tables, so ANDing the three looked-up bitmasks classifies the pixel against every range at once. The cost of this is almost independent of the number of colors, up to 32 ranges.
+#
+# A final table lookup turns the bitmask into a label: 0 for no color, or 1, 2, ... for the first color (in the order given) whose range contains the pixel.
+import cv2
+import numpy
+
+# The colors of the objects in the arena, tuned by thresholding camera frames in ``will_cv2_testing.py``. The red ball and the red paint sit at opposite ends of the hue axis, so red has two ranges.
+ARENA_COLORS = [
+    ('blue', [((105, 190, 0), (120, 255, 180))]),
+    ('green', [((50, 95, 60), (85, 255, 180))]),
+    ('yellow', [((10, 85, 0), (45, 255, 180))]),
+    ('red', [((0, 130, 0), (10, 255, 180)), ((130, 160, 0), (180, 255, 255))]),
+]
+
+
+class Hsv_Label_Map(object):
+    # colors is a sequence of ``(name, ranges)`` pairs, where ranges is a list of ``((low_h, low_s, low_v), (high_h, high_s, high_v))`` bounds, inclusive like ``cv2.inRange``. A name may have several ranges; for example, red sits at both ends of the hue axis. Alternatively, a range whose low hue exceeds its high hue wraps around, so ``((170, 100, 0), (10, 255, 255))`` selects hues from 170 through 179 then 0 through 10.
+    def __init__(self, colors):
+        self.names = [name for name, ranges in colors]
+        self.num_ranges = sum(len(ranges) for name, ranges in colors)
+        if self.num_ranges > 32:
+            raise ValueError("At most 32 color ranges are supported; %d given." % self.num_ranges)
+        # One bitmask table per channel, plus the bits belonging to each name. Build these as 64-bit tables, then narrow them below.
+        channel_tables = numpy.zeros((3, 256), dtype = numpy.int64)
+        self.name_bits = {}
+        # The label for each range bit.
+        range_labels = []
+        values = numpy.arange(256)
+        for label, (name, ranges) in enumerate(colors, 1):
+            self.name_bits[name] = 0
+            for low, high in ranges:
+                bit = 1 << len(range_labels)
+                for channel in range(3):
+                    if low[channel] <= high[channel]:
+                        selected = (values >= low[channel]) & (values <= high[channel])
+                    # Only hue wraps around; a backwards S or V range selects nothing, like ``cv2.inRange``.
+                    elif channel == 0:
+                        selected = (values >= low[channel]) | (values <= high[channel])
+                    else:
+                        selected = numpy.zeros(256, dtype = bool)
+                    channel_tables[channel, selected] |= bit
+                self.name_bits[name] |= bit
+                range_labels.append(label)
+
+        # Use the narrowest type which holds every range's bit, since smaller intermediate images are faster. With 8 or fewer ranges, every step runs on 8-bit images.
+        if self.num_ranges <= 8:
+            self.dtype = numpy.uint8
+        elif self.num_ranges <= 16:
+            self.dtype = numpy.uint16
+        else:
+            self.dtype = numpy.int32
+        self.channel_tables = [numpy.ascontiguousarray(table.astype(self.dtype)) for table in channel_tables]
+        # Map the lowest set bit of a mask to its label. Masks with more than 16 ranges are handled in two 16-bit halves.
+        table_size = 1 << min(max(self.num_ranges, 8), 16)
+        self.low_labels = numpy.zeros(table_size, dtype = numpy.uint8)
+        self.high_labels = numpy.zeros(table_size, dtype = numpy.uint8)
+        masks = numpy.arange(table_size)
+        # Assign from the highest bit down, so the lowest set bit (the first color given) wins.
+        for bit in reversed(range(self.num_ranges)):
+            if bit < 16:
+                self.low_labels[masks & (1 << bit) != 0] = range_labels[bit]
+            else:
+                self.high_labels[masks & (1 << (bit - 16)) != 0] = range_labels[bit]
+        # The bitmask image from the last call to :meth:`segment`, used for per-color masks.
+        self.bits_image = None
+
+    # Classify each pixel of the given HSV image, returning a uint8 label image. The label of a name is its position (starting at 1) in :attr:`names`.
+    def segment(self, hsv_image):
+        h, s, v = cv2.split(hsv_image)
+        # Look up each channel's bitmask, then AND them, reusing the first lookup's image for the result.
+        bits = cv2.LUT(h, self.channel_tables[0])
+        cv2.bitwise_and(bits, cv2.LUT(s, self.channel_tables[1]), dst = bits)
+        cv2.bitwise_and(bits, cv2.LUT(v, self.channel_tables[2]), dst = bits)
+        self.bits_image = bits
+        if self.num_ranges <= 8:
+            return cv2.LUT(bits, self.low_labels)
+        if self.num_ranges <= 16:
+            return numpy.take(self.low_labels, bits)
+        labels = numpy.take(self.low_labels, bits & 0xFFFF)
+        # Only pixels with no match in the low 16 ranges need the high half.
+        no_low = labels == 0
+        labels[no_low] = self.high_labels[(bits[no_low] >> 16) & 0xFFFF]
+        return labels
+
+    # Return the label number for the given color name.
+    def label(self, name):
+        return self.names.index(name) + 1
+
+    # Return a ``cv2.inRange``-style mask (255 inside, 0 outside) of every pixel in any of the given name's ranges, from the last :meth:`segment`. Unlike the label image, colors which overlap are not resolved in favor of the first name, so this matches ``cv2.inRange`` exactly.
+    def mask(self, name):
+        selected = numpy.bitwise_and(self.bits_image, numpy.int64(self.name_bits[name]).astype(self.dtype))
+        return numpy.where(selected, numpy.uint8(255), numpy.uint8(0))
+
+    # Count the pixels with each label, returning a dict from name to count.
+    def counts(self, labels):
+        bins = numpy.bincount(labels.ravel(), minlength = len(self.names) + 1)
+        return dict(zip(self.names, bins[1:]))
@@ -21,25 +21,77 @@
 import cv2
 # OpenCV_ relies heavily on `NumPy <numpy.scipy.org>`_ to manipulate arrays containing image data.
 import numpy
-# To communicate with the car, we simply send characters over the serial port using `PySerial <pyserial.sourceforge.net>`_.
-import serial
-# pickle lets the threshold and color persist across runs of this program.
-import pickle as pickle
-from math import sqrt, pi, sin, cos, atan2, copysign
-from numpy import polyfit
+# To communicate with the car, we simply send characters over the serial port using `PySerial <pyserial.sourceforge.net>`_. Since this is needed only with a real car, and pickle (which lets the threshold and color persist across runs of this program) only by the main loop, both are imported when first used; importing this module for its image-processing functions then loads neither.
+#
+# In headless mode, settings can instead come from a JSON config file.
+import json
+import time
+from math import sqrt, pi, sin, cos, atan2
+# Optionally, grab frames on a separate thread so processing always sees the newest frame.
+from frame_capture import Threaded_Capture, Capture_Stats
+# Frames may come from a webcam, a recording, or memory.
+from frame_sources import Camera_Source
+# Time each stage of the pipeline; this replaces running the whole program under cProfile.
+from stage_timers import timers
+# Find the distance from the car to the nearest line without computing a full distance map.
+from line_distance import Line_Distance_Query
+# Send commands to the car only when they change.
+from command_scheduler import Command_Scheduler
+# Find the car as the largest blob of its color, using connected components rather than contours.
+from blob_engine import open_and_find_blobs
+#
+# Like pyserial, the modules of the optional features are imported only when the feature is chosen, in :class:`Webcam_Find_Car` (or, for the update class, when first used), so importing this module loads none of them:
+#
+# - color_lut classifies colors using a precomputed lookup table rather than computing Lab distances for every pixel;
+# - car_tracker fuses the car's locations over time to predict where it will be when a command takes effect;
+# - resolution_controller picks the scale to process each frame at to keep up with the camera;
+# - calibration_store loads the settings and their lookup tables from a directory of named calibration profiles;
+# - line_cache reuses the lines found until the scene changes;
+# - stage_scheduler runs the slower, nearly static stages (finding lines, drawing) at lower rates than finding the car;
+# - path_planner steers along a path planned around the lines;
+# - render_thread and mjpeg_server draw on a separate thread, and serve the drawings to a browser;
+# - flight_recorder records each frame, what was found in it and the commands sent, to reproduce problems later.
 
 
 # For testing, create a dummy Update class.
 class Update_Mock(object):
-    def __init__(self, ser):
+    # If a :class:`Color_Lut` is given, use it to classify colors rather than converting each frame to Lab. If windowed_search is True, search for the car only near its last location; see :class:`Windowed_Car_Finder`. If draw is False, skip all drawing and return None in place of the final image. If a :class:`Car_Tracker` is given, steer using its prediction of the car's location when the command takes effect, rather than the location found in this frame; the tracker's latest :class:`Car_State` is then available as :attr:`car_state`. If a :class:`Resolution_Controller` is given, the image passed to :meth:`update` should be the full-size frame, which is processed at the controller's chosen scale by a :class:`Coarse_To_Fine_Car_Finder`; locations are still given in half-size frame coordinates.
+    #
+    # If a :class:`Stage_Scheduler` is given, each part of :meth:`update` runs as one of its stages (see :func:`add_update_stages`): finding the car and steering run every frame, while finding the lines, showing the distance map and drawing run at their stages' rates, reusing the last lines found in between. On a frame when the ``render`` stage isn't due, nothing is drawn and None is returned in place of the final image. If a :class:`Static_Line_Cache` is given, the lines found are reused until the scene changes. If a :class:`Grid_Planner` is given, the car steers along a path it plans around the lines, rather than straight toward its destination. If a :class:`Render_Thread` is given, each frame and its results are handed to it to draw; draw should then be False. After each :meth:`update`, :attr:`detection` summarizes what was found, as a :class:`Detection`.
+    def __init__(self, ser, lut = None, windowed_search = False, draw = True, tracker = None, resolution_controller = None, scheduler = None, line_cache = None, planner = None, renderer = None):
+        self.ser = ser
         self.eco = Estimate_Car_Orientation(5, 10)
+        self.lut = lut
+        self.draw = draw
+        self.tracker = tracker
+        self.scheduler = scheduler
+        self.line_cache = line_cache
+        self.planner = planner
+        self.renderer = renderer
+        # The last command given, for display.
+        self.command_text = ""
+        self.car_state = None
+        # The car's (x, y, radius) in the image passed to :meth:`update`, or None if it wasn't found.
+        self.car_footprint = None
+        # The car's estimated orientation and its distance to the nearest line, from :meth:`control`; None if unknown.
+        self.car_angle = None
+        self.line_dist = None
+        # The car's location and radius and the destination, for :attr:`detection`.
+        self._results = None
+        self.car_finder = Windowed_Car_Finder(lut, draw = draw) if windowed_search else None
+        self.adaptive_finder = Coarse_To_Fine_Car_Finder(resolution_controller, lut, draw = draw) if resolution_controller else None
 
     # Stopping the car is easy: let it coast to a stop
     def stop(self, image):
-        draw_str(image, (0, 15), "Stop")
+        self.ser.write(" ")
+        self.command_text = "Stop"
+        draw_str(image, (0, 15), self.command_text)
 
+    # The command is sent every frame; when ser is a :class:`Command_Scheduler`, only changes (plus keepalives) reach the car.
     def drive(self, image, dist, dir_name, go_char, coast_char):
-        draw_str(image, (0, 15), dir_name + (", dist = %.1f" % dist))
+        self.ser.write(go_char)
+        self.command_text = dir_name + (", dist = %.1f" % dist)
+        draw_str(image, (0, 15), self.command_text)
 
     # To drive foward or backward, alternate between driving and coasting.
     def forward(self, image, dist):
@@ -57,59 +109,162 @@ class Update_Mock(object):
     def backward_right(self, image, dist):
         self.drive(image, dist, "Backward and right", "H", "A")
 
-    # :ref:`WebcamFindCar` calls this routine every time a webcam image is grabbed. Do all your processing here!
-    def update(self, image, target_threshold, target_color, line_threshold, line_color, desired_xy, key):
-        desired_x, desired_y = desired_xy
+    # :ref:`WebcamFindCar` calls this routine every time a webcam image is grabbed. Do all your processing here! frame_time gives the time (from ``time.time``) the frame was captured, for the tracker; it's passed only when tracking.
+    def update(self, image, target_threshold, target_color, line_threshold, line_color, desired_xy, key, frame_time = None):
+        frame_start = time.perf_counter()
+        # Draw only on frames which will be shown.
+        draw = self.draw and (self.scheduler is None or self.scheduler.due('render'))
         # First, find the car in the given image. The ``actual_x`` and ``actual_y`` variables give the x, y location of the center of the car in the image.
-        lab_image, final_image, (actual_x, actual_y), cont_area = find_car(image, target_color, target_threshold)
-        draw_str(final_image, (0, 30), "Car area: %.1f" % cont_area)
-        # Find a line / obstacle
-        dist_image = distance_to_color(lab_image, final_image, line_color, line_threshold)
-        # Display it if the line / obstacle was found
-        if dist_image is not None:
-            cv2.imshow("dist", dist_image / numpy.amax(dist_image))
+        final_image, (actual_x, actual_y), lab_image = self.run_stage('car', self.find_car, image, target_color, target_threshold, draw)
+        # Find a line / obstacle. The line color and threshold identify this stage's inputs, so picking a new line color finds the lines again at once.
+        line_key = (tuple(float(c) for c in line_color), line_threshold)
+        with timers.stage('find_line_distance'):
+            line_distance = self.run_stage('lines', self.find_line_distance, image, lab_image, line_color, line_threshold, line_key, key = line_key)
+        # Display it if the line / obstacle was found. Only the display needs the full distance map.
+        if line_distance is not None and draw:
+            cv2.drawContours(final_image, line_distance.contours, -1, (0, 255, 0), 3)
+            self.run_stage('distance_map', self.show_distance_map, line_distance)
+        self.run_stage('control', self.control, final_image, (actual_x, actual_y), line_distance, desired_xy, frame_time)
+        # Tell the controller how long this frame took, so it can choose the next frame's scale.
+        if self.adaptive_finder:
+            self.adaptive_finder.controller.update((time.perf_counter() - frame_start)*1000.0, (actual_x, actual_y) != (-1, -1))
+        display_shape = self.adaptive_finder.display_shape if self.adaptive_finder else image.shape[0:2]
+        car_radius = self.car_footprint[2]*display_shape[1]/float(image.shape[1]) if self.car_footprint else 0.0
+        self._results = ((actual_x, actual_y), car_radius, self.car_angle, self.line_dist, desired_xy)
+        # Hand the frame and its results to the render thread, which draws them at its own pace.
+        if self.renderer is not None:
+            from render_thread import Render_Job
+            self.renderer.submit(Render_Job(image, display_shape, (actual_x, actual_y), car_radius, line_distance, desired_xy,
+                                            self.planner.path if self.planner is not None else None, [self.command_text]))
+
+        # Decide when to quit: return True to quit, False to keep running.
+        return key != -1, final_image
+
+    # A :class:`Detection` summarizing what the last :meth:`update` found, or None before the first. Only a recorder needs this, so it's built only when asked for.
+    @property
+    def detection(self):
+        if self._results is None:
+            return None
+        from flight_recorder import Detection
+        return Detection(*self._results)
+
+    # Run func with the given args as the named stage of the scheduler, if there is one; otherwise, just call it. See :meth:`Stage_Scheduler.run` for key.
+    def run_stage(self, name, func, *args, key = None):
+        if self.scheduler is None:
+            return func(*args)
+        return self.scheduler.run(name, func, *args, key = key)
+
+    # Find the car, returning the image to draw on (or None if draw is False), the x, y location of the center of the car, and the image to pass to :meth:`find_line_distance`.
+    def find_car(self, image, target_color, target_threshold, draw):
+        if self.adaptive_finder:
+            self.adaptive_finder.draw = draw
+            final_image, actual_xy, cont_area, lab_image, scale = self.adaptive_finder.find_car(image, target_color, target_threshold)
+            draw_str(final_image, (0, 30), "Car area: %.1f (scale 1/%g)" % (cont_area, 1.0/scale))
+        elif self.car_finder:
+            self.car_finder.draw = draw
+            final_image, actual_xy, cont_area, search = self.car_finder.find_car(image, target_color, target_threshold)
+            draw_str(final_image, (0, 30), "Car area: %.1f (%s)" % (cont_area, search))
+            # The windowed search converts only the window; the line search converts the whole image when it runs.
+            lab_image = None
+        else:
+            lab_image, final_image, actual_xy, cont_area = find_car(image, target_color, target_threshold, self.lut, draw)
+            draw_str(final_image, (0, 30), "Car area: %.1f" % cont_area)
+        if actual_xy[0] < 0:
+            self.car_footprint = None
+        else:
+            # With a resolution controller, image is the full-size frame, but locations are given in the half-size frame.
+            scale = image.shape[1] / float(self.adaptive_finder.display_shape[1]) if self.adaptive_finder else 1.0
+            self.car_footprint = (actual_xy[0]*scale, actual_xy[1]*scale, sqrt(cont_area/pi)*scale)
+        return final_image, actual_xy, lab_image
+
+    # Find the lines / obstacles, returning a :class:`Line_Distance_Query`, or None if none were found. lab_image is the image returned by :meth:`find_car`, or None to convert image here. line_key identifies the line color and threshold. With a line cache, the lines are only found again when the scene or line_key change.
+    def find_line_distance(self, image, lab_image, line_color, line_threshold, line_key):
+        if self.line_cache is not None:
+            return self.line_cache.lookup(image, line_key, self.car_footprint, lambda: self.find_lines(image, lab_image, line_color, line_threshold))
+        return self.find_lines(image, lab_image, line_color, line_threshold)
+
+    def find_lines(self, image, lab_image, line_color, line_threshold):
+        if self.adaptive_finder:
+            return self.adaptive_finder.find_line_distance(image, lab_image, None, line_color, line_threshold)
+        if lab_image is None:
+            lab_image = image if self.lut is not None else im_to_lab(image)
+        return find_line_distance(lab_image, None, line_color, line_threshold, self.lut)
+
+    def show_distance_map(self, line_distance):
+        with timers.stage('dense_distance'):
+            dist_image = line_distance.dense_map()
+        cv2.imshow("dist", dist_image / numpy.amax(dist_image))
+
+    # Given the car's location actual_xy found in a frame and the :class:`Line_Distance_Query` (or None) for the lines found in it, drive toward desired_xy. This is the second half of :meth:`update`, split out so that it can run apart from finding the car (see :mod:`process_pipeline`). Status is drawn on final_image, unless it's None. frame_time gives the time the frame was captured; the tracker measures its latency from then, so give this whenever processing may lag capture.
+    def control(self, final_image, actual_xy, line_distance, desired_xy, frame_time = None):
+        actual_x, actual_y = actual_xy
+        desired_x, desired_y = desired_xy
+        # If tracking, replace the car's location with where it will be when this frame's command takes effect. This also supplies a location through short gaps when the car isn't found.
+        if self.tracker is not None:
+            with timers.stage('tracker'):
+                self.car_state = self.tracker.update((actual_x, actual_y), frame_time)
+            if self.car_state is not None:
+                actual_x, actual_y = round_int(self.car_state.predicted)
+                draw_str(final_image, (0, 60), "Predicted (%d, %d), coasting %.2f s" % (actual_x, actual_y, self.car_state.coasting))
         # Show the distance from the car's location to the nearest line / obstacle
-        lobs_dist = get_dist_image(dist_image, actual_y, actual_x)
+        lobs_dist = line_distance.distance(actual_x, actual_y) if line_distance is not None else None
+        self.line_dist = lobs_dist
+        self.car_angle = None
         if lobs_dist is not None:
             draw_str(final_image, (0, 45), "Dist to green: %.1f" % lobs_dist)
         # This specifies how close must the car be to the desired x, y coordinate for the car to stop.
         close_dist = 40
-        # See if there's a drive destination or not.
-        if desired_x < 0 or desired_y < 0:
+        # See if there's a drive destination or not. Likewise, stop if the car's location isn't known.
+        if desired_x < 0 or desired_y < 0 or actual_x < 0 or actual_y < 0:
             self.stop(final_image)
         else:
             # Determine how far it is from the center of the screen and draw that circle on the screen
             dist = sqrt( (desired_x - actual_x)**2 + (desired_y - actual_y)**2 )
-            cv2.circle(final_image, (desired_x, desired_y), close_dist, (0,
+            if final_image is not None:
+                cv2.circle(final_image, (desired_x, desired_y), close_dist, (0,
  255, 255), 2)
              # Estimmate and plot the car's orientation
-            car_angle = self.eco.estimate_car_orientation(actual_x, actual_y)
+            with timers.stage('orientation'):
+                # The tracker's velocity gives the heading once the car is moving; until then, estimate it from recent locations.
+                if self.car_state is not None and self.car_state.heading is not None:
+                    car_angle = self.car_state.heading
+                else:
+                    car_angle = self.eco.estimate_car_orientation(actual_x, actual_y)
+            self.car_angle = car_angle
             draw_angle(final_image, (actual_x, actual_y), car_angle)
             if dist < close_dist:
                 self.stop(final_image)
             else:
-                # Determine the angle between the car's current position and its' desired position.
-                target_angle = atan2(actual_y - desired_y, desired_x - actual_x)
-                draw_angle(final_image, (actual_x, actual_y), target_angle)
-                # Determine the angle at which to drive
-                diff_angle = target_angle - car_angle
-                if abs(diff_angle) <= pi/6.0:
-                    self.forward(final_image, dist)
-                elif diff_angle > 0.0 and diff_angle <= pi/2.0:
-                    self.forward_left(final_image, dist)
-                elif diff_angle < 0.0 and diff_angle >= -pi/2.0:
-                    self.forward_right(final_image, dist)
-                else:
+                # When planning, head for the next point on a path around the lines / obstacles; otherwise, head straight for the desired position.
+                target_xy = (desired_x, desired_y)
+                if self.planner is not None:
+                    with timers.stage('planner'):
+                        target_xy = self.planner.next_waypoint((actual_x, actual_y), (desired_x, desired_y), line_distance)
+                    self.planner.draw(final_image)
+                if target_xy is None:
+                    # Wait for the planner to finish its search, or stop if there's no way to the desired position.
                     self.stop(final_image)
-
-        # Decide when to quit: return True to quit, False to keep running.
-        return key != -1, final_image
+                    draw_str(final_image, (0, 75), "Planning..." if self.planner.searching else "No path")
+                else:
+                    # Determine the angle between the car's current position and its' desired position.
+                    target_angle = atan2(actual_y - target_xy[1], target_xy[0] - actual_x)
+                    draw_angle(final_image, (actual_x, actual_y), target_angle)
+                    # Determine the angle at which to drive
+                    diff_angle = target_angle - car_angle
+                    if abs(diff_angle) <= pi/6.0:
+                        self.forward(final_image, dist)
+                    elif diff_angle > 0.0 and diff_angle <= pi/2.0:
+                        self.forward_left(final_image, dist)
+                    elif diff_angle < 0.0 and diff_angle >= -pi/2.0:
+                        self.forward_right(final_image, dist)
+                    else:
+                        self.stop(final_image)
 
 
 # For debugging, or when the COM port isn't available, write data to the screen.
 class Serial_Mock(object):
     def write(self, string):
-        print(string)
+        print(string.decode('ascii') if isinstance(string, bytes) else string)
 
     def isOpen(self):
         return True
@@ -117,10 +272,43 @@ class Serial_Mock(object):
     def close(self):
         pass
 
+# Declare the stages of :meth:`Update_Mock.update` and :meth:`Webcam_Find_Car.update` in a :class:`Stage_Scheduler`. Finding the car and steering run every frame. The lines are found line_rate times a second, the distance map is shown distance_map_rate times a second, and the display is drawn render_rate times a second; each of these slows down when frames overrun the frame budget.
+def add_update_stages(scheduler, line_rate = 10.0, distance_map_rate = 2.0, render_rate = 15.0):
+    scheduler.add_stage('car', budget_ms = 10.0)
+    scheduler.add_stage('control', budget_ms = 1.0)
+    scheduler.add_stage('lines', line_rate, budget_ms = 10.0, adaptive = True, min_rate = 2.0)
+    scheduler.add_stage('distance_map', distance_map_rate, budget_ms = 15.0, adaptive = True, min_rate = 0.5)
+    scheduler.add_stage('render', render_rate, budget_ms = 5.0, adaptive = True, min_rate = 5.0)
+
 # This class implements all the main loop functionality. Simply instantiate it to use.
 class Webcam_Find_Car(object):
-    # To initialize the class, pick default values for the threshold and target_color, both used by  :func:`find_car`. The :attr:`update_func` is the user-supplied update routine. comm_port gives the serial port used to communicate with the car.
-    def __init__(self, comm_port = None, webcam_index = 0, Update_class = Update_Mock):
+    # To initialize the class, pick default values for the threshold and target_color, both used by  :func:`find_car`. The :attr:`update_func` is the user-supplied update routine. comm_port gives the serial port used to communicate with the car. When threaded_capture is True, frames are read on a background thread which keeps only the newest frame; see :class:`Threaded_Capture`. When use_lut is True, colors are classified using a :class:`Color_Lut`. When windowed_search is True, the car is tracked using a :class:`Windowed_Car_Finder`.
+    #
+    # Commands reach the car through a :class:`Command_Scheduler`, which writes only changed commands plus a keepalive every keepalive_interval seconds, and stops the car if the loop stalls for stall_timeout seconds.
+    #
+    # When stage_timing is True, the time taken by each stage of processing is recorded (see :mod:`stage_timers`) and shown on the final image; these results are saved to timings_file (JSON, or CSV if the name ends in ``.csv``) on exit.
+    #
+    # When cache_lines is True, the lines found are reused until the scene changes; see :class:`Static_Line_Cache`.
+    #
+    # When plan_path is True, the car steers along a path planned around the lines by a :class:`Grid_Planner`, rather than straight toward the target.
+    #
+    # When render_thread is True, drawing moves off the main loop to a :class:`Render_Thread`, which draws at most render_rate times a second. When preview_port is given, the drawings are also served on that port as an MJPEG stream (see :class:`Mjpeg_Server`), which works when headless as well; this implies render_thread.
+    #
+    # When record_file is given, each frame grabbed, what was found in it and the bytes sent to the car are recorded to that file by a :class:`Flight_Recorder`, keeping the frame of one tick in record_every, as a JPEG image of quality record_jpeg_quality if given, or else raw. Recordings can be replayed as a frame source (see :func:`open_frame_source`).
+    #
+    # When schedule_stages is True, a :class:`Stage_Scheduler` runs the slower stages of each frame at lower rates than finding the car (see :func:`add_update_stages`), aiming to finish each frame within frame_budget_ms milliseconds; its report is printed on exit.
+    #
+    # When target_frame_ms is given, each frame is processed at the scale a :class:`Resolution_Controller` picks to keep the processing time near target_frame_ms milliseconds, rather than always at half size.
+    #
+    # When track_car is True, the car's location is fused over time by a :class:`Car_Tracker`, which predicts its location latency seconds after each frame is captured.
+    #
+    # When calibration_dir is given, the settings come from the named profile (by default, the active one) in that directory rather than from the pickle file, and any changes are saved back to it on exit; see :class:`Calibration_Store`. The profile is created from the current settings if it doesn't exist. Its color lookup tables are loaded rather than built. :meth:`switch_profile` changes profiles without stalling the main loop.
+    #
+    # frame_source supplies frames in place of the webcam given by webcam_index; see :mod:`frame_sources`. When it runs out of frames, :meth:`main` returns.
+    #
+    # When headless is True, no windows are created and nothing is drawn, so no display (or X server) is needed; the loop then runs as fast as the camera allows until interrupted with Ctrl+C. Settings then come from config_file (see :meth:`load_config`) or from the ``set_`` methods below, rather than from the mouse and trackbars.
+    def __init__(self, comm_port = None, webcam_index = 0, Update_class = Update_Mock, threaded_capture = False, use_lut = False, windowed_search = False, headless = False, config_file = None, frame_source = None, stage_timing = False, timings_file = None, keepalive_interval = 0.5, stall_timeout = 1.0, track_car = False, latency = 0.15, target_frame_ms = None, calibration_dir = None, profile = None, schedule_stages = False, frame_budget_ms = 33.0, cache_lines = False, plan_path = False, render_thread = False, render_rate = 15.0, preview_port = None, record_file = None, record_every = 1, record_jpeg_quality = None):
+        import pickle
         self.pickle_filename = 'webcam_find_car_defaults.pickle'
         try:
             with open(self.pickle_filename, 'rb') as f:
@@ -134,56 +322,237 @@ class Webcam_Find_Car(object):
             self.line_color = self.target_color
         # Store the last x, y right mouse click. Indiate no initial choice with negative coordinates.
         self.last_rclick_coord = (-1, -1)
+        self.headless = headless
+        self.lut = None
+        self.timings_file = timings_file
+        if stage_timing:
+            timers.enabled = True
+        self.calibration_store = None
+        self.calibration = None
+        if calibration_dir:
+            from calibration_store import Calibration_Store
+            self.calibration_store = Calibration_Store(calibration_dir, create = True)
+            profile = profile or self.calibration_store.active
+            if profile not in self.calibration_store.profiles():
+                print('Creating calibration profile %s from the current settings.' % profile)
+                self.calibration_store.save(profile, self.calibration_settings())
+            self.apply_calibration(self.calibration_store.load(profile))
+        # Settings from a config file override those from the calibration.
+        if config_file:
+            self.load_config(config_file)
 
         # Open the serial port, if given
         if comm_port:
-            self.ser = serial.Serial(port = comm_port - 1, baudrate = 115200)
+            import serial
+            ser = serial.Serial(port = comm_port - 1, baudrate = 115200)
         else:
-            self.ser = Serial_Mock()
-        # Initialize the update class. It needs an inst of ser to communiate with the car.
-        update_inst = Update_class(self.ser)
-        # All we need to call is the update method, so just save that.
+            ser = Serial_Mock()
+        # Record only the bytes which reach the car, beneath the command scheduler.
+        self.recorder = None
+        if record_file:
+            from flight_recorder import Flight_Recorder, Recording_Serial
+            self.recorder = Flight_Recorder(record_file, record_every, record_jpeg_quality)
+            ser = Recording_Serial(ser, self.recorder)
+        self.ser = Command_Scheduler(ser, keepalive_interval, stall_timeout = stall_timeout)
+        # Build the color lookup tables now, so that the first frame doesn't pay for this.
+        if use_lut:
+            from color_lut import Color_Lut
+            self.lut = Color_Lut()
+            if self.calibration is not None:
+                self.apply_calibration(self.calibration)
+            self.prepare_lut()
+        # Initialize the update class. It needs an inst of ser to communiate with the car. Pass only the options which were selected, so that update classes which don't support them still work.
+        update_options = {}
+        if self.lut is not None:
+            update_options['lut'] = self.lut
+        if windowed_search:
+            update_options['windowed_search'] = True
+        if headless:
+            update_options['draw'] = False
+        self.tracker = None
+        if track_car:
+            from car_tracker import Car_Tracker
+            self.tracker = Car_Tracker(latency)
+            update_options['tracker'] = self.tracker
+        self.resolution_controller = None
+        if target_frame_ms:
+            from resolution_controller import Resolution_Controller
+            self.resolution_controller = Resolution_Controller(target_frame_ms)
+            update_options['resolution_controller'] = self.resolution_controller
+        self.scheduler = None
+        if schedule_stages:
+            from stage_scheduler import Stage_Scheduler
+            self.scheduler = Stage_Scheduler(frame_budget_ms)
+            add_update_stages(self.scheduler)
+            update_options['scheduler'] = self.scheduler
+        self.line_cache = None
+        if cache_lines:
+            from line_cache import Static_Line_Cache
+            self.line_cache = Static_Line_Cache()
+            update_options['line_cache'] = self.line_cache
+        self.planner = None
+        if plan_path:
+            from path_planner import Grid_Planner
+            self.planner = Grid_Planner()
+            update_options['planner'] = self.planner
+        self.preview_server = None
+        if preview_port is not None:
+            from mjpeg_server import Mjpeg_Server
+            self.preview_server = Mjpeg_Server(preview_port)
+            print("Preview at http://<this machine>:%d/" % self.preview_server.port)
+        self.renderer = None
+        self.shown_dist_image = None
+        if render_thread or self.preview_server is not None:
+            from render_thread import Render_Thread
+            self.renderer = Render_Thread(render_rate, self.preview_server, show = not headless)
+            update_options['renderer'] = self.renderer
+            update_options['draw'] = False
+        update_inst = Update_class(self.ser, **update_options)
+        # All we need to call is the update method, so just save that; the recorder also reads its results.
         self.update_func = update_inst.update
+        self.update_inst = update_inst
 
         # Set up GUI
-        cv2.namedWindow("final")
-        cv2.namedWindow("dist")
-        cv2.setMouseCallback("final", self.on_mouse)
-        cv2.createTrackbar("car thold", "final", self.target_threshold, 100, self.on_trackbar_target_threshold)
-        cv2.createTrackbar("line thold", "final", self.line_threshold, 100, self.on_trackbar_line_threshold)
+        if not headless:
+            cv2.namedWindow("final")
+            cv2.namedWindow("dist")
+            cv2.setMouseCallback("final", self.on_mouse)
+            cv2.createTrackbar("car thold", "final", self.target_threshold, 100, self.on_trackbar_target_threshold)
+            cv2.createTrackbar("line thold", "final", self.line_threshold, 100, self.on_trackbar_line_threshold)
 
         # Init video capture
-        self.cap = cv2.VideoCapture(webcam_index)
+        self.cap = frame_source if frame_source is not None else Camera_Source(webcam_index)
         assert self.cap.isOpened()
+        if threaded_capture:
+            self.cap = Threaded_Capture(self.cap)
+        self.capture_stats = Capture_Stats()
 
 # Grab an image then call ``update()`` until done.
     def main(self):
-        # Using `waitKey <http://docs.opencv.org/modules/highgui/doc/user_interface.html#waitkey>`_, grab a frame then call update on it
+        # Using `waitKey <http://docs.opencv.org/modules/highgui/doc/user_interface.html#waitkey>`_, grab a frame then call update on it. Without a GUI there are no key presses to wait for, so skip this when headless.
         isDone = False
-        while not isDone:
-            key = cv2.waitKey(1)
-            success_flag, self.image = self.cap.read()
-            assert success_flag
-            sz = self.image.shape
-            self.image = cv2.resize(self.image, (int(sz[1]/2), int(sz[0]/2)))
-            isDone = self.update(key)
+        try:
+            while not isDone:
+                key = -1 if self.headless else cv2.waitKey(1)
+                self.poll_calibration()
+                if not self.grab_frame():
+                    print("No more frames.")
+                    break
+                isDone = self.update(key)
+                self.capture_stats.processed_frames += 1
+        except KeyboardInterrupt:
+            # This is the way to stop a headless run.
+            pass
 
         # Clean up
-        if self.ser.isOpen():
-            # Stop the car on exit
-            self.ser.write(" ")
-            self.ser.close()
+        print(self.capture_stats.report(self.cap))
+        # Stop the car on exit; closing the scheduler does this.
+        self.ser.close()
+        print(self.ser.report())
+        if self.tracker is not None:
+            print(self.tracker.report())
+        if self.resolution_controller is not None:
+            print(self.resolution_controller.report())
+        if self.scheduler is not None:
+            print(self.scheduler.report())
+        if self.line_cache is not None:
+            print(self.line_cache.report())
+        if self.planner is not None:
+            print(self.planner.report())
+        if self.renderer is not None:
+            self.renderer.close()
+            print(self.renderer.report())
+        if self.preview_server is not None:
+            self.preview_server.close()
+            print(self.preview_server.report())
+        # Close the recorder after the scheduler, so that the stop command sent on exit is recorded.
+        if self.recorder is not None:
+            self.recorder.close()
+            print(self.recorder.report())
+        if timers.enabled:
+            for name, stats in timers.summary().items():
+                print("%s: mean %.2f ms, p95 %.2f ms, p99 %.2f ms" % (name, stats['mean_ms'], stats['p95_ms'], stats['p99_ms']))
+            if self.timings_file:
+                timers.dump(self.timings_file)
         self.cap.release()
-        cv2.destroyAllWindows()
-        with open(self.pickle_filename, 'wb') as f:
-            pickle.dump((self.target_threshold, self.target_color, self.line_threshold, self.line_color), f)
+        if not self.headless:
+            cv2.destroyAllWindows()
+        if self.calibration_store is not None:
+            # Save any changes made with the mouse or trackbars to the current profile.
+            settings = self.calibration_settings()
+            if any(not numpy.array_equal(settings[key], self.calibration.settings[key]) for key in settings):
+                self.calibration_store.save(self.calibration.name, settings, self.lut)
+            print(self.calibration_store.report())
+            self.calibration_store.close()
+        else:
+            import pickle
+            with open(self.pickle_filename, 'wb') as f:
+                pickle.dump((self.target_threshold, self.target_color, self.line_threshold, self.line_color), f)
+
+    # Read the next frame into :attr:`image`, shrinking it to speed processing. Return False if there are no more frames.
+    def grab_frame(self):
+        success_flag, image = self.cap.read()
+        if not success_flag:
+            return False
+        # Keep the frame as grabbed, for the recorder, along with the time it was captured. A source which knows this better -- a :class:`Threaded_Capture`, or a recording with timestamps -- gives it as ``frame_time``.
+        self.frame = image
+        self.frame_time = getattr(self.cap, 'frame_time', None)
+        if self.frame_time is None:
+            self.frame_time = time.time()
+        # When the scale is chosen per frame, processing starts from the full-size frame; the half-size frame is then needed only by the GUI.
+        if self.resolution_controller is not None:
+            self.full_image = image
+            if self.headless:
+                return True
+        sz = image.shape
+        self.image = cv2.resize(image, (int(sz[1]/2), int(sz[0]/2)))
+        return True
 
     def update(self, key = -1):
-        isDone, final_image = self.update_func(self.image, self.target_threshold, self.target_color, self.line_threshold, self.line_color, self.last_rclick_coord, key)
+        if self.scheduler is not None:
+            self.scheduler.start_frame()
+        with timers.stage('update'):
+            image = self.full_image if self.resolution_controller is not None else self.image
+            # Only the tracker needs the capture time; pass it only then, so that update classes which don't track still work.
+            update_options = {'frame_time': self.frame_time} if self.tracker is not None else {}
+            isDone, final_image = self.update_func(image, self.target_threshold, self.target_color, self.line_threshold, self.line_color, self.last_rclick_coord, key, **update_options)
+        if self.recorder is not None:
+            self.recorder.record(self.frame, getattr(self.update_inst, 'detection', None), self.frame_time)
+        # With a scheduler, the update class skips drawing (returning no image) on frames when the display isn't due.
+        if self.renderer is not None and not self.headless:
+            self.show_rendered()
+        elif not self.headless and final_image is not None:
+            if self.scheduler is not None:
+                self.scheduler.run('render', self.render, final_image)
+            else:
+                self.render(final_image)
+        if self.scheduler is not None:
+            self.scheduler.end_frame()
+        return isDone
+
+    # Show the render thread's latest drawings, if there are new ones. OpenCV's windows must be used from this thread.
+    def show_rendered(self):
+        images = self.renderer.take_rendered()
+        if images is None:
+            return
+        final_image, dist_image = images
+        cv2.imshow("final", final_image)
+        # The distance map is refreshed less often than the drawing; show it only when it changes.
+        if dist_image is not None and dist_image is not self.shown_dist_image:
+            cv2.imshow("dist", dist_image)
+            self.shown_dist_image = dist_image
+
+    # Draw the status on the final image, then show it.
+    def render(self, final_image):
+        # The stage times go below the status lines drawn by the update class, the last of which is the planner's, at y = 75.
+        if timers.enabled:
+            timers.draw(final_image, (0, 90), draw_str)
         # Show the processed image
         draw_str(final_image, (5, final_image.shape[0] - 5), 'v268')
+        # Show frames dropped by the capture thread, if it's in use.
+        if isinstance(self.cap, Threaded_Capture):
+            draw_str(final_image, (5, final_image.shape[0] - 20), "Dropped: %d" % self.cap.dropped_frames)
         cv2.imshow("final", final_image)
-        return isDone
 
 # Wrapping the code in a class makes access to class variables (such as :attr:`threshold`) from callbacks such as ``on_mouse`` below simpler.
     def on_mouse(self, event, x, y, flags, param):
@@ -194,6 +563,7 @@ class Webcam_Find_Car(object):
             else:
                 print('target color')
                 self.target_color = self.rgb_pixel_to_lab(x, y)
+            self.prepare_lut()
             self.update()
         elif event == cv2.EVENT_RBUTTONDOWN:
             self.last_rclick_coord = (x, y)
@@ -206,20 +576,105 @@ class Webcam_Find_Car(object):
 
     def on_trackbar_target_threshold(self, target_threshold):
         self.target_threshold = target_threshold
+        self.prepare_lut()
         self.update()
 
     def on_trackbar_line_threshold(self, line_threshold):
         self.line_threshold = line_threshold
+        self.prepare_lut()
         self.update()
 
-# This routine places a string at the given location in an image. It was taken from openCV, in python2/samples/common.py.
+    # The color lookup tables depend only on the colors and thresholds, so rebuild them only when one of these changes.
+    def prepare_lut(self):
+        if self.lut is not None:
+            self.lut.prepare(self.target_color, self.target_threshold)
+            self.lut.prepare(self.line_color, self.line_threshold)
+
+    # Without a GUI, use these routines in place of the mouse and trackbars. Colors are given in the Lab color space, as returned by :func:`im_to_lab`; use :meth:`set_target_xy` with negative coordinates to stop the car.
+    def set_target_color(self, lab_color):
+        self.target_color = numpy.float32(lab_color)
+        self.prepare_lut()
+
+    def set_line_color(self, lab_color):
+        self.line_color = numpy.float32(lab_color)
+        self.prepare_lut()
+
+    def set_target_threshold(self, target_threshold):
+        self.target_threshold = target_threshold
+        self.prepare_lut()
+
+    def set_line_threshold(self, line_threshold):
+        self.line_threshold = line_threshold
+        self.prepare_lut()
+
+    def set_target_xy(self, x, y):
+        self.last_rclick_coord = (x, y)
+
+    # The settings kept in a calibration profile.
+    def calibration_settings(self):
+        return {'target_threshold': self.target_threshold, 'target_color': self.target_color,
+                'line_threshold': self.line_threshold, 'line_color': self.line_color}
+
+    # Use the settings and color lookup tables of a :class:`Calibration`.
+    def apply_calibration(self, calibration):
+        self.calibration = calibration
+        settings = calibration.settings
+        self.target_threshold = settings['target_threshold']
+        self.target_color = settings['target_color']
+        self.line_threshold = settings['line_threshold']
+        self.line_color = settings['line_color']
+        if self.lut is not None:
+            for color, threshold, table in calibration.tables.values():
+                self.lut.add_table(color, threshold, table)
+            self.prepare_lut()
+
+    # Start switching to the named calibration profile. It's loaded in the background, then applied by :meth:`poll_calibration` once ready.
+    def switch_profile(self, name):
+        self.calibration_store.switch_profile(name)
+
+    # Apply a profile loaded in the background, either by :meth:`switch_profile` or because another program changed the active profile. This is called once per frame.
+    def poll_calibration(self):
+        if self.calibration_store is None:
+            return
+        calibration = self.calibration_store.poll()
+        if calibration is not None:
+            self.apply_calibration(calibration)
+            print('Switched to calibration profile %s.' % calibration.name)
+            if not self.headless:
+                cv2.setTrackbarPos("car thold", "final", self.target_threshold)
+                cv2.setTrackbarPos("line thold", "final", self.line_threshold)
+
+    # Load settings from a JSON file. Any of the following keys may be given; missing keys keep their current value::
+    #
+    #   {"target_threshold": 50, "target_color": [34.0, 17.0, -47.0],
+    #    "line_threshold": 50, "line_color": [34.0, 17.0, -47.0],
+    #    "target_xy": [160, 120]}
+    def load_config(self, config_file):
+        with open(config_file) as f:
+            config = json.load(f)
+        if 'target_threshold' in config:
+            self.set_target_threshold(config['target_threshold'])
+        if 'target_color' in config:
+            self.set_target_color(config['target_color'])
+        if 'line_threshold' in config:
+            self.set_line_threshold(config['line_threshold'])
+        if 'line_color' in config:
+            self.set_line_color(config['line_color'])
+        if 'target_xy' in config:
+            self.set_target_xy(*config['target_xy'])
+
+# This routine places a string at the given location in an image. It was taken from openCV, in python2/samples/common.py. Like the other drawing routines, it does nothing if there's no image to draw on (when headless).
 def draw_str(dst, xy, s):
+    if dst is None:
+        return
     x, y = xy
     cv2.putText(dst, s, (x + 1, y + 1), cv2.FONT_HERSHEY_PLAIN, 1.0, (0, 0, 0),
                 thickness = 2)
     cv2.putText(dst, s, (x, y), cv2.FONT_HERSHEY_PLAIN, 1.0, (255, 255, 255))
 
 def draw_angle(image, xy, angle):
+    if image is None:
+        return
     x, y = xy
     cv2.line(image, round_int((x, y)), round_int((15.0*cos(angle) + x, -15.0*sin(angle) + y)), (255, 255, 0), 2)
 
@@ -232,78 +687,253 @@ def round_int(f):
 # Per the profiler, convering to the Lab colorspace takes most of the processing time. For the case of finding multiple colors, split this conversion out so it can be run once, rather than for each color to find.
 def im_to_lab(image):
 # Move from 8-bit color to 32-bit floating point to retain accuracy for the following calculations.
-    float_image = image / numpy.float32(255.0)
+    with timers.stage('im_to_lab'):
+        float_image = image / numpy.float32(255.0)
 # Using `cvtColor <http://docs.opencv.org/modules/imgproc/doc/miscellaneous_transformations.html#cvtcolor>`_, convert to the Lab_ color space, since distance in this space approximates human-perceived color differences.
-    lab_image = cv2.cvtColor(float_image, cv2.COLOR_BGR2LAB)
+        lab_image = cv2.cvtColor(float_image, cv2.COLOR_BGR2LAB)
     return lab_image
 
-# This function finds a color blob (assumed to be the car), outlining it and returning its center.
-def find_car(image, lab_color, thresh):
-    lab_image = im_to_lab(image)
-    contours = find_lab_color(lab_image, lab_color, thresh)
-    cont_image, mass_center, cont_area = draw_car_contour(image, contours)
+# This function finds a color blob (assumed to be the car), outlining it and returning its center and area (in pixels). If a :class:`Color_Lut` is given, the Lab conversion is skipped and the returned lab_image is simply the given 8-bit image, ready to pass to :func:`find_lab_color` along with the same lut. If draw is False, the returned cont_image is None.
+def find_car(image, lab_color, thresh, lut = None, draw = True):
+    lab_image = image if lut is not None else im_to_lab(image)
+    # Only the largest blob is needed.
+    blobs = find_lab_blobs(lab_image, lab_color, thresh, lut, top_k = 1)
+    with timers.stage('draw_car_blob'):
+        cont_image, mass_center, cont_area = draw_car_blob(image, blobs, draw)
     return lab_image, cont_image, mass_center, cont_area
 
-# This routine takes an image in the Lab color space, a color to find in that image, and a threshold around that color, then returns contours surrounding this color.
-def find_lab_color(lab_image, color, thresh):
+# Tracking
+# --------
+# The car moves only a few pixels between frames, so searching the entire frame for it each time wastes most of the effort. This class searches only a window around the car's last known location, sized to cover the car plus the distance it could have moved since the last frame. If the car isn't found in the window, it falls back to searching the full frame to reacquire the car.
+class Windowed_Car_Finder(object):
+    # min_margin gives the smallest number of pixels between the car's outline and the edge of the window; speed_gain scales the car's recent speed (in pixels per frame) to add to this margin. lut is an optional :class:`Color_Lut`. If draw is False, nothing is drawn, as in :func:`find_car`.
+    def __init__(self, lut = None, min_margin = 15, speed_gain = 3.0, draw = True):
+        self.lut = lut
+        self.draw = draw
+        self.min_margin = min_margin
+        self.speed_gain = speed_gain
+        # The last car location and area, or None if the car was lost.
+        self.last_center = None
+        self.last_area = 0
+        # A smoothed estimate of the car's speed, in pixels per frame.
+        self.speed = 0.0
+        # The last window searched, as (x0, y0, x1, y1), or None for a full search.
+        self.window = None
+        # Count the searches of each kind, to see how often the window suffices.
+        self.window_searches = 0
+        self.full_searches = 0
+
+    # Find the car, returning the outlined image, the car's center and area as :func:`find_car` does, plus ``'window'`` or ``'full'`` to indicate which search produced this result.
+    def find_car(self, image, lab_color, thresh):
+        blobs = None
+        if self.last_center is not None:
+            self.window = self.compute_window(image.shape)
+            x0, y0, x1, y1 = self.window
+            window_image = image[y0:y1, x0:x1]
+            window_lab_image = window_image if self.lut is not None else im_to_lab(window_image)
+            blobs = find_lab_blobs(window_lab_image, lab_color, thresh, self.lut, top_k = 1)
+            # A car touching the edge of the window may extend past it, giving a wrong center, so treat this as lost.
+            if len(blobs) and not self.touches_edge(blobs.bboxes[0], image.shape):
+                blobs.offset((x0, y0))
+                search = 'window'
+                self.window_searches += 1
+            else:
+                blobs = None
+        if blobs is None:
+            # Reacquire the car using the full image.
+            self.window = None
+            lab_image = image if self.lut is not None else im_to_lab(image)
+            blobs = find_lab_blobs(lab_image, lab_color, thresh, self.lut, top_k = 1)
+            search = 'full'
+            self.full_searches += 1
+        with timers.stage('draw_car_blob'):
+            cont_image, mass_center, cont_area = draw_car_blob(image, blobs, self.draw)
+        self.track(mass_center, cont_area)
+        if self.window is not None and cont_image is not None:
+            cv2.rectangle(cont_image, self.window[0:2], self.window[2:4], (255, 0, 255), 1)
+        return cont_image, mass_center, cont_area, search
+
+    # Size the window around the last center to hold the car plus its expected motion, clipped to the image.
+    def compute_window(self, shape):
+        x, y = self.last_center
+        half_size = int(sqrt(self.last_area) + self.min_margin + self.speed_gain*self.speed)
+        x0 = max(int(x) - half_size, 0)
+        y0 = max(int(y) - half_size, 0)
+        x1 = min(int(x) + half_size + 1, shape[1])
+        y1 = min(int(y) + half_size + 1, shape[0])
+        return x0, y0, x1, y1
+
+    # Determine if the car's bounding box (x, y, width, height), found in the window, touches the edge of the window, unless that edge is also the edge of the image.
+    def touches_edge(self, bbox, shape):
+        x, y, w, h = bbox
+        x0, y0, x1, y1 = self.window
+        return ((x == 0 and x0 > 0) or (y == 0 and y0 > 0) or
+                (x0 + x + w >= x1 and x1 < shape[1]) or
+                (y0 + y + h >= y1 and y1 < shape[0]))
+
+    # Update the car's last location and speed.
+    def track(self, mass_center, cont_area):
+        if mass_center == (-1, -1):
+            self.last_center = None
+            self.speed = 0.0
+            return
+        if self.last_center is not None:
+            moved = sqrt((mass_center[0] - self.last_center[0])**2 + (mass_center[1] - self.last_center[1])**2)
+            self.speed = 0.5*self.speed + 0.5*moved
+        self.last_center = mass_center
+        self.last_area = cont_area
+
+# Adaptive resolution
+# -------------------
+# Rather than always processing a half-size frame, this class finds the car in the full-size frame shrunk to the scale chosen by a :class:`Resolution_Controller`. A coarse scale saves time, but gives only a rough location, so the car's center is then refined by searching again at full size, but only within a small window around the car. Both searches find the car as the largest blob of its color, as :func:`find_car` does. Locations and areas are returned in the coordinates of a frame shrunk by display_scale (half size), as used by the rest of the program, whatever scale processing used.
+class Coarse_To_Fine_Car_Finder(object):
+    # refine_margin gives the number of pixels, at the coarse scale, added around the car's bounding box to form the refinement window. lut is an optional :class:`Color_Lut`. If draw is False, nothing is drawn, as in :func:`find_car`.
+    def __init__(self, controller, lut = None, display_scale = 0.5, refine_margin = 2, draw = True):
+        self.controller = controller
+        self.lut = lut
+        self.display_scale = display_scale
+        self.refine_margin = refine_margin
+        self.draw = draw
+        self.display_shape = None
+        # Count the times the refinement didn't find the car, so only the coarse location was available.
+        self.refine_failures = 0
+
+    # Find the car in the full-size image. Returns the image to display (shrunk to display_scale with the car outlined, or None if draw is False), the car's center and area, the shrunken image to pass to :meth:`find_line_distance`, and the scale used.
+    def find_car(self, image, lab_color, thresh):
+        scale = self.controller.scale
+        rows, cols = image.shape[0:2]
+        self.display_shape = (int(rows*self.display_scale), int(cols*self.display_scale))
+        with timers.stage('resize'):
+            coarse_image = cv2.resize(image, (max(int(round(cols*scale)), 1), max(int(round(rows*scale)), 1)), interpolation = cv2.INTER_AREA)
+        coarse_lab_image = coarse_image if self.lut is not None else im_to_lab(coarse_image)
+        coarse_blobs = find_lab_blobs(coarse_lab_image, lab_color, thresh, self.lut, top_k = 1)
+        mass_center, cont_area, car_blobs = (-1, -1), 0, None
+        if len(coarse_blobs):
+            with timers.stage('refine'):
+                car_blobs = self.refine(image, coarse_blobs.bboxes[0], scale, lab_color, thresh)
+            # factor converts from the coordinates the car was found in to display coordinates.
+            factor = self.display_scale
+            if car_blobs is None:
+                self.refine_failures += 1
+                car_blobs = coarse_blobs
+                factor = self.display_scale / scale
+            center_x, center_y = car_blobs.centroids[0]
+            mass_center = (center_x*factor, center_y*factor)
+            cont_area = car_blobs.areas[0]*factor**2
+        final_image = None
+        if self.draw:
+            final_image = cv2.resize(image, (self.display_shape[1], self.display_shape[0]))
+            if car_blobs is not None:
+                cv2.drawContours(final_image, [numpy.int32(numpy.round(car_blobs.contour(0)*factor))], 0, (0, 0, 255), 3)
+            if mass_center != (-1, -1):
+                cv2.circle(final_image, round_int(mass_center), 10, (0, 255, 255), -1)
+        return final_image, mass_center, cont_area, coarse_lab_image, scale
+
+    # Search for the car at full size in a window around coarse_bbox, the bounding box (x, y, width, height) of the car found in a frame shrunk by scale. Returns the :class:`Blobs` holding the largest blob found, in full-size coordinates, or None if the car wasn't found.
+    def refine(self, image, coarse_bbox, scale, lab_color, thresh):
+        x, y, w, h = (int(value) for value in coarse_bbox)
+        margin = self.refine_margin
+        x0 = max(int((x - margin) / scale), 0)
+        y0 = max(int((y - margin) / scale), 0)
+        x1 = min(int((x + w + margin) / scale) + 1, image.shape[1])
+        y1 = min(int((y + h + margin) / scale) + 1, image.shape[0])
+        window_image = image[y0:y1, x0:x1]
+        window_lab_image = window_image if self.lut is not None else im_to_lab(window_image)
+        blobs = find_lab_blobs(window_lab_image, lab_color, thresh, self.lut, top_k = 1)
+        if not len(blobs):
+            return None
+        blobs.offset((x0, y0))
+        return blobs
+
+    # Find the lines in image, the full-size frame, as :func:`find_line_distance` does. The morphological open (see :func:`open_mask`) erases anything narrower than about :data:`OPEN_RADIUS` pixels, which removes thin lines at a coarse scale; so the lines are always found at display_scale, whatever scale the car was found at. Since the lines are found less often than the car (see :class:`Stage_Scheduler` and :class:`Static_Line_Cache`), this costs little. lab_image is the shrunken image returned by :meth:`find_car`, which is reused when it's already at display_scale.
+    def find_line_distance(self, image, lab_image, display_image, lab_color, threshold):
+        rows, cols = image.shape[0:2]
+        display_shape = (int(rows*self.display_scale), int(cols*self.display_scale))
+        if lab_image is None or lab_image.shape[0:2] != display_shape:
+            with timers.stage('resize'):
+                display_sized_image = cv2.resize(image, (display_shape[1], display_shape[0]), interpolation = cv2.INTER_AREA)
+            lab_image = display_sized_image if self.lut is not None else im_to_lab(display_sized_image)
+        contours = find_lab_color(lab_image, lab_color, threshold, self.lut)
+        if not contours:
+            return None
+        if display_image is not None:
+            cv2.drawContours(display_image, contours, -1, (0, 255, 0), 3)
+        return Line_Distance_Query(contours, display_shape)
+
+# This routine takes an image in the Lab color space, a color to find in that image, and a threshold around that color, then returns contours surrounding this color. If a :class:`Color_Lut` is given, lab_image should instead be the original 8-bit BGR image.
+def find_lab_color(lab_image, color, thresh, lut = None):
     assert(color.dtype == numpy.float32)
+    with timers.stage('threshold'):
+        thresh_image = threshold_lab_color(lab_image, color, thresh, lut)
+    with timers.stage('morphology'):
+        open_image = open_mask(thresh_image)
+# Find the contours of the image, smooth them, and draw them
+    with timers.stage('contours'):
+        # OpenCV 3 returns the image as well as the contours and hierarchy; later versions don't.
+        contours0 = cv2.findContours(open_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+#    contours = [cv2.approxPolyDP(cnt, 3, True) for cnt in contours0]
+    contours = contours0
+    return contours
+
+# Select the pixels of lab_image within thresh of color, returning an 8-bit image which is 255 for these pixels and 0 elsewhere. The arguments are the same as :func:`find_lab_color`.
+def threshold_lab_color(lab_image, color, thresh, lut = None):
+    if lut is not None:
+# Look up each pixel's classification in the precomputed table, which produces an 8-bit image directly.
+        return lut.threshold(lab_image, color, thresh)
 # Compute (image - target_color)^2, giving a Euclidian distance between the two.
     diff_image = lab_image - color
     normsq_image = numpy.sum(diff_image*diff_image, -1)
 # `cv2.Threshold <http://docs.opencv.org/modules/imgproc/doc/miscellaneous_transformations.html#threshold>`_ the image to select only pixels close to the target color. Convert it from floating-point back to an 8-bit image, since the steps below require 8-bit input.
     (retval, thresh_image) = cv2.threshold(normsq_image, thresh**2.0, 255.0, cv2.THRESH_BINARY_INV)
-    thresh_image = numpy.uint8(thresh_image)
-# Perform a morphological open (`erode <http://docs.opencv.org/modules/imgproc/doc/filtering.html#cv2.erode>`_ then dilate), using `getStructuringElement <http://docs.opencv.org/modules/imgproc/doc/filtering.html#getstructuringelement>`_.
-    sel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-    it = 2
-    erode_image = cv2.erode(thresh_image, sel, iterations = it)
-    open_image = cv2.dilate(erode_image, sel, iterations = it)
-# Find the contours of the image, smooth them, and draw them
-    output_image, contours0, hierarchy = cv2.findContours(open_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-#    contours = [cv2.approxPolyDP(cnt, 3, True) for cnt in contours0]
-    contours = contours0
-    return contours
+    return numpy.uint8(thresh_image)
 
-# Given a contour, outline it and find its center.
-def draw_car_contour(image, contours):
-    if not contours:
-        return image, (-1, -1), 0
-# Select the largest-area contour, then compute its mass center
-    cont_area = [cv2.contourArea(contour) for contour in contours]
-    max_cont_area_index = numpy.argmax(cont_area)
-    mass_center = compute_mass_center(contours[max_cont_area_index])
-#    print(cont_area, max_cont_area_index, mass_center)
+# The morphological open below uses this element, applied this many times. Each output pixel therefore depends on the input pixels within OPEN_RADIUS of it.
+OPEN_ELEMENT = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+OPEN_ITERATIONS = 2
+OPEN_RADIUS = 2*OPEN_ITERATIONS*(OPEN_ELEMENT.shape[0] // 2)
+
+# Perform a morphological open (`erode <http://docs.opencv.org/modules/imgproc/doc/filtering.html#cv2.erode>`_ then dilate), using `getStructuringElement <http://docs.opencv.org/modules/imgproc/doc/filtering.html#getstructuringelement>`_. This removes specks of noise from the thresholded image.
+def open_mask(thresh_image):
+    erode_image = cv2.erode(thresh_image, OPEN_ELEMENT, iterations = OPEN_ITERATIONS)
+    return cv2.dilate(erode_image, OPEN_ELEMENT, iterations = OPEN_ITERATIONS)
+
+# Like :func:`find_lab_color`, but return the :class:`Blobs` of the color rather than their contours, so that areas and centers come from a single pass. Blobs smaller than min_area pixels are dropped; if top_k is given, only the top_k largest are returned.
+def find_lab_blobs(lab_image, color, thresh, lut = None, min_area = 0, top_k = None):
+    assert(color.dtype == numpy.float32)
+    with timers.stage('threshold'):
+        thresh_image = threshold_lab_color(lab_image, color, thresh, lut)
+    with timers.stage('blobs'):
+        return open_and_find_blobs(thresh_image, OPEN_ELEMENT, OPEN_ITERATIONS, min_area, top_k)
+
+# Given the blobs found by :func:`find_lab_blobs`, outline the largest (the car) and return its center (the mean location of its pixels) and area (its number of pixels). If draw is False, skip the outlining and return None in place of the image. Only this blob's contour is traced, and only when drawing.
+def draw_car_blob(image, blobs, draw = True):
+    if not len(blobs):
+        return image if draw else None, (-1, -1), 0
+    mass_center = tuple(blobs.centroids[0])
+    cont_area = blobs.areas[0]
+    if not draw:
+        return None, mass_center, cont_area
     cont_image = image.copy()
-    cv2.drawContours(cont_image, contours, max_cont_area_index, (0, 0, 255), 3)
-    # http://docs.opencv.org/modules/core/doc/drawing_functions.html#cv2.circle
+    cv2.drawContours(cont_image, [blobs.contour(0)], 0, (0, 0, 255), 3)
     cv2.circle(cont_image, round_int(mass_center), 10, (0, 255, 255), -1)
-    return cont_image, mass_center, cont_area[max_cont_area_index],
-
-# Found this formula at    http://docs.opencv.org/modules/imgproc/doc/structural_analysis_and_shape_descriptors.html#moments
-def compute_mass_center(contour):
-    moments = cv2.moments(contour)
-    m00 = moments['m00']
-    if m00 == 0:
-        return -1, -1
-    m01 = moments['m01']
-    m10 = moments['m10']
-    x_m = m10/m00
-    y_m = m01/m00
-    return x_m, y_m
-
-# Given a color and threhold, this routine computes a distance map from every pixel to the cloest found line
-def distance_to_color(lab_image, display_image, lab_color, threshold):
-    contours = find_lab_color(lab_image, lab_color, threshold)
+    return cont_image, mass_center, cont_area
+
+# Given a color and threshold, this routine finds the lines of that color, returning a :class:`Line_Distance_Query` which gives the distance from a point to the closest found line, or None if no lines were found. The lines are outlined on display_image, unless it's None.
+def find_line_distance(lab_image, display_image, lab_color, threshold, lut = None):
+    contours = find_lab_color(lab_image, lab_color, threshold, lut)
     if not contours:
         return None
     # Outline all the found contours
-    cv2.drawContours(display_image, contours, -1, (0, 255, 0), 3)
-    # Zero all pixels in the found contours for use with the distance map
-    dist_image_in = numpy.empty(lab_image.shape[0:-1], dtype = numpy.uint8)
-    dist_image_in.fill(255)
-    cv2.drawContours(dist_image_in, contours, -1, 0, cv2.FILLED)
-    dist_image = cv2.distanceTransform(dist_image_in, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
-    return dist_image
+    if display_image is not None:
+        cv2.drawContours(display_image, contours, -1, (0, 255, 0), 3)
+    return Line_Distance_Query(contours, lab_image.shape[0:2])
+
+# Given a color and threhold, this routine computes a distance map from every pixel to the cloest found line. When only the distance from a few points is needed, use :func:`find_line_distance` instead, which avoids computing the full map.
+def distance_to_color(lab_image, display_image, lab_color, threshold, lut = None):
+    line_distance = find_line_distance(lab_image, display_image, lab_color, threshold, lut)
+    if line_distance is None:
+        return None
+    return line_distance.dense_map()
 
 
 # Indexing an image produced by distance_to_color fails in two cases:
@@ -327,9 +957,21 @@ def get_dist_image(dist_image, row, col):
 
 class Estimate_Car_Orientation(object):
     def __init__(self, num_history_points, dist_threshold):
-        # Keep a list of the last few x, y locations of the car for use in esimating the car's orientation.
-        self.actual_x_history = []
-        self.actual_y_history = []
+        # Keep the last few x, y locations of the car for use in esimating the car's orientation. These live in a fixed-size ring buffer: next_index gives where the next point goes, overwriting the oldest once the buffer is full.
+        self.x_history = numpy.zeros(num_history_points)
+        self.y_history = numpy.zeros(num_history_points)
+        # The length of the step from the previous point to each point in the history.
+        self.step_history = numpy.zeros(num_history_points)
+        self.next_index = 0
+        self.count = 0
+
+        # Rather than refitting every point on every frame, keep running sums of the coordinates, their squares and products, and the step lengths. Adding a point and dropping the oldest then updates the fit and the path length in constant time.
+        self.sum_x = self.sum_y = self.sum_xx = self.sum_yy = self.sum_xy = 0.0
+        # The total length of the path through the history, excluding the step into the oldest point (which leads from a point no longer held).
+        self.path_length = 0.0
+        # Adding and subtracting slowly accumulates rounding error in these sums, so recompute them from scratch after this many points.
+        self.refresh_interval = 4096
+        self.points_since_refresh = 0
 
         # How many points to keep in the history
         self.num_history_points = num_history_points
@@ -340,51 +982,115 @@ class Estimate_Car_Orientation(object):
         # How many pixels of movement produce a valid orientation estimate
         self.dist_threshold = dist_threshold
 
-    # Estimate the car's direction of travel based on fitting an arc of a circle to the last few x, y car locations. We assume that over this short sample time, there are no s-curves / direction changes to confuse this algorithm.
+    # Estimate the car's direction of travel based on fitting a line to the last few x, y car locations. We assume that over this short sample time, there are no s-curves / direction changes to confuse this algorithm.
     def estimate_car_orientation(self, x, y):
-        # First, add the current x, y coordinate to the end of the list, then drop the oldest coordinate from the beginning if the list is too long.
-        self.actual_x_history.append(x)
-        self.actual_y_history.append(y)
-        length = len(self.actual_x_history)
-        assert length == len(self.actual_y_history)
-        if len(self.actual_x_history) > self.num_history_points:
-            self.actual_x_history.pop(0)
-            self.actual_y_history.pop(0)
-            length -= 1
-        # Is there enough distance between these points to trust this estimate? Sum up the distance beteen all points in the history then see if it's big enough.
-        dist = 0
-        for index in range(length - 1):
-            dist += sqrt( (self.actual_x_history[index + 1] - self.actual_x_history[index])**2 +
-                          (self.actual_y_history[index + 1] - self.actual_y_history[index])**2 )
-        if dist < self.dist_threshold:
+        capacity = self.num_history_points
+        newest = (self.next_index - 1) % capacity
+        # First, drop the oldest coordinate if the buffer is full. The step into the second-oldest point then no longer counts toward the path length, since it now leads from a point outside the history.
+        if self.count == capacity:
+            old_x = self.x_history[self.next_index]
+            old_y = self.y_history[self.next_index]
+            self.sum_x -= old_x
+            self.sum_y -= old_y
+            self.sum_xx -= old_x*old_x
+            self.sum_yy -= old_y*old_y
+            self.sum_xy -= old_x*old_y
+            self.path_length -= self.step_history[(self.next_index + 1) % capacity]
+            self.count -= 1
+        # Then add the current x, y coordinate.
+        step = sqrt((x - self.x_history[newest])**2 + (y - self.y_history[newest])**2) if self.count else 0.0
+        self.x_history[self.next_index] = x
+        self.y_history[self.next_index] = y
+        self.step_history[self.next_index] = step
+        self.next_index = (self.next_index + 1) % capacity
+        self.count += 1
+        self.sum_x += x
+        self.sum_y += y
+        self.sum_xx += x*x
+        self.sum_yy += y*y
+        self.sum_xy += x*y
+        if self.count > 1:
+            self.path_length += step
+        self.points_since_refresh += 1
+        if self.points_since_refresh >= self.refresh_interval:
+            self.refresh_sums()
+
+        # Is there enough distance between these points to trust this estimate?
+        if self.path_length < self.dist_threshold:
             return self.last_orientation
-        # Next, fit the points. Polyfit stores coefficients of higher powers first, so an order-1 polynomial is :math:`C_0 x + C_1' -- slope then intercept.
-        (slope, intercept), residuals, rank, singular_values, rcond = polyfit(self.actual_x_history, self.actual_y_history, 1, full = True)
-        # Did we get a valid fit? A deficient rank indicates a vertical line.
-        if rank < 2:
-            self.last_orientation = pi/2.0
-        # Otherwise, the slope gives the angle.  However, tan elementof [-pi/2, pi/2], so look at the vector connecting the first and last points to make this a four-quadrant result.
-        else:
-            self.last_orientation = atan2(
-              copysign(slope, self.actual_y_history[0] - self.actual_y_history[-1]),
-              copysign(1, self.actual_x_history[-1] - self.actual_x_history[0]))
+        oldest = self.next_index if self.count == capacity else 0
+        self.last_orientation = _fit_orientation(self.count, self.sum_x, self.sum_y, self.sum_xx, self.sum_yy, self.sum_xy,
+          x - self.x_history[oldest], y - self.y_history[oldest])
         return self.last_orientation
 
+    # Recompute the running sums from the points held.
+    def refresh_sums(self):
+        capacity = self.num_history_points
+        start = self.next_index if self.count == capacity else 0
+        order = (start + numpy.arange(self.count)) % capacity
+        x = self.x_history[order]
+        y = self.y_history[order]
+        self.sum_x = x.sum()
+        self.sum_y = y.sum()
+        self.sum_xx = numpy.dot(x, x)
+        self.sum_yy = numpy.dot(y, y)
+        self.sum_xy = numpy.dot(x, y)
+        self.path_length = self.step_history[order[1:]].sum()
+        self.points_since_refresh = 0
+
+    # Estimate the orientation at every point of a recorded trajectory, given as arrays of x and y locations. This returns the same values as calling :meth:`estimate_car_orientation` with each point in turn on a freshly-created instance, but computes them all at once. It doesn't change this instance's history.
+    def estimate_trajectory(self, x, y):
+        x = numpy.asarray(x, dtype = numpy.float64)
+        y = numpy.asarray(y, dtype = numpy.float64)
+        length = len(x)
+        capacity = self.num_history_points
+        if length == 0:
+            return numpy.zeros(0)
+        # Point i's history runs from first[i] to i, holding count[i] points.
+        index = numpy.arange(length)
+        first = numpy.maximum(index - capacity + 1, 0)
+        count = index - first + 1
+
+        # Sum over each history by differencing cumulative sums.
+        def window_sum(values):
+            cumulative = numpy.concatenate(([0.0], numpy.cumsum(values)))
+            return cumulative[index + 1] - cumulative[first]
+        steps = numpy.concatenate(([0.0], numpy.hypot(numpy.diff(x), numpy.diff(y))))
+        # The steps within point i's history are those into points first[i] + 1 through i.
+        cumulative_steps = numpy.cumsum(steps)
+        path_length = cumulative_steps - cumulative_steps[first]
+        orientation = _fit_orientation(count, window_sum(x), window_sum(y), window_sum(x*x), window_sum(y*y),
+          window_sum(x*y), x - x[first], y - y[first])
+
+        # Where the car hasn't moved far enough, carry forward the last valid estimate, which starts at pi/2.
+        valid = path_length >= self.dist_threshold
+        last_valid = numpy.maximum.accumulate(numpy.where(valid, index, -1))
+        return numpy.where(last_valid >= 0, orientation[numpy.maximum(last_valid, 0)], pi/2.0)
+
+
+# Given the number of points, their sums, and the vector from the first to the last point, find the direction of the total least squares line through the points -- the line minimizing the perpendicular distance to each point. Unlike fitting y as a function of x, this handles vertical travel as easily as horizontal. The line's angle is half the angle of the vector (cxx - cyy, 2 cxy), where c is the covariance of the points. A line has two directions; pick the one closest to the direction of travel (from the first to the last point). Returns the angle in radians, measured counterclockwise from the x axis, with y increasing upward -- the opposite of image coordinates. This works on scalars or numpy arrays.
+def _fit_orientation(count, sum_x, sum_y, sum_xx, sum_yy, sum_xy, travel_x, travel_y):
+    mean_x = sum_x/count
+    mean_y = sum_y/count
+    cxx = sum_xx/count - mean_x*mean_x
+    cyy = sum_yy/count - mean_y*mean_y
+    cxy = sum_xy/count - mean_x*mean_y
+    angle = 0.5*numpy.arctan2(2.0*cxy, cxx - cyy)
+    direction_x = numpy.cos(angle)
+    direction_y = numpy.sin(angle)
+    flip = numpy.where(direction_x*travel_x + direction_y*travel_y < 0, -1.0, 1.0)
+    # Negate y, since image y increases downward.
+    orientation = numpy.arctan2(-flip*direction_y, flip*direction_x)
+    return float(orientation) if numpy.ndim(orientation) == 0 else orientation
 
-def profile():
-    import cProfile
-    import pstats
-    cProfile.run('main()', 'mainprof')
-    p = pstats.Stats('mainprof')
-    p.strip_dirs().sort_stats('time').print_stats(10)
 
+# To see where the time goes, use ``Webcam_Find_Car(stage_timing = True)``; see :mod:`stage_timers`.
 def main():
     wfc = Webcam_Find_Car()
     wfc.main()
 
 if __name__ == "__main__":
     main()
-#    profile()
 
 
 # .. _`grab an image`: http://docs.opencv.org/modules/highgui/doc/reading_and_writing_images_and_video.html#imread
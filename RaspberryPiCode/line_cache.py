@@ -0,0 +1,103 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# line_cache.py
+# *************
+# The lines painted on the arena don't move, yet :func:`find_line_distance` segments the line color on every frame, and the display rebuilds the distance map from it. This module keeps the lines found (a :class:`Line_Distance_Query`, which in turn keeps its distance map once computed) until the scene changes. Checking for a change is far cheaper than finding the lines: each frame is shrunk to a small grayscale image (about 80 pixels wide), which is compared against the same-size image of the frame the lines were found in. The lines are found again only when:
+#
+# - the line color or threshold change;
+# - more than a small fraction of the small image's pixels differ from the reference by more than a threshold, as when an obstacle is placed or the lighting changes; or
+# - phase correlation between the small images shows the camera has shifted by more than a pixel, as when it's bumped. A shift smaller than the change detector can see still moves every line.
+#
+# The car moves, of course, so its footprint -- a circle around its location -- is masked out of these checks, so that it can't trigger a change. Both its footprint in the current frame and its footprint in the reference frame are masked, since the floor it has since uncovered differs from the reference just as much.
+import cv2
+import numpy
+
+from stage_timers import timers
+
+
+class Static_Line_Cache(object):
+    # detect_width gives the width in pixels of the small images compared. A pixel has changed if its gray level differs from the reference by more than change_threshold; the scene has changed if more than changed_fraction of the pixels outside the car's footprint have. A camera shift of more than shake_threshold pixels, measured in the full image, also counts as a change. footprint_margin scales the radius of the car's footprint, to cover its shadow and the blur of its motion.
+    def __init__(self, detect_width = 80, change_threshold = 15, changed_fraction = 0.02, shake_threshold = 1.0, footprint_margin = 2.0):
+        self.detect_width = detect_width
+        self.change_threshold = change_threshold
+        self.changed_fraction = changed_fraction
+        self.shake_threshold = shake_threshold
+        self.footprint_margin = footprint_margin
+        self.reference = None
+        self.reference_footprint = None
+        self.window = None
+        self.key = None
+        self.line_distance = None
+        # Statistics: the number of frames which reused the cached lines, and the number which found them again, by reason.
+        self.hits = 0
+        self.misses = {'first': 0, 'settings': 0, 'changed': 0, 'shake': 0}
+
+    # Return the cached lines for image if the scene hasn't changed, or else call find_lines() to find them again, caching its result. key identifies the settings the lines depend on, such as the line color and threshold. car_footprint gives the car's (x, y, radius) in image's coordinates, or None if the car wasn't found.
+    def lookup(self, image, key, car_footprint, find_lines):
+        with timers.stage('line_cache_check'):
+            small = self.shrink(image)
+            scale = image.shape[1] / float(small.shape[1])
+            footprint = self.footprint_mask(small.shape, car_footprint, scale)
+            reason = self.change_reason(small, key, footprint, scale)
+        if reason is None:
+            self.hits += 1
+            return self.line_distance
+        self.misses[reason] += 1
+        self.line_distance = find_lines()
+        self.reference = small
+        self.reference_footprint = footprint
+        self.key = key
+        return self.line_distance
+
+    # Forget the cached lines, so the next :meth:`lookup` finds them again.
+    def invalidate(self):
+        self.reference = None
+
+    # Shrink image to a grayscale image detect_width pixels wide. Averaging each block of pixels also averages away most camera noise.
+    def shrink(self, image):
+        rows, cols = image.shape[0:2]
+        detect_height = max(int(round(rows*self.detect_width / float(cols))), 1)
+        # Converting to gray first leaves a third of the data to shrink, which is faster.
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return numpy.float32(cv2.resize(image, (self.detect_width, detect_height), interpolation = cv2.INTER_AREA))
+
+    # Return a mask which is non-zero over the car's footprint (see :meth:`lookup`) in an image of the given shape, where each pixel covers scale pixels of the full image.
+    def footprint_mask(self, shape, car_footprint, scale):
+        footprint = numpy.zeros(shape, dtype = numpy.uint8)
+        if car_footprint is not None:
+            x, y, radius = car_footprint
+            cv2.circle(footprint, (int(round(x/scale)), int(round(y/scale))), int(numpy.ceil(radius*self.footprint_margin/scale)), 1, -1)
+        return footprint
+
+    # Return None if the scene in small matches the reference, ignoring the car's footprint, or else the reason it doesn't. scale gives the size of a pixel of small, in pixels of the full image.
+    def change_reason(self, small, key, footprint, scale):
+        if self.reference is None or self.reference.shape != small.shape:
+            return 'first'
+        if key != self.key:
+            return 'settings'
+        # Hide the car by copying the reference over its footprints, now and in the reference.
+        footprint = footprint | self.reference_footprint
+        small = numpy.where(footprint != 0, self.reference, small)
+        diff = cv2.absdiff(small, self.reference)
+        changed = numpy.count_nonzero(diff > self.change_threshold)
+        if changed > self.changed_fraction*(small.size - numpy.count_nonzero(footprint)):
+            return 'changed'
+        if self.window is None or self.window.shape != small.shape:
+            self.window = cv2.createHanningWindow((small.shape[1], small.shape[0]), cv2.CV_32F)
+        # Some versions of OpenCV apply the window to the images in place, so pass copies to keep the reference intact.
+        (dx, dy), response = cv2.phaseCorrelate(self.reference.copy(), small.copy(), self.window)
+        if numpy.hypot(dx, dy)*scale > self.shake_threshold:
+            return 'shake'
+        return None
+
+    # The fraction of lookups which reused the cached lines.
+    @property
+    def hit_rate(self):
+        lookups = self.hits + sum(self.misses.values())
+        return self.hits / float(lookups) if lookups else 0.0
+
+    def report(self):
+        return "Line cache: %.1f%% hits (%d of %d); found again: %s" % (self.hit_rate*100.0, self.hits, self.hits + sum(self.misses.values()),
+                                                                       ", ".join("%d %s" % (count, reason) for reason, count in self.misses.items()))
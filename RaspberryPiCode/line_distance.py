@@ -0,0 +1,67 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# line_distance.py
+# ****************
+# To steer, the car needs only the distance from its own location to the nearest line or obstacle. Computing a distance transform gives this distance for every pixel in the frame, then throws away all but one. Instead, this module answers the question directly from the outlines (contours) of the lines: the distance from a point to a filled contour is zero inside the contour, or the distance to its nearest edge outside it, which ``cv2.pointPolygonTest`` computes.
+#
+# To avoid testing every contour, the bounding box of each contour is stored. The distance to a box is never more than the distance to the contour inside it, so contours are tested in order of the distance to their boxes, stopping once the next box is farther away than the closest contour found so far.
+#
+# The full distance map is still available from :meth:`Line_Distance_Query.dense_map`, but is only computed when something (such as a display) asks for it. A coarser, faster map is available from :meth:`Line_Distance_Query.coarse_map`, for uses (such as path planning) which need distances across the whole frame, but not to the pixel.
+import cv2
+import numpy
+
+
+class Line_Distance_Query(object):
+    # contours gives the outlines of the lines / obstacles, as returned by :func:`find_lab_color`; shape gives the (rows, columns) of the image they came from.
+    def __init__(self, contours, shape):
+        self.contours = contours
+        self.shape = tuple(shape[0:2])
+        rects = numpy.array([cv2.boundingRect(contour) for contour in contours], dtype = numpy.float64).reshape(-1, 4)
+        # Store each box as its left, top, right and bottom edges (inclusive).
+        self.x0 = rects[:, 0]
+        self.y0 = rects[:, 1]
+        self.x1 = rects[:, 0] + rects[:, 2] - 1
+        self.y1 = rects[:, 1] + rects[:, 3] - 1
+        self._dense_map = None
+        self._coarse_maps = {}
+
+    # Return the distance from the point x, y to the nearest line / obstacle, or None if the point lies outside the image (for example, the (-1, -1) returned when the car isn't found). This agrees with the :meth:`dense_map` to within a pixel.
+    def distance(self, x, y):
+        if x < 0 or y < 0 or x >= self.shape[1] or y >= self.shape[0] or not self.contours:
+            return None
+        # Find the distance to each box: zero along an axis where the point lies between the box's edges.
+        dx = numpy.maximum(numpy.maximum(self.x0 - x, x - self.x1), 0.0)
+        dy = numpy.maximum(numpy.maximum(self.y0 - y, y - self.y1), 0.0)
+        box_dist = numpy.hypot(dx, dy)
+        best = numpy.inf
+        point = (float(x), float(y))
+        for index in numpy.argsort(box_dist):
+            if box_dist[index] >= best:
+                break
+            # pointPolygonTest returns a positive distance inside the contour, negative outside, and zero on an edge.
+            signed_dist = cv2.pointPolygonTest(self.contours[index], point, True)
+            if signed_dist >= 0:
+                return 0.0
+            best = min(best, -signed_dist)
+        return best
+
+    # Return the distance from every pixel to the nearest line / obstacle, computing it on first use.
+    def dense_map(self):
+        if self._dense_map is None:
+            # Zero all pixels in the found contours for use with the distance map
+            dist_image_in = numpy.empty(self.shape, dtype = numpy.uint8)
+            dist_image_in.fill(255)
+            cv2.drawContours(dist_image_in, self.contours, -1, 0, cv2.FILLED)
+            self._dense_map = cv2.distanceTransform(dist_image_in, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+        return self._dense_map
+
+    # Return the distance from every pixel of the image shrunk by factor (an integer) to the nearest line / obstacle, measured in pixels of the full image and computed on first use. The distances are accurate to within about factor pixels; for a factor of 2, this takes about a fifth of the time of :meth:`dense_map`.
+    def coarse_map(self, factor):
+        if factor not in self._coarse_maps:
+            rows, cols = self.shape
+            dist_image_in = numpy.empty((-(-rows // factor), -(-cols // factor)), dtype = numpy.uint8)
+            dist_image_in.fill(255)
+            cv2.drawContours(dist_image_in, [contour // factor for contour in self.contours], -1, 0, cv2.FILLED)
+            self._coarse_maps[factor] = cv2.distanceTransform(dist_image_in, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)*factor
+        return self._coarse_maps[factor]
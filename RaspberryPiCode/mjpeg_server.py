@@ -0,0 +1,152 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# mjpeg_server.py
+# ***************
+# On the robot, the vision code runs headless, so there's no window to watch. This module serves a preview instead, as an MJPEG stream over HTTP, which any browser can show: browse to ``http://<robot>:8080/`` from a laptop on the same network. The paths served are:
+#
+# ``/``
+#   A page showing the stream.
+# ``/stream.mjpg``
+#   The stream itself: a ``multipart/x-mixed-replace`` response, each part a JPEG image.
+# ``/snapshot.jpg``
+#   The latest image, as a single JPEG.
+#
+# Encoding a JPEG takes a few milliseconds, so it's throttled: images are encoded only while someone is watching, no more than max_fps times a second, and each image is encoded once however many clients are watching. Images are published from the render thread (see :mod:`render_thread`), so even this work stays out of the control loop. Each client is served by its own thread, which waits for the next encoded image, so a slow client delays only itself.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import cv2
+
+_BOUNDARY = 'frame'
+_PAGE = b"""<html><head><title>Car preview</title></head>
+<body style="margin: 0; background: black"><img src="/stream.mjpg" style="width: 100%"></body></html>
+"""
+
+
+class _Mjpeg_Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server.preview
+        if self.path == '/':
+            self.send_body(_PAGE, 'text/html')
+        elif self.path == '/snapshot.jpg':
+            # Images are only encoded while someone watches, so watch until the next one.
+            server.add_client()
+            try:
+                seq, jpeg = server.wait_jpeg(None, server.client_timeout)
+            finally:
+                server.remove_client()
+            if jpeg is None:
+                self.send_error(503, 'No image yet')
+            else:
+                self.send_body(jpeg, 'image/jpeg')
+        elif self.path == '/stream.mjpg':
+            self.stream(server)
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, server):
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=' + _BOUNDARY)
+        self.end_headers()
+        server.add_client()
+        try:
+            seq = 0
+            while True:
+                seq, jpeg = server.wait_jpeg(seq, server.client_timeout)
+                if jpeg is None:
+                    # Closed, or nothing published for a while; in the latter case, keep waiting.
+                    if server.closed:
+                        break
+                    continue
+                self.wfile.write(('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (_BOUNDARY, len(jpeg))).encode('ascii'))
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away.
+            pass
+        finally:
+            server.remove_client()
+
+    # Don't log every request to the console, which the vision code uses for its own status.
+    def log_message(self, format, *args):
+        pass
+
+
+class Mjpeg_Server(object):
+    # Serve on the given port and host; the default host accepts connections on every network interface, so a laptop can watch. A port of 0 picks a free port; see :attr:`port`. Images are encoded at most max_fps times a second, with the given JPEG quality (0 to 100). Clients waiting for an image give up after client_timeout seconds, then try again.
+    def __init__(self, port = 8080, host = '0.0.0.0', max_fps = 10.0, quality = 70, client_timeout = 1.0):
+        self.max_fps = max_fps
+        self.quality = quality
+        self.client_timeout = client_timeout
+        self.closed = False
+        self._cond = threading.Condition()
+        self._jpeg = None
+        self._seq = 0
+        self._last_encode = None
+        self.clients = 0
+        # Statistics
+        self.published = 0
+        self.encoded = 0
+        self.encode_ms = 0.0
+        self.httpd = ThreadingHTTPServer((host, port), _Mjpeg_Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.preview = self
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target = self.httpd.serve_forever, name = "mjpeg_server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_client(self):
+        with self._cond:
+            self.clients += 1
+
+    def remove_client(self):
+        with self._cond:
+            self.clients -= 1
+
+    # Offer image (a BGR image) to the clients. It's encoded only if a client is watching and max_fps allows; otherwise, it's dropped.
+    def publish(self, image):
+        self.published += 1
+        now = time.monotonic()
+        if not self.clients or (self._last_encode is not None and now - self._last_encode < 1.0/self.max_fps):
+            return
+        self._last_encode = now
+        success_flag, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        self.encode_ms += (time.monotonic() - now)*1000.0
+        if not success_flag:
+            return
+        self.encoded += 1
+        with self._cond:
+            self._jpeg = jpeg.tobytes()
+            self._seq += 1
+            self._cond.notify_all()
+
+    # Wait up to timeout seconds for an image newer than seq (or, if seq is None, newer than the current image), then return ``(seq, jpeg)`` for the newest image, or ``(seq, None)`` if there's none (or the server closed).
+    def wait_jpeg(self, seq, timeout):
+        with self._cond:
+            if seq is None:
+                seq = self._seq
+            if not self._cond.wait_for(lambda: self._seq > seq or self.closed, timeout) or self.closed:
+                return seq, None
+            return self._seq, self._jpeg
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def report(self):
+        return "Preview: %d of %d images encoded, mean %.2f ms each" % (self.encoded, self.published, self.encode_ms/self.encoded if self.encoded else 0.0)
@@ -0,0 +1,167 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# multi_object_tracker.py
+# ***********************
+# :func:`find_car` finds only the largest blob of one color, so following every object in the arena -- cars, balls and markers of several colors -- would take a full pass over the frame per object. This module finds and follows all of them at once. Each frame is converted to HSV once, then a :class:`Hsv_Label_Map` classifies every pixel against every color in a single pass. For each color, the blobs of that color (see :mod:`blob_engine`) are the detections; the number of blobs per color doesn't change the cost of finding them.
+#
+# Each detection is then matched with a track from earlier frames, so that an object keeps the same ID from frame to frame. Matching uses a cost matrix holding the distance from each track's predicted position to each detection of the same color. The cheapest pairs are taken first (a greedy assignment), skipping any pair too far apart to be the same object. Unmatched detections start new tracks; a track which goes unmatched for too many frames is dropped.
+#
+# Run this file to track objects in a recording or from a webcam::
+#
+#   python multi_object_tracker.py recording.avi --display
+import argparse
+from collections import namedtuple
+import time
+
+import cv2
+import numpy
+
+from blob_engine import open_and_find_blobs
+from hsv_label_map import Hsv_Label_Map, ARENA_COLORS
+from jones_webcam_opencv_code import OPEN_ELEMENT, OPEN_ITERATIONS, draw_str, round_int
+
+# One object's track. id is unique to this track; name is the color's name. position is the (x, y) center of the object, and velocity its motion in pixels per frame. area (in pixels) and bbox (x, y, width, height) describe the latest detection. age counts the frames since the track began; missed counts the frames since it was last detected, so it's 0 when the object was found in this frame.
+Track = namedtuple('Track', 'id name position velocity area bbox age missed')
+
+
+class Multi_Object_Tracker(object):
+    # color_models is a list of ``(name, ranges)`` pairs, as for :class:`Hsv_Label_Map`. Blobs smaller than min_area pixels are ignored, and at most max_per_color of the largest blobs of each color are tracked. A detection farther than max_distance pixels from a track's predicted position can't match that track. A track is dropped after max_missed frames without a match. velocity_smoothing gives the weight of each new motion in the track's velocity.
+    def __init__(self, color_models = ARENA_COLORS, min_area = 30, max_per_color = 4, max_distance = 40.0, max_missed = 5, velocity_smoothing = 0.5):
+        self.label_map = Hsv_Label_Map(color_models)
+        self.min_area = min_area
+        self.max_per_color = max_per_color
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.velocity_smoothing = velocity_smoothing
+        self.tracks = []
+        self.next_id = 1
+        # The label image from the last frame.
+        self.labels = None
+
+    # Find the blobs of each color in the given BGR image, returning a dict from color name to :class:`Blobs`.
+    def detect(self, image):
+        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        self.labels = self.label_map.segment(hsv_image)
+        detections = {}
+        for name in self.label_map.names:
+            mask = cv2.compare(self.labels, self.label_map.label(name), cv2.CMP_EQ)
+            detections[name] = open_and_find_blobs(mask, OPEN_ELEMENT, OPEN_ITERATIONS, self.min_area, self.max_per_color)
+        return detections
+
+    # Find the objects in the given BGR image and update the tracks, returning the list of current tracks, including those which weren't detected in this frame.
+    def update(self, image):
+        detections = self.detect(image)
+        tracks = []
+        for name, blobs in detections.items():
+            tracks.extend(self.associate([track for track in self.tracks if track.name == name], name, blobs))
+        self.tracks = tracks
+        return tracks
+
+    # Match the existing tracks of one color with the blobs of that color found in this frame, returning the updated tracks.
+    def associate(self, tracks, name, blobs):
+        matches = greedy_assignment(self.cost_matrix(tracks, blobs), self.max_distance)
+        updated = []
+        matched_tracks = set()
+        matched_blobs = set()
+        for track_index, blob_index in matches:
+            track = tracks[track_index]
+            position = tuple(blobs.centroids[blob_index])
+            motion = (position[0] - track.position[0], position[1] - track.position[1])
+            alpha = self.velocity_smoothing
+            velocity = tuple(alpha*m + (1.0 - alpha)*v for m, v in zip(motion, track.velocity))
+            updated.append(track._replace(position = position, velocity = velocity, area = int(blobs.areas[blob_index]),
+                                          bbox = tuple(blobs.bboxes[blob_index]), age = track.age + 1, missed = 0))
+            matched_tracks.add(track_index)
+            matched_blobs.add(blob_index)
+        # Coast unmatched tracks along their velocity, dropping those missed for too long.
+        for track_index, track in enumerate(tracks):
+            if track_index not in matched_tracks and track.missed < self.max_missed:
+                updated.append(track._replace(position = predict(track), age = track.age + 1, missed = track.missed + 1))
+        # Start a track for each unmatched blob.
+        for blob_index in range(len(blobs)):
+            if blob_index not in matched_blobs:
+                updated.append(Track(self.next_id, name, tuple(blobs.centroids[blob_index]), (0.0, 0.0),
+                                     int(blobs.areas[blob_index]), tuple(blobs.bboxes[blob_index]), 1, 0))
+                self.next_id += 1
+        return updated
+
+    # Return the matrix of distances from each track's predicted position (rows) to each blob (columns).
+    def cost_matrix(self, tracks, blobs):
+        if not tracks or not len(blobs):
+            return numpy.zeros((len(tracks), len(blobs)))
+        predicted = numpy.array([predict(track) for track in tracks])
+        difference = predicted[:, numpy.newaxis, :] - blobs.centroids[numpy.newaxis, :, :]
+        return numpy.hypot(difference[:, :, 0], difference[:, :, 1])
+
+
+# The position a track is expected to have in the next frame.
+def predict(track):
+    return (track.position[0] + track.velocity[0], track.position[1] + track.velocity[1])
+
+
+# Given a cost matrix, return a list of (row, column) pairs, taking the cheapest pairs first, with each row and column used at most once. Pairs costing more than max_cost aren't matched. This isn't always the cheapest total assignment, but with objects spread out relative to their motion between frames it nearly always is, and it avoids solving the full assignment problem.
+def greedy_assignment(cost, max_cost):
+    rows, cols = cost.shape
+    if rows == 0 or cols == 0:
+        return []
+    order = numpy.argsort(cost, axis = None, kind = 'stable')
+    row_used = numpy.zeros(rows, dtype = bool)
+    col_used = numpy.zeros(cols, dtype = bool)
+    matches = []
+    for flat_index in order:
+        if cost.flat[flat_index] > max_cost or len(matches) == min(rows, cols):
+            break
+        row, col = divmod(int(flat_index), cols)
+        if not row_used[row] and not col_used[col]:
+            row_used[row] = col_used[col] = True
+            matches.append((row, col))
+    return matches
+
+
+# Draw each track's box, ID and color name on image. Tracks not detected in this frame are drawn in gray.
+def draw_tracks(image, tracks):
+    for track in tracks:
+        x, y, w, h = track.bbox
+        color = (0, 255, 255) if track.missed == 0 else (128, 128, 128)
+        if track.missed == 0:
+            cv2.rectangle(image, (int(x), int(y)), (int(x + w), int(y + h)), color, 2)
+        cv2.circle(image, round_int(track.position), 3, color, -1)
+        draw_str(image, (int(x), max(int(y) - 5, 10)), "%d %s" % (track.id, track.name))
+
+
+def main():
+    from frame_sources import open_frame_source
+    parser = argparse.ArgumentParser(description = 'Track the colored objects in the arena.')
+    parser.add_argument('source', nargs = '?', default = '0', help = 'A webcam index, video file, or directory of images.')
+    parser.add_argument('--display', action = 'store_true', help = 'Show the tracks in a window.')
+    parser.add_argument('--min-area', type = int, default = 30, help = 'Ignore blobs smaller than this many pixels.')
+    args = parser.parse_args()
+
+    source = open_frame_source(args.source)
+    tracker = Multi_Object_Tracker(min_area = args.min_area)
+    frame_times = []
+    while True:
+        success_flag, image = source.read()
+        if not success_flag:
+            break
+        sz = image.shape
+        image = cv2.resize(image, (int(sz[1]/2), int(sz[0]/2)))
+        start = time.perf_counter()
+        tracks = tracker.update(image)
+        frame_times.append(time.perf_counter() - start)
+        if args.display:
+            draw_tracks(image, tracks)
+            cv2.imshow("tracks", image)
+            if cv2.waitKey(1) != -1:
+                break
+        else:
+            print(", ".join("%d %s (%.0f, %.0f)" % (track.id, track.name, track.position[0], track.position[1])
+                            for track in tracks if track.missed == 0))
+    source.release()
+    if frame_times:
+        print("%d frames, mean %.2f ms per frame, %d tracks started" %
+              (len(frame_times), numpy.mean(frame_times)*1000.0, tracker.next_id - 1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# parallel_color.py
+# *****************
+# :func:`find_lab_color` thresholds and cleans up the whole frame on one core. This module splits that work into horizontal stripes, processing each on a thread from a pool; OpenCV and most large NumPy operations release Python's global interpreter lock (GIL), so these threads run in parallel on separate cores. The cleaned-up stripes are then joined back into one image before finding the contours, so a contour crossing a stripe boundary isn't split.
+#
+# Thresholding treats each pixel on its own, but the morphological open (see :func:`open_mask`) makes each pixel depend on its neighbors up to :data:`OPEN_RADIUS` rows away. So each stripe is processed along with this many rows from the stripes above and below it, and only its own rows are kept. The result is then identical, bit for bit, to processing the whole frame at once.
+#
+# Run this file to check that the results match and to report the speedup using 1 to 4 threads::
+#
+#   python parallel_color.py recording.avi --config settings.json
+#
+# With ``--check``, it only checks that the results match, for several numbers of stripes (see :func:`check_stripes`), exiting with a non-zero status if any differ.
+#
+# OpenCV may itself split some operations across cores; ``--opencv-threads 1`` turns this off, to show the effect of the stripes alone.
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import time
+
+import cv2
+import numpy
+
+from jones_webcam_opencv_code import threshold_lab_color, open_mask, find_lab_color, im_to_lab, OPEN_RADIUS
+from stage_timers import timers
+
+
+class Stripe_Color_Finder(object):
+    # workers gives the number of threads used; stripes gives the number of stripes each frame is split into, which defaults to workers. lut is an optional :class:`Color_Lut`, as for :func:`find_lab_color`.
+    def __init__(self, workers = 4, stripes = None, lut = None):
+        self.workers = workers
+        self.stripes = stripes or workers
+        self.lut = lut
+        self.pool = ThreadPoolExecutor(workers) if workers > 1 else None
+
+    # Return the (start, end) rows of each stripe of an image with the given number of rows.
+    def stripe_bounds(self, rows):
+        edges = numpy.linspace(0, rows, self.stripes + 1).astype(int)
+        return [(start, end) for start, end in zip(edges[:-1], edges[1:]) if end > start]
+
+    # Return the thresholded and opened image, the same as :func:`find_lab_color` computes before finding contours.
+    def mask(self, lab_image, color, thresh):
+        rows = lab_image.shape[0]
+        # Build the table now, rather than in several threads at once.
+        if self.lut is not None:
+            self.lut.prepare(color, thresh)
+        open_image = numpy.empty(lab_image.shape[0:2], dtype = numpy.uint8)
+
+        def process_stripe(bounds):
+            start, end = bounds
+            # Include the neighboring rows which affect this stripe's result.
+            low = max(start - OPEN_RADIUS, 0)
+            high = min(end + OPEN_RADIUS, rows)
+            stripe = open_mask(threshold_lab_color(lab_image[low:high], color, thresh, self.lut))
+            open_image[start:end] = stripe[start - low:end - low]
+        bounds = self.stripe_bounds(rows)
+        if self.pool is None:
+            for stripe_bounds in bounds:
+                process_stripe(stripe_bounds)
+        else:
+            # Wait for every stripe; this also raises any exception from a thread.
+            for result in self.pool.map(process_stripe, bounds):
+                pass
+        return open_image
+
+    # Find the contours of the given color, as :func:`find_lab_color` does.
+    def find_lab_color(self, lab_image, color, thresh):
+        assert(color.dtype == numpy.float32)
+        with timers.stage('stripe_mask'):
+            open_image = self.mask(lab_image, color, thresh)
+        with timers.stage('contours'):
+            # OpenCV 3 returns the image as well as the contours and hierarchy; later versions don't.
+            contours = cv2.findContours(open_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        return contours
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+# Find the given color in every frame, first with :func:`find_lab_color` then with a :class:`Stripe_Color_Finder` using 1 to max_workers threads. Returns a list of dicts, one per number of threads, giving the mean time per frame in milliseconds, the speedup over :func:`find_lab_color`, and whether every result matched it exactly. The frames should already be shrunk as :meth:`Webcam_Find_Car.grab_frame` does.
+def benchmark(frames, color, thresh, lut = None, max_workers = 4, repeat = 3):
+    if lut is None:
+        lab_frames = [im_to_lab(frame) for frame in frames]
+    else:
+        lab_frames = frames
+        lut.prepare(color, thresh)
+
+    # Return the mean time per frame of the fastest of repeat passes, plus the contours found in each frame.
+    def time_frames(find):
+        best = None
+        for index in range(repeat):
+            start = time.perf_counter()
+            contours = [find(lab_frame, color, thresh) for lab_frame in lab_frames]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best*1000.0 / len(lab_frames), contours
+
+    serial_ms, serial_contours = time_frames(lambda lab_image, color, thresh: find_lab_color(lab_image, color, thresh, lut))
+    results = [{'workers': 0, 'ms_per_frame': serial_ms, 'speedup': 1.0, 'identical': True}]
+    for workers in range(1, max_workers + 1):
+        finder = Stripe_Color_Finder(workers, lut = lut)
+        ms, contours = time_frames(finder.find_lab_color)
+        identical = all(_same_mask(finder, lab_frame, color, thresh, lut) for lab_frame in lab_frames)
+        identical = identical and all(_same_contours(a, b) for a, b in zip(contours, serial_contours))
+        finder.close()
+        results.append({'workers': workers, 'ms_per_frame': ms, 'speedup': serial_ms / ms, 'identical': identical})
+    return results
+
+
+# Check that a :class:`Stripe_Color_Finder` finds exactly what :func:`find_lab_color` finds in every frame, splitting the frames into each of stripe_counts stripes, on workers threads. The frames should already be shrunk as :meth:`Webcam_Find_Car.grab_frame` does. Returns a list of the stripe counts whose masks or contours differed in any frame; an empty list means all matched.
+def check_stripes(frames, color, thresh, lut = None, stripe_counts = (1, 2, 3, 4, 7), workers = 2):
+    lab_frames = frames if lut is not None else [im_to_lab(frame) for frame in frames]
+    expected = [find_lab_color(lab_frame, color, thresh, lut) for lab_frame in lab_frames]
+    failed = []
+    for stripes in stripe_counts:
+        finder = Stripe_Color_Finder(workers, stripes, lut)
+        if not all(_same_mask(finder, lab_frame, color, thresh, lut) and _same_contours(finder.find_lab_color(lab_frame, color, thresh), contours)
+                   for lab_frame, contours in zip(lab_frames, expected)):
+            failed.append(stripes)
+        finder.close()
+    return failed
+
+# The contours are identical only if the masks are, so compare those too.
+def _same_mask(finder, lab_image, color, thresh, lut):
+    return numpy.array_equal(finder.mask(lab_image, color, thresh), open_mask(threshold_lab_color(lab_image, color, thresh, lut)))
+
+def _same_contours(a, b):
+    return len(a) == len(b) and all(numpy.array_equal(c, d) for c, d in zip(a, b))
+
+
+def main():
+    from frame_sources import open_frame_source, read_all_frames
+    from process_pipeline import load_settings
+    parser = argparse.ArgumentParser(description = 'Compare finding a color in stripes on several threads with finding it in the whole frame.')
+    parser.add_argument('recording', help = 'A video file or a directory of images.')
+    parser.add_argument('--config', help = 'A JSON settings file; see Webcam_Find_Car.load_config.')
+    parser.add_argument('--max-frames', type = int, default = 100, help = 'Use at most this many frames of the recording.')
+    parser.add_argument('--max-workers', type = int, default = 4, help = 'Test from 1 to this many threads.')
+    parser.add_argument('--full-size', action = 'store_true', help = 'Don\'t shrink the frames to half size first.')
+    parser.add_argument('--lut', action = 'store_true', help = 'Classify colors using a lookup table.')
+    parser.add_argument('--opencv-threads', type = int, help = 'Limit the threads OpenCV uses internally.')
+    parser.add_argument('--check', action = 'store_true', help = 'Only check that the results match find_lab_color, for 1, 2, 3, 4 and 7 stripes.')
+    args = parser.parse_args()
+    if args.opencv_threads is not None:
+        cv2.setNumThreads(args.opencv_threads)
+
+    frames = read_all_frames(open_frame_source(args.recording), args.max_frames)
+    if not args.full_size:
+        frames = [cv2.resize(frame, (frame.shape[1] // 2, frame.shape[0] // 2)) for frame in frames]
+    settings = load_settings(args.config)
+    lut = None
+    if args.lut:
+        from color_lut import Color_Lut
+        lut = Color_Lut()
+    print("%d frames of %dx%d" % (len(frames), frames[0].shape[1], frames[0].shape[0]))
+    if args.check:
+        matched = True
+        for name in ('target', 'line'):
+            failed = check_stripes(frames, settings[name + '_color'], settings[name + '_threshold'], lut)
+            print("The %s color: %s" % (name, "identical to find_lab_color" if not failed else
+                                        "DIFFERENT from find_lab_color with %s stripes" % ", ".join(str(stripes) for stripes in failed)))
+            matched = matched and not failed
+        return 0 if matched else 1
+    for name in ('target', 'line'):
+        print("Finding the %s color:" % name)
+        for result in benchmark(frames, settings[name + '_color'], settings[name + '_threshold'], lut, args.max_workers):
+            print("  %s: %.2f ms per frame, speedup %.2f, %s" % (
+                  "%d threads" % result['workers'] if result['workers'] else "find_lab_color",
+                  result['ms_per_frame'], result['speedup'],
+                  "identical" if result['identical'] else "DIFFERENT"))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# path_planner.py
+# ***************
+# :meth:`Update_Mock.control` steers straight at the target, ignoring the lines and obstacles in between. This module instead plans a path around them, then steers toward a point a short way along this path.
+#
+# The frame is divided into a grid of square cells. Each cell's cost comes from the distance map of the lines found; since the cells are several pixels wide, a coarse map (see :meth:`Line_Distance_Query.coarse_map`) is accurate enough, and far faster to compute than the full one. A cell closer to a line than the car's radius is blocked; a cell within safe_distance of a line costs more to cross the closer it is, so the planned path keeps its distance where it can. The cost of a step from one cell to a neighbor (including diagonals) is the step's length times the cost of the cell entered.
+#
+# Replanning from scratch each frame would waste time, since from one frame to the next the car moves a few pixels, while the lines and the target rarely change. So paths are planned with D* Lite [Koenig2002]_, which searches outward from the goal and keeps its results; when the car moves, or cell costs change, only the part of the search these changes affect is repaired. When the target moves to a neighboring cell (say, when following a moving ball), the old goal cell loses its zero cost-to-go and the new one gains it, which the same repair handles (as in Basic Moving Target D* Lite [Sun2010]_). Every cost-to-go depends on the goal, though, so after a longer move the repair redoes the whole search, taking about twice as long as starting afresh; the planner therefore starts afresh instead.
+#
+# To keep each frame's planning time bounded, each call expands at most max_expansions cells. A search which needs more (the first, or one after the target moves) continues on the following frames; until it finishes there's no path, and :attr:`Grid_Planner.searching` is True.
+#
+# .. [Koenig2002] S. Koenig and M. Likhachev, "D* Lite," AAAI 2002.
+# .. [Sun2010] X. Sun, W. Yeoh and S. Koenig, "Moving Target D* Lite," AAMAS 2010.
+from heapq import heappush, heappop
+from math import hypot
+import time
+
+import cv2
+import numpy
+
+INFINITY = float('inf')
+# The (row, column) offsets of a cell's eight neighbors.
+_NEIGHBOR_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+# D* Lite tests path costs for equality and breaks ties between keys on them, which rounding errors upset. So costs are kept to whole numbers: steps are measured in tenths of a cell (rounding a diagonal to 14), and cell costs in eighths.
+_STRAIGHT_STEP = 10
+_DIAGONAL_STEP = 14
+_COST_SCALE = 8
+
+
+class Grid_Planner(object):
+    # cell_size gives the width of a grid cell in pixels. A cell whose center lies within car_radius pixels of a line is blocked. The cost of a cell within safe_distance pixels of a line rises from 1 up to 1 + clearance_weight as the distance falls to car_radius. The car steers toward the point lookahead pixels along the path. The distance map used is shrunk by map_factor (an integer). A goal which moves by at most goal_repair_cells cells is repaired; a longer move starts a new search. Each call expands at most max_expansions cells.
+    def __init__(self, cell_size = 8, car_radius = 10.0, safe_distance = 40.0, clearance_weight = 4.0, lookahead = 40.0, map_factor = 2, goal_repair_cells = 1, max_expansions = 250):
+        self.cell_size = cell_size
+        self.car_radius = car_radius
+        self.safe_distance = safe_distance
+        self.clearance_weight = clearance_weight
+        self.lookahead = lookahead
+        self.map_factor = map_factor
+        self.goal_repair_cells = goal_repair_cells
+        self.max_expansions = max_expansions
+        # The grid's (rows, columns); None until lines are first found.
+        self.grid_shape = None
+        self.line_distance = None
+        self.path = None
+        self.searching = False
+        # Statistics
+        self.expansions = 0
+        self.restarts = 0
+        self.plans = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    # The cell containing pixel x, y.
+    def cell(self, xy):
+        rows, cols = self.grid_shape
+        col = min(max(int(xy[0] // self.cell_size), 0), cols - 1)
+        row = min(max(int(xy[1] // self.cell_size), 0), rows - 1)
+        return row*cols + col
+
+    # The pixel at the center of a cell.
+    def cell_center(self, s):
+        row, col = divmod(s, self.grid_shape[1])
+        return ((col + 0.5)*self.cell_size, (row + 0.5)*self.cell_size)
+
+    # Return the cost of each cell in a frame of the given (rows, columns), given the distance in pixels from each pixel of the frame, shrunk by map_factor, to the nearest line.
+    def cell_costs(self, dist_image, shape):
+        rows = -(-shape[0] // self.cell_size)
+        cols = -(-shape[1] // self.cell_size)
+        # Sample the distance at each cell's center.
+        centers_y = numpy.minimum((numpy.arange(rows) + 0.5)*self.cell_size / self.map_factor, dist_image.shape[0] - 1).astype(int)
+        centers_x = numpy.minimum((numpy.arange(cols) + 0.5)*self.cell_size / self.map_factor, dist_image.shape[1] - 1).astype(int)
+        clearance = dist_image[numpy.ix_(centers_y, centers_x)]
+        closeness = numpy.clip((self.safe_distance - clearance) / (self.safe_distance - self.car_radius), 0.0, 1.0)
+        costs = numpy.round(_COST_SCALE*(1.0 + self.clearance_weight*closeness**2))
+        costs[clearance < self.car_radius] = INFINITY
+        return costs
+
+    # Build a grid with the given cell costs, then start a new search.
+    def build_grid(self, costs):
+        self.grid_shape = costs.shape
+        rows, cols = costs.shape
+        self.costs = costs.ravel().tolist()
+        self.cell_rows, self.cell_cols = numpy.divmod(numpy.arange(rows*cols), cols)
+        # Each cell's neighbors, with the length of the step to each.
+        self.neighbors = []
+        for row in range(rows):
+            for col in range(cols):
+                cell_neighbors = []
+                for dr, dc in _NEIGHBOR_OFFSETS:
+                    r, c = row + dr, col + dc
+                    if 0 <= r < rows and 0 <= c < cols:
+                        cell_neighbors.append((r*cols + c, _DIAGONAL_STEP if dr and dc else _STRAIGHT_STEP))
+                self.neighbors.append(cell_neighbors)
+        self.restart()
+
+    # Discard the search, keeping the grid.
+    def restart(self):
+        count = len(self.costs)
+        # g gives each cell's cost-to-go found so far; rhs gives the cost-to-go through its best neighbor. A cell is consistent when the two agree.
+        self.g = [INFINITY]*count
+        self.rhs = [INFINITY]*count
+        # The priority queue holds (key, cell) entries for the inconsistent cells. Rather than removing or updating an entry in place, queued maps each queued cell to its current key; entries whose key doesn't match are stale and skipped.
+        self.queue = []
+        self.queued = {}
+        self.km = 0
+        self.start = None
+        self.last_start = None
+        self.goal = None
+        # The heuristic from the start to each cell.
+        self.h = None
+
+    # Use the lines described by line_distance (a :class:`Line_Distance_Query`, or None if no lines were found). Cells whose cost changed are repaired, rather than replanning.
+    def set_obstacles(self, line_distance):
+        self.line_distance = line_distance
+        if line_distance is not None:
+            dist_image = line_distance.coarse_map(self.map_factor) if self.map_factor > 1 else line_distance.dense_map()
+            costs = self.cell_costs(dist_image, line_distance.shape)
+        elif self.grid_shape is not None:
+            # With no lines, every cell is clear.
+            costs = numpy.full(self.grid_shape, float(_COST_SCALE))
+        else:
+            return
+        if self.grid_shape != costs.shape:
+            self.build_grid(costs)
+            return
+        new_costs = costs.ravel().tolist()
+        changed = numpy.flatnonzero(costs.ravel() != numpy.array(self.costs))
+        for v in changed.tolist():
+            old_cost = self.costs[v]
+            self.costs[v] = new_costs[v]
+            if self.goal is None:
+                continue
+            # Every step into v changes cost.
+            for u, step in self.neighbors[v]:
+                if u == self.goal:
+                    continue
+                c_old = step*old_cost
+                c_new = step*self.costs[v]
+                if c_old > c_new:
+                    self.rhs[u] = min(self.rhs[u], c_new + self.g[v])
+                elif self.rhs[u] == c_old + self.g[v]:
+                    self.rhs[u] = self.best_rhs(u)
+                self.update_vertex(u)
+
+    # The octile distance between two cells, at the lowest cost per step; this never overestimates the cost of a path.
+    def heuristic(self, a, b):
+        cols = self.grid_shape[1]
+        dr = abs(a // cols - b // cols)
+        dc = abs(a % cols - b % cols)
+        return _COST_SCALE*(_STRAIGHT_STEP*max(dr, dc) + (_DIAGONAL_STEP - _STRAIGHT_STEP)*min(dr, dc))
+
+    # Move the start to cell start. Every key depends on the heuristic from the start; rather than re-keying the queue, D* Lite adds the heuristic distance moved to all later keys.
+    def move_start(self, start):
+        if start == self.start:
+            return
+        if self.start is not None:
+            self.km += self.heuristic(self.last_start, start)
+        self.start = self.last_start = start
+        # Computing the heuristic to every cell at once is far faster than computing it for each key.
+        row, col = divmod(start, self.grid_shape[1])
+        dr = numpy.abs(self.cell_rows - row)
+        dc = numpy.abs(self.cell_cols - col)
+        self.h = (_COST_SCALE*(_STRAIGHT_STEP*numpy.maximum(dr, dc) + (_DIAGONAL_STEP - _STRAIGHT_STEP)*numpy.minimum(dr, dc))).tolist()
+
+    # Move the goal to cell goal. The old goal's cost-to-go is no longer zero, and the new goal's is.
+    def move_goal(self, goal):
+        old_goal = self.goal
+        self.goal = goal
+        if old_goal is not None:
+            self.rhs[old_goal] = self.best_rhs(old_goal)
+            self.update_vertex(old_goal)
+        self.rhs[goal] = 0
+        self.update_vertex(goal)
+
+    def calculate_key(self, s):
+        m = min(self.g[s], self.rhs[s])
+        return (m + self.h[s] + self.km, m)
+
+    # The lowest cost of reaching the goal from s through one of its neighbors.
+    def best_rhs(self, s):
+        costs = self.costs
+        g = self.g
+        return min(step*costs[n] + g[n] for n, step in self.neighbors[s])
+
+    def update_vertex(self, u):
+        if self.g[u] != self.rhs[u]:
+            key = self.calculate_key(u)
+            if self.queued.get(u) != key:
+                self.queued[u] = key
+                heappush(self.queue, (key, u))
+        else:
+            self.queued.pop(u, None)
+
+    # Return the smallest current key in the queue, dropping stale entries from its top.
+    def top_key(self):
+        queue = self.queue
+        while queue:
+            key, u = queue[0]
+            if self.queued.get(u) == key:
+                return key
+            heappop(queue)
+        return (INFINITY, INFINITY)
+
+    # Expand cells until the start's cost-to-go is known, or max_expansions cells have been expanded. Return True if the search finished.
+    def compute_shortest_path(self, max_expansions):
+        g = self.g
+        rhs = self.rhs
+        costs = self.costs
+        start = self.start
+        for expansion in range(max_expansions):
+            if not (self.top_key() < self.calculate_key(start) or rhs[start] > g[start]):
+                return True
+            k_old, u = heappop(self.queue)
+            del self.queued[u]
+            self.expansions += 1
+            k_new = self.calculate_key(u)
+            if k_old < k_new:
+                self.queued[u] = k_new
+                heappush(self.queue, (k_new, u))
+            elif g[u] > rhs[u]:
+                g[u] = rhs[u]
+                for s, step in self.neighbors[u]:
+                    if s != self.goal:
+                        rhs[s] = min(rhs[s], step*costs[u] + g[u])
+                        self.update_vertex(s)
+            else:
+                g_old = g[u]
+                g[u] = INFINITY
+                for s, step in self.neighbors[u] + [(u, None)]:
+                    if s != self.goal and (step is None or rhs[s] == step*costs[u] + g_old):
+                        rhs[s] = self.best_rhs(s)
+                    self.update_vertex(s)
+        return not (self.top_key() < self.calculate_key(start) or rhs[start] > g[start])
+
+    # Plan a path from start_xy to goal_xy (pixel locations), repairing the previous plan. Returns the path as a list of pixel locations, starting at start_xy and ending at goal_xy, or None if the goal can't be reached or the search hasn't finished.
+    def plan(self, start_xy, goal_xy):
+        plan_start = time.perf_counter()
+        start = self.cell(start_xy)
+        goal = self.cell(goal_xy)
+        self.path = None
+        self.searching = False
+        if self.costs[goal] == INFINITY:
+            return None
+        if self.goal is not None and goal != self.goal:
+            cols = self.grid_shape[1]
+            if max(abs(goal // cols - self.goal // cols), abs(goal % cols - self.goal % cols)) > self.goal_repair_cells:
+                self.restart()
+                self.restarts += 1
+        self.move_start(start)
+        if goal != self.goal:
+            self.move_goal(goal)
+        if self.compute_shortest_path(self.max_expansions):
+            self.path = self.extract_path(start_xy, goal_xy)
+        else:
+            self.searching = True
+        elapsed_ms = (time.perf_counter() - plan_start)*1000.0
+        self.plans += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        return self.path
+
+    # Follow the cheapest neighbors from the start cell to the goal cell.
+    def extract_path(self, start_xy, goal_xy):
+        s = self.start
+        if min(self.g[s], self.rhs[s]) == INFINITY:
+            return None
+        path = [tuple(start_xy)]
+        # A consistent search never needs more steps than there are cells; the limit guards against cycles through cells whose repairs are still pending.
+        for index in range(len(self.g)):
+            if s == self.goal:
+                break
+            s = min(self.neighbors[s], key = lambda neighbor: neighbor[1]*self.costs[neighbor[0]] + self.g[neighbor[0]])[0]
+            if self.g[s] == INFINITY:
+                return None
+            path.append(self.cell_center(s))
+        else:
+            return None
+        path[-1] = tuple(goal_xy)
+        return path
+
+    # Return the point lookahead pixels along the planned path from start_xy to goal_xy, or None if there's no path. line_distance gives the lines found in this frame, as for :meth:`set_obstacles`. The obstacles are only updated when line_distance is a new result, so passing the same cached result each frame costs nothing. Until lines have been found once, the frame's size (and so the grid) is unknown; the path then leads straight to the goal.
+    def next_waypoint(self, start_xy, goal_xy, line_distance):
+        if line_distance is not self.line_distance:
+            self.set_obstacles(line_distance)
+        if self.grid_shape is None:
+            self.path = [tuple(start_xy), tuple(goal_xy)]
+            return tuple(goal_xy)
+        path = self.plan(start_xy, goal_xy)
+        if path is None:
+            return None
+        travelled = 0.0
+        for (x0, y0), (x1, y1) in zip(path[:-1], path[1:]):
+            step = hypot(x1 - x0, y1 - y0)
+            if travelled + step >= self.lookahead:
+                fraction = (self.lookahead - travelled) / step
+                return (x0 + fraction*(x1 - x0), y0 + fraction*(y1 - y0))
+            travelled += step
+        return path[-1]
+
+    # Draw the planned path on image.
+    def draw(self, image):
+        if image is None or not self.path:
+            return
+        points = numpy.int32(numpy.round(self.path)).reshape(-1, 1, 2)
+        cv2.polylines(image, [points], False, (255, 0, 255), 2)
+
+    def report(self):
+        if not self.plans:
+            return "Planner: no plans"
+        return "Planner: %d plans, mean %.2f ms, max %.2f ms, %d cells expanded, %d new searches" % (self.plans, self.total_ms/self.plans, self.max_ms, self.expansions, self.restarts)
@@ -0,0 +1,417 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# process_pipeline.py
+# *******************
+# :class:`Webcam_Find_Car` runs every step of processing a frame -- capture, conversion to Lab, finding the car and the lines, steering, and drawing -- one after another on a single core, so each frame takes the sum of these times. The Pi has four cores. This module instead runs these steps as a pipeline of four processes, each working on a different frame at once:
+#
+# #. capture: read a frame and shrink it, as :meth:`Webcam_Find_Car.grab_frame` does;
+# #. segment: convert to Lab, then find the car and the lines;
+# #. control: decide how to drive (see :meth:`Update_Mock.control`) and send the command;
+# #. render: draw the results and display them.
+#
+# A frame then takes as long as the slowest step, rather than the sum of all of them, though each frame waits a little longer in transit. Frames don't pass between processes by pickling; instead, capture writes each one into a slot of a :class:`Shared_Frame_Ring` held in shared memory, and only the slot's index is sent down the pipeline. The render stage, the last to use the frame, returns the slot for reuse. Only the small results of each step (the car's location and the outlines found) are pickled.
+#
+# Each frame records when each stage started and finished working on it. Since ``time.perf_counter`` uses the same monotonic clock in every process (on Linux), these show both the time spent working and the time spent waiting between stages. Run this file to process a recording and report the results::
+#
+#   python process_pipeline.py recording.avi --config settings.json
+import argparse
+from collections import namedtuple
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import signal
+import time
+import traceback
+
+import cv2
+import numpy
+
+import jones_webcam_opencv_code as wfc
+from frame_sources import open_frame_source
+from line_distance import Line_Distance_Query
+
+# The stages, in pipeline order.
+STAGES = ('capture', 'segment', 'control', 'render')
+# How often (in seconds) :meth:`Process_Pipeline.run` checks that the stages are still running while it waits for a frame.
+POLL_INTERVAL = 0.5
+
+# A frame's journey down the pipeline. slot is the frame's index in the :class:`Shared_Frame_Ring`; shape gives the frame's size. times holds the ``(start, end)`` of each stage's work on this frame, in pipeline order. results holds each stage's results, in a dict.
+Frame_Message = namedtuple('Frame_Message', 'seq slot shape times results')
+
+
+# A fixed number of frame-sized slots in shared memory. The process which creates the ring owns it, and must call :meth:`close` to free it; other processes attach to it using :meth:`descriptor`.
+class Shared_Frame_Ring(object):
+    def __init__(self, slots, shape, dtype = numpy.uint8, name = None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        size = slots*int(numpy.prod(self.shape))*self.dtype.itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create = True, size = size)
+        else:
+            # The stages are children of the owner, so they share its resource tracker; attaching doesn't cause the memory to be freed when a stage exits.
+            self.shm = shared_memory.SharedMemory(name = name)
+        self.frames = numpy.ndarray((slots,) + self.shape, self.dtype, buffer = self.shm.buf)
+
+    # Return what another process needs to attach to this ring.
+    def descriptor(self):
+        return self.slots, self.shape, self.dtype.str, self.shm.name
+
+    @classmethod
+    def attach(cls, descriptor):
+        slots, shape, dtype, name = descriptor
+        return cls(slots, shape, dtype, name)
+
+    # Return a view of the given slot holding a frame of the given shape, which may be smaller than the slot.
+    def frame(self, slot, shape):
+        rows, cols = shape[0:2]
+        return self.frames[slot, :rows, :cols]
+
+    def close(self):
+        # The array refers to the shared memory, so release it first.
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# Read the settings used by :class:`Webcam_Find_Car` from config_file (see :meth:`Webcam_Find_Car.load_config`), returning them as a dict.
+def load_settings(config_file = None):
+    settings = {
+        'target_threshold': 50,
+        'target_color': (34.0, 17.0, -47.0),
+        'line_threshold': 50,
+        'line_color': (34.0, 17.0, -47.0),
+        'target_xy': (-1, -1),
+    }
+    if config_file:
+        import json
+        with open(config_file) as f:
+            settings.update(json.load(f))
+    settings['target_color'] = numpy.float32(settings['target_color'])
+    settings['line_color'] = numpy.float32(settings['line_color'])
+    return settings
+
+
+# Each stage runs one of the functions below in its own process. Ctrl+C goes to every process; only the main process should act on it, by setting stop_event.
+def _ignore_interrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Run stage_func with args as the named stage. If it raises an exception, put the stage's name and the traceback on errors, so that the main process can report it.
+def _run_stage(name, stage_func, errors, *args):
+    try:
+        stage_func(*args)
+    except BaseException:
+        errors.put((name, traceback.format_exc()))
+        raise
+
+
+# Read frames from source_name (see :func:`open_frame_source`), shrink each into a free slot, then send it on. If drop_frames is True, a frame which arrives when no slot is free is dropped, so that the pipeline always works on recent frames, as with a live camera; otherwise, wait for a slot, so that every frame of a recording is processed. If frame_rate is given, read frames no faster than this, as a camera would deliver them.
+def _capture_stage(source_name, loop, ring_descriptor, free_slots, output, stop_event, drop_frames, dropped_frames, frame_rate):
+    _ignore_interrupt()
+    ring = Shared_Frame_Ring.attach(ring_descriptor)
+    try:
+        source = open_frame_source(source_name, loop)
+        try:
+            seq = 0
+            first_time = time.perf_counter()
+            frames_read = 0
+            while not stop_event.is_set():
+                if frame_rate:
+                    time.sleep(max(first_time + frames_read/frame_rate - time.perf_counter(), 0.0))
+                frames_read += 1
+                success_flag, image = source.read()
+                if not success_flag:
+                    break
+                start = time.perf_counter()
+                try:
+                    slot = free_slots.get_nowait() if drop_frames else free_slots.get(timeout = 1.0)
+                except queue.Empty:
+                    if drop_frames:
+                        dropped_frames.value += 1
+                    continue
+                sz = image.shape
+                shape = (int(sz[0]/2), int(sz[1]/2), sz[2])
+                cv2.resize(image, (shape[1], shape[0]), dst = ring.frame(slot, shape))
+                output.put(Frame_Message(seq, slot, shape, [(start, time.perf_counter())], {}))
+                seq += 1
+        finally:
+            source.release()
+        output.put(None)
+    finally:
+        ring.close()
+
+
+# Find the car and the lines in each frame. The results are the car's outline (only when displaying), center and area, plus the outlines of the lines.
+def _segment_stage(ring_descriptor, settings, use_lut, display, input, output):
+    _ignore_interrupt()
+    ring = Shared_Frame_Ring.attach(ring_descriptor)
+    try:
+        lut = None
+        if use_lut:
+            from color_lut import Color_Lut
+            lut = Color_Lut()
+            lut.prepare(settings['target_color'], settings['target_threshold'])
+            lut.prepare(settings['line_color'], settings['line_threshold'])
+        while True:
+            message = input.get()
+            if message is None:
+                break
+            start = time.perf_counter()
+            image = ring.frame(message.slot, message.shape)
+            lab_image = image if lut is not None else wfc.im_to_lab(image)
+            blobs = wfc.find_lab_blobs(lab_image, settings['target_color'], settings['target_threshold'], lut, top_k = 1)
+            cont_image, mass_center, cont_area = wfc.draw_car_blob(image, blobs, False)
+            car_contours = [blobs.contour(0)] if display and len(blobs) else []
+            line_contours = wfc.find_lab_color(lab_image, settings['line_color'], settings['line_threshold'], lut)
+            message.results.update(car_contours = car_contours, mass_center = mass_center, cont_area = cont_area, line_contours = line_contours)
+            message.times.append((start, time.perf_counter()))
+            output.put(message)
+        output.put(None)
+    finally:
+        ring.close()
+
+
+# Steer the car, sending commands through a :class:`Command_Scheduler` as :class:`Webcam_Find_Car` does. The result is the last command sent. desired_xy is a shared array, so that the render stage can change it.
+def _control_stage(comm_port, desired_xy, track_car, latency, input, output):
+    _ignore_interrupt()
+    from command_scheduler import Command_Scheduler
+    if comm_port:
+        import serial
+        ser = serial.Serial(port = comm_port - 1, baudrate = 115200)
+    else:
+        ser = wfc.Serial_Mock()
+    scheduler = Command_Scheduler(ser)
+    # Whatever happens, stop the car.
+    try:
+        tracker = None
+        if track_car:
+            from car_tracker import Car_Tracker
+            tracker = Car_Tracker(latency)
+        update_inst = wfc.Update_Mock(scheduler, draw = False, tracker = tracker)
+        while True:
+            message = input.get()
+            if message is None:
+                break
+            start = time.perf_counter()
+            results = message.results
+            line_distance = Line_Distance_Query(results['line_contours'], message.shape) if results['line_contours'] else None
+            # The capture stage's start time is when the frame was read.
+            update_inst.control(None, results['mass_center'], line_distance, tuple(desired_xy), message.times[0][0])
+            results['command'] = scheduler.last_command
+            message.times.append((start, time.perf_counter()))
+            output.put(message)
+    finally:
+        scheduler.close()
+    output.put(scheduler.report())
+    output.put(None)
+
+
+# Draw the results on each frame, display them if requested, then free the frame's slot. A right click sets the car's destination, as in :meth:`Webcam_Find_Car.on_mouse`; any key stops the pipeline. Each finished message, without its results, goes to stats.
+def _render_stage(ring_descriptor, display, desired_xy, free_slots, input, stats, stop_event):
+    _ignore_interrupt()
+    ring = Shared_Frame_Ring.attach(ring_descriptor)
+    try:
+        if display:
+            def on_mouse(event, x, y, flags, param):
+                if event == cv2.EVENT_RBUTTONDOWN:
+                    desired_xy[0], desired_xy[1] = x, y
+            cv2.namedWindow("final")
+            cv2.setMouseCallback("final", on_mouse)
+        while True:
+            message = input.get()
+            # The control stage sends its report just before finishing.
+            if isinstance(message, str):
+                stats.put(message)
+                continue
+            if message is None:
+                break
+            start = time.perf_counter()
+            if display:
+                results = message.results
+                final_image = ring.frame(message.slot, message.shape).copy()
+                cv2.drawContours(final_image, results['car_contours'], -1, (0, 0, 255), 3)
+                if results['mass_center'] != (-1, -1):
+                    cv2.circle(final_image, wfc.round_int(results['mass_center']), 10, (0, 255, 255), -1)
+                cv2.drawContours(final_image, results['line_contours'], -1, (0, 255, 0), 3)
+                wfc.draw_str(final_image, (0, 15), "Command: %r" % results['command'])
+                wfc.draw_str(final_image, (0, 30), "Car area: %.1f" % results['cont_area'])
+                if desired_xy[0] >= 0:
+                    cv2.circle(final_image, (desired_xy[0], desired_xy[1]), 40, (0, 255, 255), 2)
+                cv2.imshow("final", final_image)
+                if cv2.waitKey(1) != -1:
+                    stop_event.set()
+            # The frame is no longer needed.
+            free_slots.put(message.slot)
+            message.times.append((start, time.perf_counter()))
+            stats.put(Frame_Message(message.seq, message.slot, message.shape, message.times, None))
+        if display:
+            cv2.destroyAllWindows()
+        stats.put(None)
+    finally:
+        ring.close()
+
+
+# Run the pipeline on frames from source (a webcam index, video file or directory of images; see :func:`open_frame_source`). config_file supplies the colors, thresholds and destination, as for :meth:`Webcam_Find_Car.load_config`. slots gives the number of frames in shared memory; it should be at least the number of stages, so that each stage can work on a frame at once. If drop_frames is None, frames are dropped when the pipeline is busy only for a webcam. If display is True, the render stage shows its results in a window. To measure latency using a recording, give the camera's frame_rate; otherwise, frames are read as fast as possible and spend most of their time waiting for the slowest stage.
+class Process_Pipeline(object):
+    def __init__(self, source, config_file = None, comm_port = None, slots = 6, use_lut = False, display = False, drop_frames = None, track_car = False, latency = 0.15, loop = False, frame_rate = None, warmup = 5):
+        self.source = str(source)
+        self.loop = loop
+        self.frame_rate = frame_rate
+        self.settings = load_settings(config_file)
+        self.comm_port = comm_port
+        self.slots = slots
+        self.use_lut = use_lut
+        self.display = display
+        self.drop_frames = self.source.isdigit() if drop_frames is None else drop_frames
+        self.track_car = track_car
+        self.latency = latency
+        # The first few frames pay for starting up each stage, so they're left out of the report.
+        self.warmup = warmup
+        # The per-frame stage times and the control stage's report, filled in by :meth:`run`.
+        self.frame_times = []
+        self.command_report = None
+
+    # Find the shape of the shrunken frames by reading one frame.
+    def probe_shape(self):
+        source = open_frame_source(self.source)
+        success_flag, image = source.read()
+        source.release()
+        if not success_flag:
+            raise IOError("No frames available from %s." % self.source)
+        sz = image.shape
+        return int(sz[0]/2), int(sz[1]/2), sz[2]
+
+    # Process frames until the source runs out, a key is pressed in the display window, or Ctrl+C is pressed. Returns :meth:`report`.
+    def run(self):
+        ring = Shared_Frame_Ring(self.slots, self.probe_shape())
+        descriptor = ring.descriptor()
+        free_slots = multiprocessing.Queue()
+        for slot in range(self.slots):
+            free_slots.put(slot)
+        captured, segmented, controlled, stats = [multiprocessing.Queue() for index in range(4)]
+        stop_event = multiprocessing.Event()
+        errors = multiprocessing.Queue()
+        dropped_frames = multiprocessing.Value('i', 0)
+        desired_xy = multiprocessing.Array('i', [int(v) for v in self.settings['target_xy']])
+        stage_args = [
+            (_capture_stage, (self.source, self.loop, descriptor, free_slots, captured, stop_event, self.drop_frames, dropped_frames, self.frame_rate)),
+            (_segment_stage, (descriptor, self.settings, self.use_lut, self.display, captured, segmented)),
+            (_control_stage, (self.comm_port, desired_xy, self.track_car, self.latency, segmented, controlled)),
+            (_render_stage, (descriptor, self.display, desired_xy, free_slots, controlled, stats, stop_event)),
+        ]
+        processes = [multiprocessing.Process(target = _run_stage, name = name, args = (name, stage_func, errors) + args)
+                     for name, (stage_func, args) in zip(STAGES, stage_args)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+        self.frame_times = []
+        self.start_time = time.perf_counter()
+        try:
+            try:
+                while True:
+                    message = self._next_stats(stats, processes, errors, stop_event)
+                    if message is None:
+                        break
+                    if isinstance(message, str):
+                        self.command_report = message
+                    else:
+                        self.frame_times.append(message.times)
+            except KeyboardInterrupt:
+                # Let the stages finish the frames already in the pipeline, which stops the car.
+                stop_event.set()
+                while self._next_stats(stats, processes, errors, stop_event) is not None:
+                    pass
+            self.end_time = time.perf_counter()
+            for process in processes:
+                process.join(5.0)
+        finally:
+            # After a failure, the stages downstream of the failed one are still waiting for frames.
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join(5.0)
+            ring.close()
+        self.dropped_frames = dropped_frames.value
+        return self.report()
+
+    # Return the next message on stats. A stage which dies leaves the stages after it waiting forever for frames, so while waiting, check that each stage is still running or finished cleanly; if one failed, set stop_event and raise a RuntimeError giving its exit code and, if it raised an exception, the traceback.
+    def _next_stats(self, stats, processes, errors, stop_event):
+        while True:
+            try:
+                return stats.get(timeout = POLL_INTERVAL)
+            except queue.Empty:
+                pass
+            for process in processes:
+                # exitcode is None while the process runs, and 0 when it finishes cleanly.
+                if process.exitcode:
+                    stop_event.set()
+                    message = "The %s stage failed with exit code %d." % (process.name, process.exitcode)
+                    # A stage killed by a signal leaves no traceback.
+                    try:
+                        message += "\nIn the %s stage:\n%s" % errors.get(timeout = POLL_INTERVAL)
+                    except queue.Empty:
+                        pass
+                    raise RuntimeError(message)
+
+    # Summarize the stage times. For each stage, give the mean time spent working on a frame (busy), and the mean time a frame waited for the stage after the previous stage finished with it (wait). If each frame were processed in turn by a single process, a frame would take the total busy time; the latency added by the pipeline is the rest of the time from the start of capture to the end of rendering, which is spent waiting or moving between processes.
+    def report(self):
+        times = numpy.array(self.frame_times[self.warmup:])
+        frames = len(times)
+        results = {'frames': frames, 'dropped_frames': self.dropped_frames, 'command_report': self.command_report}
+        if frames < 2:
+            return results
+        # times has shape (frames, stages, 2), holding each stage's start and end time.
+        busy = times[:, :, 1] - times[:, :, 0]
+        wait = times[:, 1:, 0] - times[:, :-1, 1]
+        end_to_end = times[:, -1, 1] - times[:, 0, 0]
+        to_command = times[:, STAGES.index('control'), 1] - times[:, 0, 0]
+        results['fps'] = (frames - 1) / (times[-1, -1, 1] - times[0, -1, 1])
+        results['stages'] = {}
+        for index, name in enumerate(STAGES):
+            results['stages'][name] = {
+                'busy_ms': busy[:, index].mean()*1000.0,
+                'wait_ms': wait[:, index - 1].mean()*1000.0 if index else 0.0,
+            }
+        total_busy = busy.sum(1)
+        results['serial_fps'] = 1.0 / total_busy.mean()
+        results['slowest_stage_fps'] = 1.0 / busy.mean(0).max()
+        results['latency_p50_ms'], results['latency_p95_ms'] = numpy.percentile(end_to_end, (50, 95))*1000.0
+        results['command_latency_p50_ms'], results['command_latency_p95_ms'] = numpy.percentile(to_command, (50, 95))*1000.0
+        results['added_latency_ms'] = (end_to_end - total_busy).mean()*1000.0
+        return results
+
+
+def format_report(results):
+    if 'fps' not in results:
+        return "%(frames)d frames; too few to report." % results
+    lines = ["%(frames)d frames at %(fps).1f fps (one process: %(serial_fps).1f fps; slowest stage alone: %(slowest_stage_fps).1f fps), %(dropped_frames)d dropped" % results]
+    for name in STAGES:
+        stage = results['stages'][name]
+        lines.append("  %-8s busy %6.2f ms, waited %6.2f ms" % (name, stage['busy_ms'], stage['wait_ms']))
+    lines.append("Capture to command p50 %(command_latency_p50_ms).1f ms, p95 %(command_latency_p95_ms).1f ms; "
+                 "capture to display p50 %(latency_p50_ms).1f ms, p95 %(latency_p95_ms).1f ms; "
+                 "added by the pipeline %(added_latency_ms).1f ms" % results)
+    if results['command_report']:
+        lines.append(results['command_report'])
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Find the car using a pipeline of processes.')
+    parser.add_argument('source', nargs = '?', default = '0', help = 'A webcam index, video file, or directory of images.')
+    parser.add_argument('--config', help = 'A JSON settings file; see Webcam_Find_Car.load_config.')
+    parser.add_argument('--slots', type = int, default = 6, help = 'Frames held in shared memory.')
+    parser.add_argument('--lut', action = 'store_true', help = 'Classify colors using a lookup table.')
+    parser.add_argument('--track', action = 'store_true', help = 'Fuse the car\'s locations using a Kalman filter.')
+    parser.add_argument('--fps', type = float, help = 'Read a recording at this frame rate, as a camera would.')
+    parser.add_argument('--display', action = 'store_true', help = 'Show the results in a window.')
+    args = parser.parse_args()
+    pipeline = Process_Pipeline(args.source, args.config, slots = args.slots, use_lut = args.lut, display = args.display, track_car = args.track, frame_rate = args.fps)
+    print(format_report(pipeline.run()))
+
+if __name__ == "__main__":
+    main()
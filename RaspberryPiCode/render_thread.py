@@ -0,0 +1,129 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# render_thread.py
+# ****************
+# Drawing sits on the control loop's critical path: :func:`find_car` copies the whole frame to draw the car's outline on, the distance map is scaled into a new floating-point image just to display it, and :meth:`Webcam_Find_Car.update` then shows the results before the next frame can start. None of this affects how the car is steered. This module moves it to a separate thread: each frame, :meth:`Update_Mock.update` hands over a :class:`Render_Job` -- a reference to the frame (not a copy; each frame is a new image, which nothing changes afterwards) plus the results found in it -- and returns at once. The render thread draws the newest job, at no more than max_rate times a second, then passes the drawing to a window, to an :class:`Mjpeg_Server`, or both.
+#
+# Jobs pass through a :class:`Latest_Frame_Slot`, as frames do from the capture thread, so a job the render thread hasn't reached is replaced by the next one, rather than queueing up behind it. OpenCV's windows must be used from the main thread (where ``cv2.waitKey`` runs), so when showing windows, the render thread only draws; the main thread shows the finished drawing by calling :meth:`Render_Thread.take_rendered`.
+from collections import namedtuple
+import threading
+import time
+
+import cv2
+import numpy
+
+from frame_capture import Latest_Frame_Slot
+
+# The results of processing one frame. frame is the image processed; display_shape gives the (rows, columns) of the image to draw, and so the coordinates of the other fields, which differ from the frame's when processing at an adaptive scale. car_xy gives the car's location, or (-1, -1) if it wasn't found, and car_radius the radius of a circle of the same area. line_distance is the :class:`Line_Distance_Query` for the lines found, or None. desired_xy gives the car's destination, or negative values for none. path gives the path planned there, as a list of points, or None. status gives lines of text to show.
+Render_Job = namedtuple('Render_Job', 'frame display_shape car_xy car_radius line_distance desired_xy path status')
+
+# How close the car must be to its destination to stop; see :meth:`Update_Mock.control`.
+CLOSE_DIST = 40
+
+
+class Render_Thread(object):
+    # Draw at most max_rate times a second. Each drawing is published to server (an :class:`Mjpeg_Server`), if given. If show is True, drawings are kept for :meth:`take_rendered`, along with a display of the distance map, refreshed distance_map_rate times a second.
+    def __init__(self, max_rate = 15.0, server = None, show = False, distance_map_rate = 2.0):
+        self.max_rate = max_rate
+        self.server = server
+        self.show = show
+        self.distance_map_rate = distance_map_rate
+        self.slot = Latest_Frame_Slot()
+        self.rendered = Latest_Frame_Slot()
+        self.dist_image = None
+        self._last_distance_map = None
+        # Statistics
+        self.submitted = 0
+        self.renders = 0
+        self.render_ms = 0.0
+        self.first_render = None
+        self.last_render = None
+        self._running = True
+        self._thread = threading.Thread(target = self._render_loop, name = "render")
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Hand a :class:`Render_Job` to the render thread. This never waits.
+    def submit(self, job):
+        self.submitted += 1
+        self.slot.put(job)
+
+    # From the main thread, return the newest drawing and distance map display (None until one is ready), or None if there's been no new drawing since the last call.
+    def take_rendered(self):
+        seq, images = self.rendered.take(0)
+        return images
+
+    def _render_loop(self):
+        period = 1.0/self.max_rate
+        while self._running:
+            seq, job = self.slot.take(0.5)
+            if seq is None:
+                continue
+            start = time.monotonic()
+            image = self.render(job)
+            if self.server is not None:
+                self.server.publish(image)
+            if self.show:
+                self.rendered.put((image, self.dist_image))
+            end = time.monotonic()
+            self.renders += 1
+            self.render_ms += (end - start)*1000.0
+            if self.first_render is None:
+                self.first_render = start
+            self.last_render = start
+            # Wait out the rest of the period; jobs submitted meanwhile replace each other in the slot, so only the newest is drawn.
+            time.sleep(max(period - (end - start), 0.0))
+
+    # Return a drawing of job's results over its frame.
+    def render(self, job):
+        rows, cols = job.display_shape
+        if job.frame.shape[0:2] == (rows, cols):
+            image = job.frame.copy()
+        else:
+            image = cv2.resize(job.frame, (cols, rows))
+        if job.line_distance is not None:
+            cv2.drawContours(image, job.line_distance.contours, -1, (0, 255, 0), 3)
+            self.update_distance_map(job.line_distance)
+        if job.path:
+            cv2.polylines(image, [numpy.int32(numpy.round(job.path)).reshape(-1, 1, 2)], False, (255, 0, 255), 2)
+        car_x, car_y = job.car_xy
+        if car_x >= 0:
+            center = (int(round(car_x)), int(round(car_y)))
+            cv2.circle(image, center, int(round(job.car_radius)), (0, 0, 255), 3)
+            cv2.circle(image, center, 10, (0, 255, 255), -1)
+        desired_x, desired_y = job.desired_xy
+        if desired_x >= 0 and desired_y >= 0:
+            cv2.circle(image, (int(desired_x), int(desired_y)), CLOSE_DIST, (0, 255, 255), 2)
+        for index, text in enumerate(job.status):
+            draw_text(image, (0, 15*(index + 1)), text)
+        return image
+
+    # Refresh the display of the distance map, if it's due. Scaling straight to 8 bits avoids making a floating-point copy of the map to show.
+    def update_distance_map(self, line_distance):
+        if not self.show:
+            return
+        now = time.monotonic()
+        if self._last_distance_map is not None and now - self._last_distance_map < 1.0/self.distance_map_rate:
+            return
+        self._last_distance_map = now
+        self.dist_image = cv2.normalize(line_distance.dense_map(), None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+
+    def close(self):
+        self._running = False
+        self.slot.close()
+        self._thread.join(2.0)
+        self.rendered.close()
+
+    def report(self):
+        span = (self.last_render - self.first_render) if self.renders > 1 else 0.0
+        return "Render: %d of %d frames drawn (%s), mean %.2f ms" % (self.renders, self.submitted,
+                                                                    "%.1f Hz" % ((self.renders - 1)/span) if span > 0 else "rate n/a",
+                                                                    self.render_ms/self.renders if self.renders else 0.0)
+
+
+# Like :func:`draw_str`: draw s at xy on image, in white with a black shadow.
+def draw_text(image, xy, s):
+    x, y = xy
+    cv2.putText(image, s, (x + 1, y + 1), cv2.FONT_HERSHEY_PLAIN, 1.0, (0, 0, 0), thickness = 2)
+    cv2.putText(image, s, (x, y), cv2.FONT_HERSHEY_PLAIN, 1.0, (255, 255, 255))
@@ -0,0 +1,219 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# replay_benchmark.py
+# *******************
+# This program pushes a recording through the car-finding code as fast as possible, then reports the frame rate and the per-frame latency. Since the same frames are used for every run, the results of two runs can be compared to judge a change to the image-processing code. For example::
+#
+#   python replay_benchmark.py recording.avi --config settings.json --json before.json
+#
+# The frames are read into memory before timing starts, so that decoding the recording isn't measured. The settings (colors and thresholds) come from a config file, as described in :meth:`Webcam_Find_Car.load_config`; otherwise, the last saved settings are used.
+#
+# With ``--check-line-scales``, it instead checks that the lines found by a :class:`Coarse_To_Fine_Car_Finder` match those found in the half-size frame at every scale a :class:`Resolution_Controller` can pick (see :func:`check_line_scales`), exiting with a non-zero status if any differ.
+import argparse
+import json
+import sys
+import time
+
+import cv2
+import numpy
+
+from jones_webcam_opencv_code import Webcam_Find_Car, Update_Mock, Coarse_To_Fine_Car_Finder, find_car, distance_to_color, find_line_distance, im_to_lab
+from frame_sources import Array_Source, open_frame_source, read_all_frames
+from stage_timers import timers
+
+
+# The stages which can be timed. Each is a function taking a :class:`Webcam_Find_Car` whose :attr:`image` holds the current frame. With a :class:`Resolution_Controller`, only :meth:`Webcam_Find_Car.update` can be timed: when headless, :meth:`Webcam_Find_Car.grab_frame` then keeps only the full-size frame, and only :meth:`Update_Mock.update` lets the controller pick the scale.
+def _time_update(wfc):
+    wfc.update()
+
+def _time_find_car(wfc):
+    find_car(wfc.image, wfc.target_color, wfc.target_threshold, wfc.lut, False)
+
+def _time_distance(wfc):
+    lab_image = wfc.image if wfc.lut is not None else im_to_lab(wfc.image)
+    distance_to_color(lab_image, None, wfc.line_color, wfc.line_threshold, wfc.lut)
+
+# Find the distance from the center of the image to the nearest line, without a distance map.
+def _time_line_query(wfc):
+    lab_image = wfc.image if wfc.lut is not None else im_to_lab(wfc.image)
+    line_distance = find_line_distance(lab_image, None, wfc.line_color, wfc.line_threshold, wfc.lut)
+    if line_distance is not None:
+        line_distance.distance(wfc.image.shape[1] // 2, wfc.image.shape[0] // 2)
+
+STAGES = {
+    'update': _time_update,
+    'find_car': _time_find_car,
+    'distance': _time_distance,
+    'line_query': _time_line_query,
+}
+
+
+# Run every frame through the given stage, returning a dict of statistics. frames is a list of frames (see :func:`read_all_frames`); repeat gives the number of passes through these frames. The first warmup frames aren't timed, since the first few calls pay one-time costs. Any remaining keyword arguments are passed to :class:`Webcam_Find_Car`. When processing at an adaptive scale (the target_frame_ms option), the scale used for each frame is written to resolution_log (a CSV file), if given.
+def run_replay(frames, stage = 'update', Update_class = Update_Mock, repeat = 1, warmup = 5, resolution_log = None, **options):
+    stage_func = STAGES[stage]
+    if options.get('target_frame_ms') and stage != 'update':
+        raise ValueError("An adaptive scale (target_frame_ms) can only be used with the update stage, not %s." % stage)
+    source = Array_Source(frames*repeat)
+    wfc = Webcam_Find_Car(Update_class = Update_class, headless = True, frame_source = source, **options)
+    latencies = []
+    start_time = None
+    while True:
+        frame_start = time.perf_counter()
+        # Shrinking the frame is part of the pipeline, so include it in the time.
+        if not wfc.grab_frame():
+            break
+        stage_func(wfc)
+        frame_end = time.perf_counter()
+        if warmup > 0:
+            warmup -= 1
+            continue
+        if start_time is None:
+            start_time = frame_start
+        latencies.append(frame_end - frame_start)
+    wfc.cap.release()
+    # Stop the command scheduler's watchdog; close it before the recorder, so that the stop command is recorded.
+    wfc.ser.close()
+    if wfc.renderer is not None:
+        wfc.renderer.close()
+    if wfc.preview_server is not None:
+        wfc.preview_server.close()
+    if wfc.recorder is not None:
+        wfc.recorder.close()
+    results = summarize(latencies, (frame_end - start_time) if start_time is not None else 0.0, stage)
+    if wfc.resolution_controller is not None:
+        results['resolution'] = dict(("1/%g" % (1.0/scale), stats) for scale, stats in wfc.resolution_controller.summary().items())
+        if resolution_log:
+            wfc.resolution_controller.dump(resolution_log)
+    if wfc.scheduler is not None:
+        results['scheduler'] = wfc.scheduler.summary()
+    if wfc.line_cache is not None:
+        results['line_cache'] = {'hit_rate': wfc.line_cache.hit_rate, 'hits': wfc.line_cache.hits, 'misses': wfc.line_cache.misses}
+    if wfc.planner is not None and wfc.planner.plans:
+        results['planner'] = {'plans': wfc.planner.plans, 'mean_ms': wfc.planner.total_ms/wfc.planner.plans, 'max_ms': wfc.planner.max_ms,
+                              'expansions': wfc.planner.expansions, 'restarts': wfc.planner.restarts}
+    if wfc.renderer is not None:
+        results['render'] = {'submitted': wfc.renderer.submitted, 'renders': wfc.renderer.renders,
+                             'mean_ms': wfc.renderer.render_ms/wfc.renderer.renders if wfc.renderer.renders else 0.0}
+    if wfc.recorder is not None:
+        results['recorder'] = {'ticks': wfc.recorder.ticks, 'dropped': wfc.recorder.dropped, 'frames': wfc.recorder.frames, 'bytes': wfc.recorder.offset,
+                               'write_ms': wfc.recorder.write_ms/wfc.recorder.ticks if wfc.recorder.ticks else 0.0}
+    return results
+
+
+# Find the lines in each of frames (full-size 8-bit BGR images) using a :class:`Coarse_To_Fine_Car_Finder` held at each of scales in turn, returning the scales at which the number of lines found differs from the number found in the half-size frame, as :meth:`Webcam_Find_Car.grab_frame` shrinks it. Thin lines mustn't vanish when the controller picks a coarse scale to keep up, since steering would then ignore them.
+def check_line_scales(frames, line_color, line_threshold, lut = None, scales = None):
+    from resolution_controller import Resolution_Controller
+    scales = scales or Resolution_Controller().scales
+    def line_count(line_distance):
+        return 0 if line_distance is None else len(line_distance.contours)
+    expected = []
+    for frame in frames:
+        image = cv2.resize(frame, (int(frame.shape[1]/2), int(frame.shape[0]/2)))
+        expected.append(line_count(find_line_distance(image if lut is not None else im_to_lab(image), None, line_color, line_threshold, lut)))
+    failed = []
+    for scale in scales:
+        finder = Coarse_To_Fine_Car_Finder(Resolution_Controller(scales = (scale,)), lut, draw = False)
+        # The shrunken image from find_car is only reused at half size, so pass None to find the lines from the full-size frame, as at any other scale.
+        if any(line_count(finder.find_line_distance(frame, None, None, line_color, line_threshold)) != count for frame, count in zip(frames, expected)):
+            failed.append(scale)
+    return failed
+
+
+# Compute the frame rate and latency percentiles, in milliseconds, of the given per-frame latencies (in seconds).
+def summarize(latencies, elapsed, stage):
+    results = {'stage': stage, 'frames': len(latencies)}
+    if not latencies:
+        return results
+    p50, p95, p99 = numpy.percentile(latencies, (50, 95, 99))*1000.0
+    results.update({
+        'fps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'mean_ms': numpy.mean(latencies)*1000.0,
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'max_ms': numpy.max(latencies)*1000.0,
+    })
+    return results
+
+
+def format_results(results):
+    if results['frames'] == 0:
+        return "%(stage)s: no frames timed" % results
+    return ("%(stage)s: %(frames)d frames, %(fps).1f fps, latency mean %(mean_ms).2f ms, "
+            "p50 %(p50_ms).2f ms, p95 %(p95_ms).2f ms, p99 %(p99_ms).2f ms, max %(max_ms).2f ms" % results)
+
+
+# args is a list of command line arguments; by default, they come from sys.argv.
+def main(args = None):
+    parser = argparse.ArgumentParser(description = 'Replay a recording through the car-finding code and report its speed.')
+    parser.add_argument('recording', help = 'A video file, a directory of images, or a flight log.')
+    parser.add_argument('--stage', choices = sorted(STAGES), default = 'update', help = 'The part of the pipeline to time.')
+    parser.add_argument('--config', help = 'A JSON settings file; see Webcam_Find_Car.load_config.')
+    parser.add_argument('--calibration', help = 'A calibration directory; see calibration_store.py.')
+    parser.add_argument('--profile', help = 'With --calibration, the profile to use rather than the active one.')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'Passes through the recording.')
+    parser.add_argument('--max-frames', type = int, help = 'Use at most this many frames of the recording.')
+    parser.add_argument('--lut', action = 'store_true', help = 'Classify colors using a lookup table.')
+    parser.add_argument('--windowed', action = 'store_true', help = 'Search for the car near its last location.')
+    parser.add_argument('--track', action = 'store_true', help = 'Fuse the car\'s locations using a Kalman filter.')
+    parser.add_argument('--schedule', action = 'store_true', help = 'Find the lines at a lower rate than the car; see stage_scheduler.py.')
+    parser.add_argument('--cache-lines', action = 'store_true', help = 'Reuse the lines found until the scene changes; see line_cache.py.')
+    parser.add_argument('--plan', action = 'store_true', help = 'Steer along a path planned around the lines; see path_planner.py.')
+    parser.add_argument('--render-thread', action = 'store_true', help = 'Draw the results on a separate thread; see render_thread.py.')
+    parser.add_argument('--preview-port', type = int, help = 'Serve the drawings as an MJPEG stream on this port; see mjpeg_server.py.')
+    parser.add_argument('--record', help = 'Record the frames, results and commands to this flight log; see flight_recorder.py.')
+    parser.add_argument('--record-every', type = int, default = 1, help = 'With --record, keep the frame of one tick in this many.')
+    parser.add_argument('--record-jpeg', type = int, help = 'With --record, store frames as JPEG images of this quality, rather than raw.')
+    parser.add_argument('--target-ms', type = float, help = 'Choose the processing scale of each frame to take about this long; only with --stage update.')
+    parser.add_argument('--resolution-log', help = 'With --target-ms, write the scale and time of each frame to this CSV file.')
+    parser.add_argument('--json', help = 'Also write the results to this JSON file.')
+    parser.add_argument('--stage-timing', action = 'store_true', help = 'Also report the time taken by each stage of the pipeline.')
+    parser.add_argument('--check-line-scales', action = 'store_true', help = 'Only check that the lines are found at every scale --target-ms may pick.')
+    args = parser.parse_args(args)
+    if args.target_ms and args.stage != 'update':
+        parser.error("--target-ms can only be used with --stage update.")
+
+    frames = read_all_frames(open_frame_source(args.recording), args.max_frames)
+    print("Read %d frames." % len(frames))
+    if args.check_line_scales:
+        from process_pipeline import load_settings
+        settings = load_settings(args.config)
+        lut = None
+        if args.lut:
+            from color_lut import Color_Lut
+            lut = Color_Lut()
+        failed = check_line_scales(frames, settings['line_color'], settings['line_threshold'], lut)
+        print("Lines: %s" % ("the same at every scale" if not failed else
+                             "DIFFERENT from half size at scale %s" % ", ".join("1/%g" % (1.0/scale) for scale in failed)))
+        return 0 if not failed else 1
+    results = run_replay(frames, args.stage, repeat = args.repeat, resolution_log = args.resolution_log, config_file = args.config,
+                         use_lut = args.lut, windowed_search = args.windowed, track_car = args.track, target_frame_ms = args.target_ms, stage_timing = args.stage_timing,
+                         calibration_dir = args.calibration, profile = args.profile, schedule_stages = args.schedule,
+                         cache_lines = args.cache_lines, plan_path = args.plan, render_thread = args.render_thread, preview_port = args.preview_port,
+                         record_file = args.record, record_every = args.record_every, record_jpeg_quality = args.record_jpeg)
+    print(format_results(results))
+    for scale, stats in results.get('resolution', {}).items():
+        print("  scale %s: %d frames, mean %.2f ms, car found in %.0f%%" % (scale, stats['frames'], stats['mean_ms'], stats['found']*100.0))
+    for name, stats in results.get('scheduler', {}).items():
+        print("  %s: %d runs, %d skipped, %s, %d over budget, %d late" % (name, stats['runs'], stats['skipped'],
+              "%.1f Hz" % stats['achieved_hz'] if stats['achieved_hz'] is not None else "rate n/a", stats['over_budget'], stats['late']))
+    if 'line_cache' in results:
+        print("  line cache: %.1f%% hits" % (results['line_cache']['hit_rate']*100.0))
+    if 'planner' in results:
+        print("  planner: %d plans, mean %.2f ms, max %.2f ms" % (results['planner']['plans'], results['planner']['mean_ms'], results['planner']['max_ms']))
+    if 'render' in results:
+        print("  render: %d of %d frames drawn, mean %.2f ms" % (results['render']['renders'], results['render']['submitted'], results['render']['mean_ms']))
+    if 'recorder' in results:
+        print("  recorder: %d ticks recorded, %d dropped, %.1f MB, mean %.2f ms written per tick" % (results['recorder']['ticks'], results['recorder']['dropped'],
+              results['recorder']['bytes']/1e6, results['recorder']['write_ms']))
+    if args.stage_timing:
+        results['stages'] = timers.summary()
+        for name, stats in results['stages'].items():
+            print("  %s: mean %.3f ms, p95 %.3f ms" % (name, stats['mean_ms'], stats['p95_ms']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+    sys.exit(main())
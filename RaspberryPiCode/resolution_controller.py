@@ -0,0 +1,89 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# resolution_controller.py
+# ************************
+# :meth:`Webcam_Find_Car.grab_frame` always shrinks each frame to half size, whether or not the processing then keeps up with the camera. The time to find the car grows with the number of pixels processed, so processing at a quarter of the size takes about a quarter of the time. This module picks the scale to process each frame at, from a list of scales, to keep the time per frame near a target: it moves to a coarser scale when frames take too long, and back to a finer scale when the time saved leaves room. See :class:`Coarse_To_Fine_Car_Finder`, which finds the car at the chosen scale then refines its location at full resolution.
+#
+# The scale and time of each frame are recorded, so the trade-off between speed and accuracy can be examined.
+from collections import deque, namedtuple
+import csv
+
+# The record for one frame: the scale it was processed at, the time it took in milliseconds, and whether the car was found.
+Frame_Record = namedtuple('Frame_Record', 'scale ms found')
+
+
+class Resolution_Controller(object):
+    # target_ms gives the desired processing time per frame, in milliseconds. scales lists the scales (relative to the full frame) which may be used, finest first. Frame times are smoothed with an exponential moving average, giving each new time the weight smoothing. A move to a finer scale happens only if the time predicted there is below headroom times the target; after any change, the scale is held for at least hold_frames frames. history gives the number of :class:`Frame_Record` values kept.
+    def __init__(self, target_ms = 33.0, scales = (0.5, 0.25, 0.125), smoothing = 0.3, headroom = 0.7, hold_frames = 5, history = 1024):
+        self.target_ms = target_ms
+        self.scales = scales
+        self.smoothing = smoothing
+        self.headroom = headroom
+        self.hold_frames = hold_frames
+        # Start at the finest scale.
+        self.scale_index = 0
+        self.smoothed_ms = None
+        self.frames_since_change = 0
+        self.records = deque(maxlen = history)
+        # Statistics
+        self.changes = 0
+
+    # The scale to process the next frame at.
+    @property
+    def scale(self):
+        return self.scales[self.scale_index]
+
+    # Record that the last frame took frame_ms milliseconds at the current scale, then choose the scale for the next frame, which is returned. found tells if the car was found; since a small car may vanish at a coarse scale, losing it moves to a finer scale.
+    def update(self, frame_ms, found = True):
+        self.records.append(Frame_Record(self.scale, frame_ms, found))
+        if self.smoothed_ms is None:
+            self.smoothed_ms = frame_ms
+        else:
+            self.smoothed_ms += self.smoothing*(frame_ms - self.smoothed_ms)
+        self.frames_since_change += 1
+        if self.frames_since_change < self.hold_frames:
+            return self.scale
+        if not found and self.scale_index > 0:
+            self.change_scale(self.scale_index - 1)
+        elif self.smoothed_ms > self.target_ms and self.scale_index < len(self.scales) - 1:
+            self.change_scale(self.scale_index + 1)
+        elif self.scale_index > 0 and self.predict_ms(self.scale_index - 1) < self.headroom*self.target_ms:
+            self.change_scale(self.scale_index - 1)
+        return self.scale
+
+    # Predict the time per frame at the scale with the given index, assuming time is proportional to the number of pixels.
+    def predict_ms(self, scale_index):
+        return self.smoothed_ms*(self.scales[scale_index] / self.scale)**2
+
+    def change_scale(self, scale_index):
+        # Start the new scale's average from its predicted time, rather than the old scale's time.
+        self.smoothed_ms = self.predict_ms(scale_index)
+        self.scale_index = scale_index
+        self.frames_since_change = 0
+        self.changes += 1
+
+    # Summarize the recorded frames: for each scale used, the number of frames, their mean time in milliseconds, and the fraction in which the car was found.
+    def summary(self):
+        results = {}
+        for scale in self.scales:
+            records = [record for record in self.records if record.scale == scale]
+            if records:
+                results[scale] = {
+                    'frames': len(records),
+                    'mean_ms': sum(record.ms for record in records) / len(records),
+                    'found': sum(record.found for record in records) / float(len(records)),
+                }
+        return results
+
+    def report(self):
+        return "; ".join("scale 1/%g: %d frames, mean %.2f ms, car found in %.0f%%" %
+                         (1.0/scale, stats['frames'], stats['mean_ms'], stats['found']*100.0)
+                         for scale, stats in self.summary().items()) + "; %d changes" % self.changes
+
+    # Write the per-frame records to a CSV file.
+    def dump(self, filename):
+        with open(filename, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(Frame_Record._fields)
+            writer.writerows(self.records)
@@ -1,13 +1,25 @@
+import asyncio
 import serial
 import RPi.GPIO as GPIO
 import time
+from telemetry_reader import Telemetry_Reader
 
 # Sets up serial device
 ser=serial.Serial("/dev/ttyACM0",9600)  #change ACM number as found from ls /dev/tty/ACM*
 ser.baudrate=9600
 
-while True:
-	# Reads input every 1 second(s) and prints to screen
-	read_ser=ser.readline()
-	print(read_ser)
-	time.sleep(1)
\ No newline at end of file
+async def main():
+	# Reads lines as soon as they arrive, rather than polling
+	reader = Telemetry_Reader(ser.fileno())
+	reader.start(asyncio.get_running_loop())
+	subscription = reader.subscribe()
+
+	lastReport = time.time()
+	async for record in subscription:
+		# Prints the latest line and the line rate once per second, rather than every line
+		if time.time() - lastReport >= 1:
+			lastReport = time.time()
+			stats = reader.stats()
+			print("%.1f lines/s, %d dropped: %s" % (stats['records_per_s'], subscription.dropped, record.value))
+
+asyncio.run(main())
@@ -0,0 +1,156 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# stage_scheduler.py
+# ******************
+# :meth:`Update_Mock.update` runs every stage of processing on every frame: finding the car, finding the lines, computing a distance map for display, and drawing. But only the car moves quickly. The lines and obstacles barely change, and a person watching the display doesn't need 30 updates a second. This module runs each stage at its own rate, returning the stage's last result on the frames in between, so the time saved goes to the stages which must run every frame: finding the car and steering it.
+#
+# Each stage declares a target rate, in runs per second (or None to run every frame), and a budget: the time, in milliseconds, one run should take. An adaptive stage slows down, to no less than its minimum rate, when its runs take longer than their budget or when whole frames overrun the frame budget, then speeds back up as time allows. A stage always runs when its inputs change (say, after picking a new line color), whatever its rate.
+#
+# For each stage, the scheduler counts runs and skipped frames, the rate achieved, and two kinds of deadline miss: runs which took longer than their budget, and runs which started late -- more than late_factor periods after the previous run.
+import time
+
+from stage_timers import timers
+
+
+class _Stage(object):
+    def __init__(self, name, rate, budget_ms, adaptive, min_rate):
+        self.name = name
+        self.rate = rate
+        self.budget_ms = budget_ms
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.result = None
+        self.key = None
+        self.last_run = None
+        self.first_run = None
+        self.next_due = None
+        self.smoothed_ms = None
+        # Statistics
+        self.runs = 0
+        self.skips = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.over_budget = 0
+        self.late = 0
+
+
+class Stage_Scheduler(object):
+    # frame_budget_ms gives the time, in milliseconds, a whole frame should take. Run and frame times are smoothed with an exponential moving average, giving each new time the weight smoothing. A run is late if it starts more than late_factor periods after the previous run. clock returns the current time in seconds.
+    def __init__(self, frame_budget_ms = 33.0, smoothing = 0.2, late_factor = 1.5, clock = time.monotonic):
+        self.frame_budget_ms = frame_budget_ms
+        self.smoothing = smoothing
+        self.late_factor = late_factor
+        self.clock = clock
+        # Stage names map to their :class:`_Stage`, in the order the stages were added.
+        self.stages = {}
+        self.frame_start = None
+        self.smoothed_frame_ms = None
+        # Statistics
+        self.frames = 0
+        self.frame_overruns = 0
+
+    # Declare a stage. rate gives its target runs per second, or None to run on every frame. budget_ms gives the time one run should take, or None for no budget. An adaptive stage runs slower, but no less than min_rate times per second, when it or the frame overruns its budget.
+    def add_stage(self, name, rate = None, budget_ms = None, adaptive = False, min_rate = 1.0):
+        self.stages[name] = _Stage(name, rate, budget_ms, adaptive, min_rate)
+
+    # Call these at the start and end of each frame, so that adaptive stages can respond to frames which overrun the frame budget.
+    def start_frame(self):
+        self.frame_start = self.clock()
+
+    def end_frame(self):
+        if self.frame_start is None:
+            return
+        frame_ms = (self.clock() - self.frame_start)*1000.0
+        self.frame_start = None
+        self.frames += 1
+        if frame_ms > self.frame_budget_ms:
+            self.frame_overruns += 1
+        self.smoothed_frame_ms = self._smooth(self.smoothed_frame_ms, frame_ms)
+
+    def _smooth(self, average, value):
+        return value if average is None else average + self.smoothing*(value - average)
+
+    # Return the rate, in runs per second, the named stage currently aims for, or None if it runs every frame.
+    def current_rate(self, name):
+        stage = self.stages[name]
+        if stage.rate is None or not stage.adaptive:
+            return stage.rate
+        scale = 1.0
+        if stage.budget_ms and stage.smoothed_ms:
+            scale = min(scale, stage.budget_ms / stage.smoothed_ms)
+        if self.smoothed_frame_ms:
+            scale = min(scale, self.frame_budget_ms / self.smoothed_frame_ms)
+        return max(stage.rate*scale, min(stage.min_rate, stage.rate))
+
+    # Return True if the named stage should run now. key identifies its inputs; when it differs from the key of the last run, the stage is due whatever its rate.
+    def due(self, name, key = None):
+        stage = self.stages[name]
+        if stage.last_run is None or key != stage.key:
+            return True
+        return stage.next_due is None or self.clock() >= stage.next_due
+
+    # Run func with the given args as the named stage if it's due, returning its result; otherwise, return the result of its last run. See :meth:`due` for key.
+    def run(self, name, func, *args, key = None):
+        stage = self.stages[name]
+        if not self.due(name, key):
+            stage.skips += 1
+            return stage.result
+        start = self.clock()
+        with timers.stage(name):
+            stage.result = func(*args)
+        elapsed_ms = (self.clock() - start)*1000.0
+        # A run forced by new inputs isn't late, however long since the last run.
+        rate = self.current_rate(name)
+        if rate is not None and stage.last_run is not None and key == stage.key and start - stage.last_run > self.late_factor/rate:
+            stage.late += 1
+        if stage.budget_ms is not None and elapsed_ms > stage.budget_ms:
+            stage.over_budget += 1
+        # Schedule the next run one period after this run was due, rather than after it started; since runs can only start on a frame, this keeps the rate achieved near the target. After a long gap, or new inputs, start afresh.
+        if rate is None:
+            stage.next_due = None
+        elif stage.next_due is None or key != stage.key or start - stage.next_due >= 1.0/rate:
+            stage.next_due = start + 1.0/rate
+        else:
+            stage.next_due += 1.0/rate
+        if stage.first_run is None:
+            stage.first_run = start
+        stage.last_run = start
+        stage.key = key
+        stage.runs += 1
+        stage.total_ms += elapsed_ms
+        stage.max_ms = max(stage.max_ms, elapsed_ms)
+        stage.smoothed_ms = self._smooth(stage.smoothed_ms, elapsed_ms)
+        return stage.result
+
+    # Make the named stage run on its next call, as when something its result depends on has changed.
+    def invalidate(self, name):
+        self.stages[name].next_due = None
+        self.stages[name].last_run = None
+
+    # Return a dict mapping each stage name to its statistics: runs and skipped frames, the target and achieved rates in runs per second (None for every frame), the mean and maximum run times in milliseconds, and the runs over budget or late.
+    def summary(self):
+        results = {}
+        for name, stage in self.stages.items():
+            span = (stage.last_run - stage.first_run) if stage.runs > 1 else 0.0
+            results[name] = {
+                'runs': stage.runs,
+                'skipped': stage.skips,
+                'target_hz': stage.rate,
+                'achieved_hz': (stage.runs - 1)/span if span > 0 else None,
+                'mean_ms': stage.total_ms/stage.runs if stage.runs else 0.0,
+                'max_ms': stage.max_ms,
+                'over_budget': stage.over_budget,
+                'late': stage.late,
+            }
+        return results
+
+    def report(self):
+        lines = ["%d frames, %d over the %.0f ms frame budget" % (self.frames, self.frame_overruns, self.frame_budget_ms)]
+        for name, stats in self.summary().items():
+            lines.append("%s: %d runs, %d skipped, %s (target %s), mean %.2f ms, max %.2f ms, %d over budget, %d late" % (
+                name, stats['runs'], stats['skipped'],
+                "%.1f Hz" % stats['achieved_hz'] if stats['achieved_hz'] is not None else "rate n/a",
+                "%g Hz" % stats['target_hz'] if stats['target_hz'] is not None else "every frame",
+                stats['mean_ms'], stats['max_ms'], stats['over_budget'], stats['late']))
+        return "\n".join(lines)
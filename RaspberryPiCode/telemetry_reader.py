@@ -0,0 +1,253 @@
+# .. highlight:: python3
+# .. default-domain:: py
+#
+# telemetry_reader.py
+# *******************
+# This module reads telemetry from the Arduino as soon as it arrives. Rather than polling the serial port, it asks asyncio to call it back whenever the port has data, then splits that data into lines (or binary frames; see :mod:`command_protocol`), parses each, and stores the result with the time it was received in a bounded ring buffer. Any number of consumers may subscribe to receive new records; each subscriber has its own bounded queue, so a slow consumer loses its oldest records rather than holding up the reader or other consumers.
+#
+# If the port goes away (the read returns end-of-file or fails, as when a USB serial adapter is unplugged), the reader stops watching it and ends every subscription, rather than being called back again at once, forever. A line which grows past max_line bytes without ending is discarded, so that noise on the line can't use up memory.
+#
+# The vision loop isn't written with asyncio, so :meth:`Telemetry_Reader.start_in_thread` runs the reader's event loop on a background thread; the vision loop then reads the latest records with :meth:`Telemetry_Reader.recent`, which never blocks for long.
+#
+# Run this file to benchmark the reader against a pseudo-terminal (pty) loopback::
+#
+#   python telemetry_reader.py --lines 20000
+#
+# This works only on POSIX systems (Linux, including the Pi, or macOS).
+import argparse
+import asyncio
+from collections import deque, namedtuple
+import os
+import threading
+import time
+
+import numpy
+
+from command_protocol import Frame_Decoder
+
+# A parsed record. received is the ``time.perf_counter()`` time at which its data was read; parsed is the time parsing finished.
+Record = namedtuple('Record', 'received parsed value')
+
+
+# The default line parser: decode the line to text, without the line ending.
+def parse_line(line):
+    return line.decode('ascii', 'replace').rstrip('\r')
+
+
+# Marks the end of a subscription's records.
+_END = object()
+
+
+# A consumer's queue of new records. If the consumer falls behind by more than maxsize records, the oldest are dropped.
+class Subscription(object):
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.closed = False
+
+    def offer(self, record):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(record)
+
+    # No more records will arrive; wake the consumer once it has taken those queued.
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.offer(_END)
+
+    # Wait for the next record. Raises EOFError once the reader has closed and every record has been taken.
+    async def get(self):
+        record = await self.queue.get()
+        if record is _END:
+            # Leave the marker for any later call.
+            self.queue.put_nowait(_END)
+            raise EOFError('the telemetry reader has closed')
+        return record
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.get()
+        except EOFError:
+            raise StopAsyncIteration
+
+
+class Telemetry_Reader(object):
+    # fd is the file descriptor to read, such as ``serial.Serial(...).fileno()``. parser turns one line (bytes, without the ``\n``) into a value. If binary is True, the data is instead decoded into :class:`command_protocol.Frame` values. capacity gives the number of records kept. A line longer than max_line bytes is discarded.
+    def __init__(self, fd, parser = parse_line, binary = False, capacity = 1024, max_line = 4096):
+        self.fd = fd
+        self.parser = parser
+        self.decoder = Frame_Decoder() if binary else None
+        self.records = deque(maxlen = capacity)
+        # Guards :attr:`records`, which other threads may read.
+        self._lock = threading.Lock()
+        self.subscriptions = []
+        self.max_line = max_line
+        self._partial = b''
+        # True while skipping the rest of a line which grew too long.
+        self._discarding = False
+        self.loop = None
+        # True once the port has gone away (or :meth:`stop` was called).
+        self.closed = False
+        # Statistics
+        self.record_count = 0
+        self.parse_errors = 0
+        self.long_lines = 0
+        self.start_time = None
+        self._parse_latencies = numpy.zeros(capacity)
+
+    # Start reading, using the given (or currently running) event loop.
+    def start(self, loop = None):
+        self.loop = loop or asyncio.get_event_loop()
+        os.set_blocking(self.fd, False)
+        self.start_time = time.perf_counter()
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    # Stop reading, and end every subscription. Calling this more than once is harmless.
+    def stop(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+        for subscription in self.subscriptions:
+            subscription.close()
+
+    # Run an event loop on a background thread and start reading there. Returns the loop, for use with ``asyncio.run_coroutine_threadsafe``.
+    def start_in_thread(self):
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            self.start(loop)
+            started.set()
+            loop.run_forever()
+        thread = threading.Thread(target = run, name = "telemetry")
+        thread.daemon = True
+        thread.start()
+        started.wait()
+        return loop
+
+    # Subscribe to new records. Call this from the reader's event loop.
+    def subscribe(self, maxsize = 256):
+        subscription = Subscription(maxsize)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.remove(subscription)
+
+    # Return the last count records (or all those held), oldest first. This is safe to call from any thread.
+    def recent(self, count = None):
+        with self._lock:
+            records = list(self.records)
+        return records if count is None else records[-count:]
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # The device went away; a pty whose other end closed, or an unplugged USB serial adapter, fails with EIO.
+            data = b''
+        # Otherwise, an empty read means end-of-file. The fd would stay readable, so stop watching it.
+        if not data:
+            self.stop()
+            return
+        received = time.perf_counter()
+        if self.decoder is not None:
+            values = self.decoder.feed(data)
+        else:
+            lines = (self._partial + data).split(b'\n')
+            # The last piece is an incomplete line; keep it for next time.
+            self._partial = lines.pop()
+            if self._discarding:
+                if lines:
+                    # The first piece ends the line which grew too long.
+                    lines.pop(0)
+                    self._discarding = False
+                else:
+                    self._partial = b''
+            if len(self._partial) > self.max_line:
+                self._partial = b''
+                self._discarding = True
+                self.long_lines += 1
+            values = []
+            for line in lines:
+                try:
+                    values.append(self.parser(line))
+                except ValueError:
+                    self.parse_errors += 1
+        parsed = time.perf_counter()
+        for value in values:
+            self._add(Record(received, parsed, value))
+
+    def _add(self, record):
+        with self._lock:
+            self.records.append(record)
+        self._parse_latencies[self.record_count % len(self._parse_latencies)] = record.parsed - record.received
+        self.record_count += 1
+        for subscription in self.subscriptions:
+            subscription.offer(record)
+
+    # Return the records per second since :meth:`start` and the parse latency (from reading the data to finishing its parse) percentiles, in milliseconds.
+    def stats(self):
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        results = {
+            'records': self.record_count,
+            'records_per_s': self.record_count / elapsed if elapsed > 0 else 0.0,
+            'parse_errors': self.parse_errors,
+            'long_lines': self.long_lines,
+        }
+        if self.record_count:
+            latencies = self._parse_latencies[:min(self.record_count, len(self._parse_latencies))]*1000.0
+            results['parse_p50_ms'], results['parse_p99_ms'] = numpy.percentile(latencies, (50, 99))
+        return results
+
+
+# Write lines holding a sequence number and send time to one end of a pty, as fast as possible, while a :class:`Telemetry_Reader` reads the other end. Returns the reader's statistics plus the end-to-end (write to parsed) latency percentiles, in milliseconds.
+async def benchmark(line_count = 10000):
+    import pty
+    import tty
+    master_fd, slave_fd = pty.openpty()
+    tty.setraw(slave_fd)
+    reader = Telemetry_Reader(slave_fd, parser = lambda line: [float(field) for field in line.split(b',')])
+    reader.start(asyncio.get_running_loop())
+    subscription = reader.subscribe(line_count)
+
+    def write_lines():
+        for seq in range(line_count):
+            os.write(master_fd, b'%d,%.9f\n' % (seq, time.perf_counter()))
+    writer = threading.Thread(target = write_lines)
+    writer.start()
+    latencies = []
+    while len(latencies) < line_count:
+        record = await asyncio.wait_for(subscription.get(), 5.0)
+        latencies.append(record.parsed - record.value[1])
+    writer.join()
+    reader.stop()
+    os.close(master_fd)
+    os.close(slave_fd)
+    results = reader.stats()
+    results['end_to_end_p50_ms'], results['end_to_end_p99_ms'] = numpy.percentile(latencies, (50, 99))*1000.0
+    results['dropped'] = subscription.dropped
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the telemetry reader over a pty loopback.')
+    parser.add_argument('--lines', type = int, default = 10000, help = 'Number of lines to send.')
+    args = parser.parse_args()
+    results = asyncio.run(benchmark(args.lines))
+    print("%(records)d lines, %(records_per_s).0f lines/s, parse p50 %(parse_p50_ms).3f ms, "
+          "p99 %(parse_p99_ms).3f ms, end to end p50 %(end_to_end_p50_ms).3f ms, "
+          "p99 %(end_to_end_p99_ms).3f ms, %(parse_errors)d parse errors, %(dropped)d dropped" % results)
+
+if __name__ == "__main__":
+    main()
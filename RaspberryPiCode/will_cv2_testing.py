@@ -5,9 +5,9 @@
 from __future__ import print_function
 import cv2
 import numpy as np
-from matplotlib import pyplot as plt
 import argparse
 import time
+from hsv_label_map import Hsv_Label_Map, ARENA_COLORS
 
 
 #---------THRESHOLDING AND PASTING LOGO-------
@@ -234,6 +234,8 @@ def foregroundextract():
     mask2 = np.where((mask==2) | (mask==0), 0, 1).astype('uint8')
     img = img*mask2[:,:,np.newaxis]
 
+    # matplotlib is slow to import and only needed here, so import it when used
+    from matplotlib import pyplot as plt
     plt.imshow(img)
     plt.colorbar()
     plt.show()
@@ -304,56 +306,63 @@ def on_high_v_thresh_trackbar(val):
     high_v = max(high_v, low_v+1)
     cv2.setTrackbarPos(high_v_name, detect, high_v)
 
-parser = argparse.ArgumentParser(description='Code for Thresholding Operations using inRange tutorial.')
-parser.add_argument('--camera', help='Camera divide number.', default=0, type=int)
-args = parser.parse_args()
+# Show the masks for each of the arena colors from the camera, with trackbars for trying out new ranges.
+# Press q to quit. args is a list of command line arguments; by default, they come from sys.argv.
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Code for Thresholding Operations using inRange tutorial.')
+    parser.add_argument('--camera', help='Camera divide number.', default=0, type=int)
+    args = parser.parse_args(args)
 
-cap = cv2.VideoCapture(0)
+    # I tested with the frame threshold to get these ranges for the colors
+    # Since the red ball and the red paint are on different ends of the hue spectrum
+    # red has two ranges, which the label map combines for us
+    colors = Hsv_Label_Map(ARENA_COLORS)
 
-cv2.namedWindow(capture)
-cv2.namedWindow(detect)
+    cap = cv2.VideoCapture(args.camera)
 
-cv2.createTrackbar(low_h_name, detect, low_h, max_value_h, on_low_h_thresh_trackbar)
-cv2.createTrackbar(high_h_name, detect, high_h, max_value_h, on_high_h_thresh_trackbar)
-cv2.createTrackbar(low_s_name, detect, low_s, max_value, on_low_s_thresh_trackbar)
-cv2.createTrackbar(high_s_name, detect, high_s, max_value, on_high_s_thresh_trackbar)
-cv2.createTrackbar(low_v_name, detect, low_v, max_value, on_low_v_thresh_trackbar)
-cv2.createTrackbar(high_v_name, detect, high_v, max_value, on_high_v_thresh_trackbar)
+    cv2.namedWindow(capture)
+    cv2.namedWindow(detect)
 
+    cv2.createTrackbar(low_h_name, detect, low_h, max_value_h, on_low_h_thresh_trackbar)
+    cv2.createTrackbar(high_h_name, detect, high_h, max_value_h, on_high_h_thresh_trackbar)
+    cv2.createTrackbar(low_s_name, detect, low_s, max_value, on_low_s_thresh_trackbar)
+    cv2.createTrackbar(high_s_name, detect, high_s, max_value, on_high_s_thresh_trackbar)
+    cv2.createTrackbar(low_v_name, detect, low_v, max_value, on_low_v_thresh_trackbar)
+    cv2.createTrackbar(high_v_name, detect, high_v, max_value, on_high_v_thresh_trackbar)
 
-while True:
 
-    ret, frame = cap.read()
-    frame = cv2.resize(frame, (600, 500))
-    if frame is None:
-        break
-    frame_HSV = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-    # frame_threshold = cv2.inRange(frame_HSV, (low_h, low_s, low_v), (high_h, high_s, high_v))
+    while True:
 
-    # I tested with the frame threshold to get these ranges for the colors
-    blue = cv2.inRange(frame_HSV, (105, 190, 0), (120,255,180))
-    green = cv2.inRange(frame_HSV, (50, 95, 60), (85,255,180))
-    yellow = cv2.inRange(frame_HSV, (10, 85, 0), (45,255,180))
+        ret, frame = cap.read()
+        if frame is None:
+            break
+        frame = cv2.resize(frame, (600, 500))
+        frame_HSV = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        # frame_threshold = cv2.inRange(frame_HSV, (low_h, low_s, low_v), (high_h, high_s, high_v))
+
+        # Classify every pixel against all the colors in one pass, then pick out each color's pixels from the labels. Where ranges overlap, a pixel shows only in the first color listed.
+        labels = colors.segment(frame_HSV)
+        blue = cv2.compare(labels, colors.label('blue'), cv2.CMP_EQ)
+        green = cv2.compare(labels, colors.label('green'), cv2.CMP_EQ)
+        yellow = cv2.compare(labels, colors.label('yellow'), cv2.CMP_EQ)
+        red = cv2.compare(labels, colors.label('red'), cv2.CMP_EQ)
+
+        cv2.imshow(capture, frame)
+        # cv2.imshow('hsv', frame_HSV)
+        # cv2.imshow(detect, frame_threshold)
+        cv2.imshow('blue', blue)
+        cv2.imshow('green', green)
+        # cv2.imshow('redball', redball)
+        # cv2.imshow('redeverything', redeverything)
+        cv2.imshow('red', red)
+        cv2.imshow('yellow', yellow)
 
-    # Since the red ball and the red paint are on different ends of the hue spectrum
-    # I had to add the two masks for those ranges
-    redball = cv2.inRange(frame_HSV, (0, 130, 0), (10,255,180))
-    redeverything = cv2.inRange(frame_HSV, (130, 160, 0), (180, 255, 255))
-    red = cv2.add(redball, redeverything)
-
-    cv2.imshow(capture, frame)
-    # cv2.imshow('hsv', frame_HSV)
-    # cv2.imshow(detect, frame_threshold)
-    cv2.imshow('blue', blue)
-    cv2.imshow('green', green)
-    # cv2.imshow('redball', redball)
-    # cv2.imshow('redeverything', redeverything)
-    cv2.imshow('red', red)
-    cv2.imshow('yellow', yellow)
-
-
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
-
-cv2.destroyAllWindows()
-cap.release()
\ No newline at end of file
+
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+    cv2.destroyAllWindows()
+    cap.release()
+
+if __name__ == '__main__':
+    main()